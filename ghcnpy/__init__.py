@@ -2,6 +2,14 @@
 from .iotools import *
 from .metadata import *
 from .plotting import *
+from .indices import *
+from .records import *
+from .parallel import *
+from .summaries import *
+from .spells import *
+from .gapfill import *
+from .correlation import *
+from .station import *
 
 def intro():
   print("GHCNPy | year 2025 Fixed by Shourya Sharma (github: https://github.com/shourya-sharma-33)")
@@ -0,0 +1,162 @@
+# Import Modules
+import numpy as np
+
+import ghcnpy as gp
+
+#################################################
+# MODULE: anomaly_matrix
+# (stations x days) anomalies of one element from
+# each station's day-of-year mean over a base
+# period (default: the whole record)
+#    smooth: centred window (days) applied to the
+#            day-of-year means
+# Returns dict with station_ids, dates, anomaly
+# ((stations, days) float32, NaN missing) and
+# climatology ((stations, 366))
+#################################################
+def anomaly_matrix(data, element, base_begin=None, base_end=None, smooth=31, reject_qflags=gp.QFLAG_CODES):
+    series = gp.daily_series(gp.filter_qflags(data, reject_qflags), element)
+    value = series["value"]
+    base_begin = series["begin_year"] if base_begin is None else base_begin
+    base_end = series["end_year"] if base_end is None else base_end
+    in_base = (series["year"] >= base_begin) & (series["year"] <= base_end)
+
+    # Day-of-year sums / counts per station in one pass
+    present = ~np.isnan(value) & in_base
+    total = np.zeros((value.shape[0], 366))
+    count = np.zeros((value.shape[0], 366))
+    np.add.at(total.T, series["doy"], np.where(present, value, 0.0).T)
+    np.add.at(count.T, series["doy"], present.T)
+    if smooth and smooth > 1:
+        # Circular running sums over the day of year
+        half = smooth // 2
+        total = sum(np.roll(total, offset, axis=1) for offset in range(-half, half + 1))
+        count = sum(np.roll(count, offset, axis=1) for offset in range(-half, half + 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        climatology = total / count
+
+    anomaly = (value - climatology[:, series["doy"]]).astype('f')
+    return {
+        "station_ids": series["station_ids"],
+        "element": element,
+        "dates": series["dates"],
+        "anomaly": anomaly,
+        "climatology": climatology.astype('f'),
+    }
+
+#################################################
+# MODULE: block_correlation
+# Pairwise-complete correlation between two blocks
+# of rows, all through matrix products:
+#    mask M, zero-filled values X
+#    n = Ma Mb', sx = Xa Mb', sy = Ma Xb',
+#    sxx = Xa^2 Mb', syy = Ma Xb^2', sxy = Xa Xb'
+# Returns (correlation, n), NaN below min_pairs
+#################################################
+def block_correlation(block_a, block_b, min_pairs=30):
+    return _terms_correlation(_block_terms(block_a), _block_terms(block_b), min_pairs)
+
+def _terms_correlation(terms_a, terms_b, min_pairs):
+    mask_a, value_a, square_a = terms_a
+    mask_b, value_b, square_b = terms_b
+    n = (mask_a @ mask_b.T).astype(np.float64)
+    sx = (value_a @ mask_b.T).astype(np.float64)
+    sy = (mask_a @ value_b.T).astype(np.float64)
+    sxx = (square_a @ mask_b.T).astype(np.float64)
+    syy = (mask_a @ square_b.T).astype(np.float64)
+    sxy = (value_a @ value_b.T).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx * sx) * (n * syy - sy * sy))
+    correlation[n < max(min_pairs, 2)] = np.nan
+    return correlation, n.astype(np.int64)
+
+def _block_terms(block):
+    present = ~np.isnan(block)
+    value = np.where(present, block, 0.0).astype('f')
+    return present.astype('f'), value, value * value
+
+#################################################
+# MODULE: correlation_neighbors
+# Top-k most correlated stations for every station
+# of an anomaly matrix, computed block by block so
+# only (block_size x block_size) terms and the
+# (stations x k) result are ever held
+#    block_size: stations per block; the mask,
+#            value and square terms of a block are
+#            float32 (block_size x days) arrays,
+#            3 per block and 2 blocks at a time,
+#            about 51 MB each at 256 x 50000 days
+#    min_pairs: days both stations need in common
+# Returns dict with station_ids, neighbors (index,
+# -1 where none), correlation and pairs, each
+# (stations, k), best first
+#################################################
+def correlation_neighbors(anomaly, k=10, block_size=256, min_pairs=365, station_ids=None):
+    if isinstance(anomaly, dict):
+        station_ids = anomaly["station_ids"]
+        anomaly = anomaly["anomaly"]
+    num_stations = anomaly.shape[0]
+    k = min(k, max(num_stations - 1, 0))
+    print("\nCORRELATING", num_stations, "STATIONS IN BLOCKS OF", block_size)
+
+    best = {
+        "index": np.full((num_stations, k), -1, dtype=np.int64),
+        "value": np.full((num_stations, k), -np.inf),
+        "pairs": np.zeros((num_stations, k), dtype=np.int64),
+    }
+    # The matrix is symmetric: each block above the diagonal also serves its mirror
+    for row_start in range(0, num_stations, block_size):
+        rows = slice(row_start, min(row_start + block_size, num_stations))
+        row_terms = _block_terms(anomaly[rows])
+        for column_start in range(row_start, num_stations, block_size):
+            columns = slice(column_start, min(column_start + block_size, num_stations))
+            column_terms = row_terms if rows == columns else _block_terms(anomaly[columns])
+            correlation, pairs = _terms_correlation(row_terms, column_terms, min_pairs)
+            correlation = np.where(np.isnan(correlation), -np.inf, correlation)
+            if rows == columns:
+                np.fill_diagonal(correlation, -np.inf)
+            _merge_top(best, k, rows, columns, correlation, pairs)
+            if rows != columns:
+                _merge_top(best, k, columns, rows, correlation.T, pairs.T)
+
+    best_index, best_value, best_pairs = best["index"], best["value"], best["pairs"]
+    order = np.argsort(-best_value, axis=1, kind="stable")
+    best_value = np.take_along_axis(best_value, order, axis=1)
+    best_index = np.take_along_axis(best_index, order, axis=1)
+    best_pairs = np.take_along_axis(best_pairs, order, axis=1)
+    missing = ~np.isfinite(best_value)
+    best_index[missing] = -1
+    best_pairs[missing] = 0
+    return {
+        "station_ids": list(station_ids) if station_ids is not None else None,
+        "neighbors": best_index,
+        "correlation": np.where(missing, np.nan, best_value).astype('f'),
+        "pairs": best_pairs,
+    }
+
+def _merge_top(best, k, rows, columns, correlation, pairs):
+    # Merge one block's candidates into the best k so far of its rows
+    if k == 0:
+        return None
+    row_count = rows.stop - rows.start
+    candidates = np.concatenate((best["value"][rows], correlation), axis=1)
+    candidate_index = np.concatenate((best["index"][rows], np.broadcast_to(
+        np.arange(columns.start, columns.stop), (row_count, columns.stop - columns.start))), axis=1)
+    candidate_pairs = np.concatenate((best["pairs"][rows], pairs), axis=1)
+    keep = np.argpartition(-candidates, k - 1, axis=1)[:, :k]
+    best["value"][rows] = np.take_along_axis(candidates, keep, axis=1)
+    best["index"][rows] = np.take_along_axis(candidate_index, keep, axis=1)
+    best["pairs"][rows] = np.take_along_axis(candidate_pairs, keep, axis=1)
+    return None
+
+#################################################
+# MODULE: reference_stations
+# Best correlated stations for one station, as a
+# list of (station_id, correlation, pairs)
+#################################################
+def reference_stations(neighbors, station_id):
+    row = neighbors["station_ids"].index(station_id)
+    return [(neighbors["station_ids"][index], float(value), int(pairs))
+            for index, value, pairs in zip(neighbors["neighbors"][row], neighbors["correlation"][row],
+                                           neighbors["pairs"][row])
+            if index >= 0]
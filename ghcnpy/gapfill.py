@@ -0,0 +1,257 @@
+# Import Modules
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import ghcnpy as gp
+
+#################################################
+# Neighbor Gap Filling
+# Missing days of a target station are estimated
+# from its k nearest neighbors:
+#    regression: target = slope * neighbor +
+#                intercept, fitted per month
+#    ratio: target = ratio * neighbor, with ratio
+#           = sum(target) / sum(neighbor) per month
+#           (amounts: PRCP, SNOW, SNWD ...)
+# Each neighbor is weighted per month by its
+# squared correlation with the target over the
+# days both reported; filled values get the
+# measurement flag FILL_MFLAG
+# Local copies of station files and tables are
+# reused for up to max_age seconds (default one
+# day), so the caches below keep hitting
+#################################################
+FILL_MFLAG = "F"
+
+GAPFILL_MAX_AGE = 86400
+
+RATIO_ELEMENTS = ("PRCP", "SNOW", "SNWD", "WESD", "WESF", "EVAP", "MDPR")
+
+#################################################
+# Caches
+#    neighbor records: ragged .dly records keyed by
+#        station and file version, LRU bounded
+#    fits: per-month coefficients keyed by target,
+#        neighbor, element, method and versions
+#################################################
+class _LRU:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+_station_records = _LRU(128)
+_fits = _LRU(65536)
+
+def clear_gapfill_cache():
+    _station_records.clear()
+    _fits.clear()
+    return None
+
+def _station_record(station_id, max_age):
+    infile = gp.station_file(station_id, max_age)
+    info = os.stat(infile)
+    key = (station_id, info.st_size, info.st_mtime_ns)
+    record = _station_records.get(key)
+    if record is None:
+        record = _station_records.put(key, gp.read_dly_ragged(infile))
+    return key, record
+
+#################################################
+# MODULE: find_neighbors
+# k nearest stations reporting an element over
+# years that overlap the target's
+#    max_distance: miles
+#    min_overlap: overlapping years needed
+#    table / inventory: station and inventory
+#          tables already loaded (fetched if None)
+# Returns list of (station_id, distance in miles)
+#################################################
+def find_neighbors(station_id, element, k=5, max_distance=100.0, min_overlap=10, max_age=GAPFILL_MAX_AGE,
+                   table=None, inventory=None):
+    if table is None:
+        table = gp.get_station_table(max_age)
+    if inventory is None:
+        inventory = gp.get_inventory_table(max_age)
+    row = table.find(station_id)
+    if row is None:
+        raise ValueError("Unknown station: " + str(station_id))
+
+    has_element = inventory["element"] == element
+    target = has_element & (inventory["station_ids"] == station_id.encode())
+    if not target.any():
+        return []
+    first_year = int(inventory["first_year"][target].min())
+    last_year = int(inventory["last_year"][target].max())
+
+    # Candidates: same element, enough overlapping years, not the target
+    overlap = (np.minimum(inventory["last_year"], last_year) - np.maximum(inventory["first_year"], first_year) + 1)
+    candidate = has_element & ~target & (overlap >= min_overlap)
+    distance = gp.haversine_miles(table.latitude[row], table.longitude[row],
+                                  inventory["latitude"][candidate], inventory["longitude"][candidate])
+    close = distance <= max_distance
+    ids = inventory["station_ids"][candidate][close]
+    distance = distance[close]
+    order = np.argsort(distance, kind="stable")[:k]
+    return [(ids[index].decode(), round(float(distance[index]), 3)) for index in order]
+
+#################################################
+# MODULE: fit_neighbors
+# Per-month fits of the target on each neighbor
+# from pairwise overlap sums (n, sx, sy, sxx, syy,
+# sxy) over days both stations reported
+#    target: (years, 12, 31) values, NaN missing
+#    neighbors: (k, years, 12, 31) values
+#    min_pairs: overlapping days needed in a month
+# Returns dict of (k, 12) arrays: slope, intercept
+# (regression) or slope = ratio, and weight
+#################################################
+def fit_neighbors(target, neighbors, method="regression", min_pairs=30):
+    both = ~np.isnan(target)[np.newaxis] & ~np.isnan(neighbors)
+    x = np.where(both, neighbors, 0.0)
+    y = np.where(both, target[np.newaxis], 0.0)
+    axes = (1, 3)
+    n = both.sum(axis=axes).astype(np.float64)
+    sx, sy = x.sum(axis=axes), y.sum(axis=axes)
+    sxx, syy, sxy = (x * x).sum(axis=axes), (y * y).sum(axis=axes), (x * y).sum(axis=axes)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = n * sxy - sx * sy
+        var_x = n * sxx - sx * sx
+        var_y = n * syy - sy * sy
+        correlation = cov / np.sqrt(var_x * var_y)
+        if method == "regression":
+            slope = cov / var_x
+            intercept = (sy - slope * sx) / n
+        elif method == "ratio":
+            slope = sy / sx
+            intercept = np.zeros_like(slope)
+        else:
+            raise ValueError("Unknown method: " + str(method))
+
+    usable = (n >= min_pairs) & np.isfinite(slope) & np.isfinite(correlation) & (correlation > 0)
+    return {
+        "method": method,
+        "slope": np.where(usable, slope, 0.0),
+        "intercept": np.where(usable, intercept, 0.0),
+        "weight": np.where(usable, correlation ** 2, 0.0),
+        "pairs": n.astype(np.int64),
+    }
+
+#################################################
+# MODULE: fill_gaps
+# Fill the missing days of one element in a cube
+# from aligned neighbor values and their fits
+# Returns a copy of the cube; filled days carry
+# FILL_MFLAG and a blank QFLAG
+#################################################
+def fill_gaps(cube, element, neighbors, fits):
+    element_counter = cube["elements"].index(element)
+    value = cube["value"][..., element_counter]
+    valid, days_in_month = gp.valid_dates(cube["begin_year"], cube["end_year"])
+
+    # Weighted mean of every neighbor's estimate, month by month
+    month_slope = fits["slope"][:, np.newaxis, :, np.newaxis]
+    month_intercept = fits["intercept"][:, np.newaxis, :, np.newaxis]
+    month_weight = fits["weight"][:, np.newaxis, :, np.newaxis]
+    available = ~np.isnan(neighbors) & (month_weight > 0)
+    estimate = np.where(available, month_slope * neighbors + month_intercept, 0.0)
+    weight = np.where(available, month_weight, 0.0)
+    total_weight = weight.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        estimate = (estimate * weight).sum(axis=0) / total_weight
+    if element in RATIO_ELEMENTS:
+        estimate = np.maximum(estimate, 0.0)
+
+    fill = valid & (value == -9999.) & (total_weight > 0)
+    filled = dict(cube)
+    for name in ("value", "mflag", "qflag"):
+        filled[name] = cube[name].copy()
+    filled["value"][..., element_counter][fill] = np.round(estimate[fill], 1)
+    filled["mflag"][..., element_counter][fill] = ord(FILL_MFLAG)
+    filled["qflag"][..., element_counter][fill] = 0
+    filled["filled"] = int(fill.sum())
+    return filled
+
+def _element_grid(record, element, begin_year, end_year, reject_qflags):
+    # (years, 12, 31) float64 values of one element, NaN missing
+    cube = gp.filter_qflags(gp.ragged_to_dense(record, [element], begin_year, end_year), reject_qflags)
+    grid = cube["value"][..., 0].astype(np.float64)
+    grid[grid == -9999.] = np.nan
+    return grid
+
+#################################################
+# MODULE: gap_fill_station
+# Neighbors, fits and fill for one station
+#    method: regression / ratio (default: ratio for
+#            amounts, regression otherwise)
+# Returns the filled cube (QFLAG rejected values
+# removed first) with neighbors / weights attached
+#################################################
+def gap_fill_station(station_id, element, k=5, method=None, max_distance=100.0, min_overlap=10, min_pairs=30,
+                     reject_qflags=gp.QFLAG_CODES, max_age=GAPFILL_MAX_AGE, table=None, inventory=None):
+    if method is None:
+        method = "ratio" if element in RATIO_ELEMENTS else "regression"
+    target_key, target_record = _station_record(station_id, max_age)
+    cube = gp.filter_qflags(gp.ragged_to_dense(target_record, [element]), reject_qflags)
+    target = cube["value"][..., 0].astype(np.float64)
+    target[target == -9999.] = np.nan
+
+    neighbors = find_neighbors(station_id, element, k, max_distance, min_overlap, max_age, table, inventory)
+    num_years = cube["end_year"] - cube["begin_year"] + 1
+    grids = np.full((len(neighbors), num_years, 12, 31), np.nan)
+    fits = {name: np.zeros((len(neighbors), 12)) for name in ("slope", "intercept", "weight")}
+    fits["method"] = method
+    for neighbor_counter, (neighbor_id, distance) in enumerate(neighbors):
+        neighbor_key, record = _station_record(neighbor_id, max_age)
+        grids[neighbor_counter] = _element_grid(record, element, cube["begin_year"], cube["end_year"], reject_qflags)
+
+        fit_key = (target_key, neighbor_key, element, method, min_pairs, reject_qflags)
+        fit = _fits.get(fit_key)
+        if fit is None:
+            fit = _fits.put(fit_key, fit_neighbors(target, grids[neighbor_counter][np.newaxis], method, min_pairs))
+        for name in ("slope", "intercept", "weight"):
+            fits[name][neighbor_counter] = fit[name][0]
+
+    filled = fill_gaps(cube, element, grids, fits)
+    filled["neighbors"] = neighbors
+    filled["fits"] = fits
+    return filled
+
+#################################################
+# MODULE: gap_fill_region
+# gap_fill_station over many stations; the station
+# and inventory tables are fetched once, neighbor
+# records and fits are shared through the caches
+# Returns dict station_id -> filled cube
+#################################################
+def gap_fill_region(station_ids, element, k=5, method=None, max_distance=100.0, min_overlap=10, min_pairs=30,
+                    reject_qflags=gp.QFLAG_CODES, max_age=GAPFILL_MAX_AGE):
+    print("\nGAP FILLING", element, "FOR", len(station_ids), "STATIONS")
+    table = gp.get_station_table(max_age)
+    inventory = gp.get_inventory_table(max_age)
+    return {station_id: gap_fill_station(station_id, element, k, method, max_distance, min_overlap, min_pairs,
+                                         reject_qflags, max_age, table, inventory)
+            for station_id in station_ids}
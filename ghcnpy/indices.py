@@ -0,0 +1,188 @@
+# Import Modules
+import numpy as np
+
+import ghcnpy as gp
+
+#################################################
+# Derived Index Definitions
+#    elements: GHCN-D elements the index needs
+#    daily: function(data, params) -> daily value,
+#           data maps element -> array (NaN=missing)
+#    aggregate: how days combine into months/years
+#               (sum, mean, count, max, min)
+#    params: default parameters (degC / mm)
+#################################################
+def _tavg(data, params):
+    return (data["TMAX"] + data["TMIN"]) / 2.0
+
+def _heating_degree_days(data, params):
+    return np.maximum(params["base"] - _tavg(data, params), 0.0)
+
+def _cooling_degree_days(data, params):
+    return np.maximum(_tavg(data, params) - params["base"], 0.0)
+
+def _growing_degree_days(data, params):
+    # Modified (86/50 F) method: TMAX and TMIN are both clipped to
+    # [base, upper] before averaging (McMaster & Wilhelm method 2)
+    tmax = np.clip(data["TMAX"], params["base"], params["upper"])
+    tmin = np.clip(data["TMIN"], params["base"], params["upper"])
+    return np.maximum((tmax + tmin) / 2.0 - params["base"], 0.0)
+
+def _threshold(element, compare):
+    def daily(data, params):
+        return compare(data[element], params["threshold"])
+    return daily
+
+INDICES = {
+    "TAVG": {"elements": ["TMAX", "TMIN"], "daily": _tavg, "aggregate": "mean", "params": {}},
+    "DTR": {"elements": ["TMAX", "TMIN"], "daily": lambda data, params: data["TMAX"] - data["TMIN"],
+            "aggregate": "mean", "params": {}},
+    "HDD": {"elements": ["TMAX", "TMIN"], "daily": _heating_degree_days, "aggregate": "sum",
+            "params": {"base": 18.3}},
+    "CDD": {"elements": ["TMAX", "TMIN"], "daily": _cooling_degree_days, "aggregate": "sum",
+            "params": {"base": 18.3}},
+    "GDD": {"elements": ["TMAX", "TMIN"], "daily": _growing_degree_days, "aggregate": "sum",
+            "params": {"base": 10.0, "upper": 30.0}},
+    "FD": {"elements": ["TMIN"], "daily": _threshold("TMIN", np.less), "aggregate": "count",
+           "params": {"threshold": 0.0}},
+    "ID": {"elements": ["TMAX"], "daily": _threshold("TMAX", np.less), "aggregate": "count",
+           "params": {"threshold": 0.0}},
+    "SU": {"elements": ["TMAX"], "daily": _threshold("TMAX", np.greater), "aggregate": "count",
+           "params": {"threshold": 25.0}},
+    "TR": {"elements": ["TMIN"], "daily": _threshold("TMIN", np.greater), "aggregate": "count",
+           "params": {"threshold": 20.0}},
+    "TXX": {"elements": ["TMAX"], "daily": lambda data, params: data["TMAX"], "aggregate": "max", "params": {}},
+    "TNN": {"elements": ["TMIN"], "daily": lambda data, params: data["TMIN"], "aggregate": "min", "params": {}},
+    "PRCPTOT": {"elements": ["PRCP"], "daily": lambda data, params: data["PRCP"], "aggregate": "sum", "params": {}},
+    "R1MM": {"elements": ["PRCP"], "daily": _threshold("PRCP", np.greater_equal), "aggregate": "count",
+             "params": {"threshold": 1.0}},
+    "R10MM": {"elements": ["PRCP"], "daily": _threshold("PRCP", np.greater_equal), "aggregate": "count",
+              "params": {"threshold": 10.0}},
+    "RX1DAY": {"elements": ["PRCP"], "daily": lambda data, params: data["PRCP"], "aggregate": "max", "params": {}},
+}
+
+#################################################
+# MODULE: register_index
+# Add a custom index to the engine
+#################################################
+def register_index(name, elements, daily, aggregate="sum", params=None):
+    if aggregate not in ("sum", "mean", "count", "max", "min"):
+        raise ValueError("Unknown aggregate: " + str(aggregate))
+    INDICES[name] = {"elements": list(elements), "daily": daily, "aggregate": aggregate,
+                     "params": dict(params or {})}
+    return None
+
+#################################################
+# MODULE: compute_index
+# Evaluate a derived index over one station cube
+# or a stack of cubes (see stack_cubes)
+#    freq: daily, monthly or annual
+#    min_complete: fraction of valid days needed
+#                  in a month / year, else -9999
+#    **params: override the index defaults
+# Returns dict with value and completeness
+#    value: ([stations,] years[, 12[, 31]])
+#################################################
+def compute_index(data, name, freq="monthly", min_complete=0.8, **params):
+    if name not in INDICES:
+        raise ValueError("Unknown index: " + str(name))
+    if freq not in ("daily", "monthly", "annual"):
+        raise ValueError("Unknown freq: " + str(freq))
+    index = INDICES[name]
+    index_params = dict(index["params"])
+    index_params.update(params)
+
+    # Work on (stations, years, 12, 31), NaN where missing or not a real date
+    single = "station_ids" not in data
+    value = data["value"][np.newaxis] if single else data["value"]
+    valid, days_in_month = gp.valid_dates(data["begin_year"], data["end_year"])
+
+    element_data = {}
+    present = np.broadcast_to(valid, value.shape[:4]).copy()
+    for element in index["elements"]:
+        if element not in data["elements"]:
+            raise ValueError("Index " + name + " needs element " + element)
+        element_value = value[..., data["elements"].index(element)]
+        present &= element_value != -9999.
+        element_data[element] = np.where(element_value != -9999., element_value, np.nan)
+
+    with np.errstate(invalid='ignore'):
+        daily = np.asarray(index["daily"](element_data, index_params), dtype='f')
+    daily = np.where(present, daily, np.nan)
+
+    if freq == "daily":
+        result = np.where(present, daily, -9999.).astype('f')
+        completeness = present.astype('f')
+    else:
+        # Reduce over days, then over months too for annual values
+        axes = (3,) if freq == "monthly" else (2, 3)
+        possible = days_in_month if freq == "monthly" else days_in_month.sum(axis=1)
+        count = present.sum(axis=axes)
+        completeness = (count / possible[np.newaxis]).astype('f')
+
+        aggregate = index["aggregate"]
+        zeroed = np.where(present, daily, 0.0)
+        if aggregate in ("sum", "count"):
+            result = zeroed.sum(axis=axes)
+        elif aggregate == "mean":
+            result = zeroed.sum(axis=axes) / np.maximum(count, 1)
+        elif aggregate == "max":
+            result = np.where(present, daily, -np.inf).max(axis=axes)
+        else:
+            result = np.where(present, daily, np.inf).min(axis=axes)
+
+        # Totals and counts scale with the days that were observed; keep only complete periods
+        result = np.where((completeness >= min_complete) & (count > 0), result, -9999.).astype('f')
+
+    if single:
+        result, completeness = result[0], completeness[0]
+    return {
+        "index": name,
+        "freq": freq,
+        "station_ids": [data["station_id"]] if single else list(data["station_ids"]),
+        "begin_year": data["begin_year"],
+        "end_year": data["end_year"],
+        "params": index_params,
+        "value": result,
+        "completeness": completeness,
+    }
+
+#################################################
+# MODULE: compute_indices
+# Several indices at once, keyed by index name
+#################################################
+def compute_indices(data, names, freq="monthly", min_complete=0.8):
+    return {name: compute_index(data, name, freq, min_complete) for name in names}
+
+#################################################
+# MODULE: daily_climatology
+# Day-of-year statistics of one element over a
+# base period (default: the whole record)
+#    mean / min / max: (12, 31) float32
+#    count: (12, 31) years with a valid value
+# Days with no valid years are -9999
+#################################################
+def daily_climatology(cube, element, begin_year=None, end_year=None, reject_qflags=gp.QFLAG_CODES):
+    if element not in cube["elements"]:
+        raise ValueError("Cube has no element " + element)
+    begin_year = cube["begin_year"] if begin_year is None else begin_year
+    end_year = cube["end_year"] if end_year is None else end_year
+    cube = gp.select_years(gp.filter_qflags(cube, reject_qflags), begin_year, end_year)
+    value = cube["value"][..., cube["elements"].index(element)]
+    valid, days_in_month = gp.valid_dates(begin_year, end_year)
+    present = valid & (value != -9999.)
+
+    count = present.sum(axis=0)
+    has_data = count > 0
+    climatology = {
+        "element": element,
+        "begin_year": begin_year,
+        "end_year": end_year,
+        "mean": np.where(present, value, 0.0).sum(axis=0) / np.maximum(count, 1),
+        "min": np.where(present, value, np.inf).min(axis=0),
+        "max": np.where(present, value, -np.inf).max(axis=0),
+        "count": count.astype(np.int32),
+    }
+    for stat in ("mean", "min", "max"):
+        climatology[stat] = np.where(has_data, climatology[stat], -9999.).astype('f')
+    return climatology
@@ -2,26 +2,339 @@
 import re
 import os
 import sys
+import time
+import hashlib
+import zlib
+import contextlib
 import requests
+import urllib3
 import datetime
 from datetime import date
 import pandas as pd
 import numpy as np
 import netCDF4 as nc
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 import ghcnpy as gp
 
+GHCND_URL = "https://www1.ncdc.noaa.gov/pub/data/ghcn/daily/"
+
+#################################################
+# MODULE: download_file
+# Stream a URL to disk in chunks (constant RAM)
+#    - bytes go to {outfile}.part, renamed onto
+#      outfile only once complete and verified
+#    - a broken transfer resumes with an HTTP
+#      Range request from the bytes already kept
+#    - expected_size / checksum (hex digest of
+#      checksum_type, e.g. md5, sha256) are
+#      checked before the rename
+#    - bytes are kept as sent, so every request
+#      asks for Accept-Encoding: identity
+#################################################
+def download_file(url, outfile, chunk_size=1 << 20, retries=5, expected_size=None, checksum=None,
+                  checksum_type="md5", timeout=60):
+    part_file = outfile + ".part"
+    validator = None
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = "bytes=%d-" % offset
+            if validator:
+                headers["If-Range"] = validator
+        try:
+            with requests.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                if r.status_code == 416:
+                    # Nothing left to send: the part file already holds the whole resource
+                    total_size = int(r.headers.get("Content-Range", "*/-1").split("/")[-1])
+                    if total_size != offset:
+                        os.remove(part_file)
+                        raise IOError("Partial download does not match remote size: " + url)
+                    break
+                r.raise_for_status()
+                if r.status_code == 206:
+                    total_size = int(r.headers["Content-Range"].split("/")[-1])
+                else:
+                    # Full response (first try, or server ignored / refused the range)
+                    offset = 0
+                    total_size = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+                validator = r.headers.get("ETag") or r.headers.get("Last-Modified")
+
+                with open(part_file, "ab" if offset else "wb") as f:
+                    for chunk in r.raw.stream(chunk_size, decode_content=False):
+                        f.write(chunk)
+            received = os.path.getsize(part_file)
+            if total_size is not None and received < total_size:
+                raise IOError("Transfer ended at %d of %d bytes: %s" % (received, total_size, url))
+            break
+        except requests.HTTPError as e:
+            # Client errors (404, ...) will not go away by retrying
+            if e.response is not None and e.response.status_code < 500:
+                raise
+            if attempt == retries:
+                raise
+            print("DOWNLOAD FAILED, RETRYING (", attempt + 1, "/", retries, "): ", e)
+            time.sleep(min(2 ** attempt, 30))
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                urllib3.exceptions.HTTPError, IOError) as e:
+            if attempt == retries:
+                raise
+            print("DOWNLOAD INTERRUPTED, RESUMING (", attempt + 1, "/", retries, "): ", e)
+            time.sleep(min(2 ** attempt, 30))
+
+    # Integrity checks before the file becomes visible
+    received = os.path.getsize(part_file)
+    if expected_size is not None and received != expected_size:
+        os.remove(part_file)
+        raise IOError("Size mismatch for %s: got %d, expected %d" % (url, received, expected_size))
+    if checksum is not None:
+        digest = hashlib.new(checksum_type)
+        with open(part_file, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        if digest.hexdigest() != checksum.lower():
+            os.remove(part_file)
+            raise IOError("Checksum mismatch for %s: got %s" % (url, digest.hexdigest()))
+    os.replace(part_file, outfile)
+    return outfile
+
+#################################################
+# MODULE: set_data_dir / data_path
+# Shared directory for downloaded files. Defaults
+# to $GHCNPY_DATA_DIR, else the working directory;
+# created on first use
+#################################################
+_data_dir = os.environ.get("GHCNPY_DATA_DIR", ".")
+
+def set_data_dir(path):
+    global _data_dir
+    os.makedirs(path, exist_ok=True)
+    _data_dir = path
+    return _data_dir
+
+def get_data_dir():
+    return _data_dir
+
+def data_path(filename):
+    if not os.path.isdir(_data_dir):
+        os.makedirs(_data_dir, exist_ok=True)
+    return os.path.join(_data_dir, filename)
+
+#################################################
+# MODULE: file_lock
+# Exclusive lock on .locks/{file}.lock next to
+# path, held across processes (flock, or msvcrt
+# on Windows)
+#################################################
+LOCK_DIR = ".locks"
+
+@contextlib.contextmanager
+def file_lock(path):
+    lock_dir = os.path.join(os.path.dirname(path), LOCK_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, os.path.basename(path) + ".lock"), "a+") as handle:
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+            else:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+#################################################
+# MODULE: fetch_resource
+# Single-flight download into the data directory
+#    - one process downloads while the others
+#      wait on the lock, then reuse its file
+#    - max_age (seconds): reuse an existing copy
+#      this recent (None = always reuse, 0 = only
+#      reuse a copy fetched while waiting)
+#    - compression: keep the file compressed as
+#      {filename}{suffix} (see compress_file); a
+#      fresh uncompressed copy is compressed in
+#      place instead of downloaded again
+# The file appears by atomic rename, so readers
+# never see it half written
+#################################################
+def fetch_resource(url, filename, max_age=0, compression=None):
+    outfile = data_path(filename)
+    if compression is not None:
+        outfile += COMPRESSION_SUFFIXES[compression]
+    requested = time.time()
+    with file_lock(outfile):
+        if _is_fresh(outfile, requested, max_age):
+            return outfile
+        if compression is None:
+            download_file(url, outfile)
+            os.utime(outfile)
+        elif _is_fresh(data_path(filename), requested, max_age):
+            compress_file(data_path(filename), outfile, compression, _compression_level)
+        else:
+            download_file(url, outfile + ".download")
+            # Stamp the fetch time first: the compressed file and its stored index keep this mtime
+            os.utime(outfile + ".download")
+            compress_file(outfile + ".download", outfile, compression, _compression_level)
+    return outfile
+
+def _is_fresh(path, requested, max_age):
+    if not os.path.exists(path):
+        return False
+    modified = os.path.getmtime(path)
+    return modified >= requested or max_age is None or time.time() - modified <= max_age
+
+#################################################
+# Compressed storage
+# Station files can be kept compressed in the
+# data directory; readers pick the codec from the
+# file suffix and decompress as a stream
+#    gzip: {file}.gz, zlib: {file}.zz (stdlib)
+#    zstd: {file}.zst (needs zstandard)
+# set_compression() picks the codec for new
+# station files, default $GHCNPY_COMPRESSION
+# (unset = uncompressed)
+#################################################
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zlib": ".zz", "zstd": ".zst"}
+
+_compression = os.environ.get("GHCNPY_COMPRESSION") or None
+_compression_level = None
+
+def set_compression(codec=None, level=None):
+    global _compression, _compression_level
+    if codec is not None:
+        _compressor(codec, level)
+    _compression, _compression_level = codec, level
+    return _compression
+
+def get_compression():
+    return _compression
+
+def compression_codec(path):
+    for codec, suffix in COMPRESSION_SUFFIXES.items():
+        if path.endswith(suffix):
+            return codec
+    return None
+
+def _compressor(codec, level=None):
+    if codec == "gzip":
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+    if codec == "zlib":
+        return zlib.compressobj(6 if level is None else level)
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    raise ValueError("Unknown compression: " + str(codec))
+
+def _decompressor(codec):
+    if codec == "gzip":
+        return zlib.decompressobj(31)
+    if codec == "zlib":
+        return zlib.decompressobj()
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError("Unknown compression: " + str(codec))
+
+#################################################
+# MODULE: compress_file
+# Stream a file into its compressed form
+#    outfile: default {infile}{suffix}
+#    remove: delete infile (and its .idx.npz)
+# The compressed file keeps infile's mtime, so
+# max_age still sees when it was fetched; .dly
+# files get their line index (see get_dly_index)
+# built from the plain text, so it is never
+# rebuilt by decompressing
+#################################################
+def compress_file(infile, outfile=None, codec="gzip", level=None, remove=True, chunk_size=1 << 20):
+    if outfile is None:
+        outfile = infile + COMPRESSION_SUFFIXES[codec]
+    compressor = _compressor(codec, level)
+    temp_file = outfile + ".%d.tmp" % os.getpid()
+    with open(infile, 'rb') as source, open(temp_file, 'wb') as target:
+        for chunk in iter(lambda: source.read(chunk_size), b""):
+            target.write(compressor.compress(chunk))
+        target.write(compressor.flush())
+    status = os.stat(infile)
+    os.utime(temp_file, ns=(status.st_atime_ns, status.st_mtime_ns))
+    os.replace(temp_file, outfile)
+    if os.path.splitext(outfile)[0].endswith(".dly"):
+        _store_dly_index(outfile, build_dly_index(infile))
+    if remove:
+        os.remove(infile)
+        if os.path.exists(infile + ".idx.npz"):
+            os.remove(infile + ".idx.npz")
+    return outfile
+
+#################################################
+# MODULE: compress_station_files
+# Compress every .dly file of a directory (default
+# the data directory) in place
+# Returns (bytes before, bytes after)
+#################################################
+def compress_station_files(directory=None, codec="gzip", level=None):
+    directory = _data_dir if directory is None else directory
+    print("\nCOMPRESSING STATION FILES IN", directory, "WITH", codec.upper())
+    before = after = 0
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".dly"):
+            continue
+        infile = os.path.join(directory, filename)
+        with file_lock(infile + COMPRESSION_SUFFIXES[codec]):
+            before += os.path.getsize(infile)
+            after += os.path.getsize(compress_file(infile, codec=codec, level=level))
+    return before, after
+
+#################################################
+# MODULE: iter_data_file / read_data_file
+# Contents of a data file, plain or compressed,
+# decompressed chunk by chunk as it is read
+#################################################
+def iter_data_file(path, chunk_size=1 << 20):
+    codec = compression_codec(path)
+    with open(path, 'rb') as file_handle:
+        if codec is None:
+            yield from iter(lambda: file_handle.read(chunk_size), b"")
+            return
+        decompressor = _decompressor(codec)
+        for chunk in iter(lambda: file_handle.read(chunk_size), b""):
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+def read_data_file(path):
+    if compression_codec(path) is None:
+        with open(path, 'rb') as file_handle:
+            return file_handle.read()
+    return b"".join(iter_data_file(path))
+
 #################################################
 # MODULE: get_ghcnd_version
 # Get which version of GHCN-D we are using
 #################################################
 def get_ghcnd_version():
-    url = "https://www1.ncdc.noaa.gov/pub/data/ghcn/daily/ghcnd-version.txt"
-    r = requests.get(url)
-    with open("ghcnd-version.txt", "wb") as f:
-        f.write(r.content)
+    version_file = fetch_resource(GHCND_URL + "ghcnd-version.txt", "ghcnd-version.txt")
     try:
-        with open("ghcnd-version.txt", "r") as myfile:
+        with open(version_file, "r") as myfile:
             ghcnd_version = myfile.read().replace('\n', '')
     except:
         print("Version file does not exist: ghcnd-version.txt")
@@ -30,41 +343,54 @@ def get_ghcnd_version():
 
 #################################################
 # MODULE: get_data_station
-# Fetch Individual station (.dly ASCII format)
+# Fetch Individual station
+#    source: dly - all/{id}.dly (fixed width)
+#            csv - by_station/{id}.csv.gz, several
+#                  times smaller to transfer
+#    default from set_station_source() or
+#    $GHCNPY_STATION_SOURCE, else dly
+# Both read into the same records (read_dly)
 #################################################
-def get_data_station(station_id):
+STATION_SOURCES = ("dly", "csv")
+
+_station_source = os.environ.get("GHCNPY_STATION_SOURCE") or "dly"
+
+def set_station_source(source="dly"):
+    global _station_source
+    if source not in STATION_SOURCES:
+        raise ValueError("Unknown station source: " + str(source))
+    _station_source = source
+    return _station_source
+
+def get_data_station(station_id, max_age=0, source=None):
     print("\nGETTING DATA FOR STATION: ", station_id)
-    url = f"https://www1.ncdc.noaa.gov/pub/data/ghcn/daily/all/{station_id}.dly"
-    r = requests.get(url)
-    with open(f"{station_id}.dly", "wb") as f:
-        f.write(r.content)
-    outfile = f"{station_id}.dly"
-    return outfile
+    return station_file(station_id, max_age, source)
+
+def station_file(station_id, max_age=0, source=None):
+    # Same as get_data_station, without the progress message
+    source = _station_source if source is None else source
+    if source == "csv":
+        return fetch_resource(GHCND_URL + f"by_station/{station_id}.csv.gz", f"{station_id}.csv.gz", max_age)
+    if source != "dly":
+        raise ValueError("Unknown station source: " + str(source))
+    return fetch_resource(GHCND_URL + f"all/{station_id}.dly", f"{station_id}.dly", max_age, _compression)
 
 #################################################
 # MODULE: get_data_year
 # Fetch 1 Year of Data (.csv ASCII format)
 #################################################
-def get_data_year(year):
+def get_data_year(year, max_age=0):
     print("\nGETTING DATA FOR YEAR: ", year)
-    url = f"https://www1.ncdc.noaa.gov/pub/data/ghcn/daily/by_year/{year}.csv.gz"
-    r = requests.get(url)
-    with open(f"{year}.csv.gz", "wb") as f:
-        f.write(r.content)
-    outfile = f"{year}.csv.gz"
+    outfile = fetch_resource(GHCND_URL + f"by_year/{year}.csv.gz", f"{year}.csv.gz", max_age)
     return outfile
 
 #################################################
 # MODULE: get_ghcnd_stations
 # Get ghcnd-stations.txt file
 #################################################
-def get_ghcnd_stations():
+def get_ghcnd_stations(max_age=0):
     print("\nGRABBING LATEST STATION METADATA FILE")
-    url = "https://www1.ncdc.noaa.gov/pub/data/ghcn/daily/ghcnd-stations.txt"
-    r = requests.get(url)
-    with open("ghcnd-stations.txt", "wb") as f:
-        f.write(r.content)
-    ghcnd_stnfile = "ghcnd-stations.txt"
+    ghcnd_stnfile = fetch_resource(GHCND_URL + "ghcnd-stations.txt", "ghcnd-stations.txt", max_age)
     ghcnd_stations = np.genfromtxt(ghcnd_stnfile, delimiter=(11,9,10,7,4,30), dtype=str)
     return ghcnd_stations
 
@@ -72,221 +398,791 @@ def get_ghcnd_stations():
 # MODULE: get_ghcnd_inventory
 # Get ghcnd-inventory.txt file
 #################################################
-def get_ghcnd_inventory():
+def get_ghcnd_inventory(max_age=0):
     print("\nGRABBING LATEST STATION INVENTORY FILE")
-    url = "https://www1.ncdc.noaa.gov/pub/data/ghcn/daily/ghcnd-inventory.txt"
-    r = requests.get(url)
-    with open("ghcnd-inventory.txt", "wb") as f:
-        f.write(r.content)
-    ghcnd_invfile = "ghcnd-inventory.txt"
+    ghcnd_invfile = fetch_resource(GHCND_URL + "ghcnd-inventory.txt", "ghcnd-inventory.txt", max_age)
     ghcnd_inventory = np.genfromtxt(ghcnd_invfile, delimiter=(11,9,11,4), dtype=str)
     return ghcnd_inventory
 
+#################################################
+# MODULE: get_inventory_table
+# ghcnd-inventory.txt as parallel columns, one row
+# per (station, element)
+#    station_ids: S11, latitude / longitude: float
+#    element: U4, first_year / last_year: int32
+# The parsed table is reused until the file
+# itself changes (size / mtime)
+#################################################
+INVENTORY_LINE_LENGTH = 45
+
+_inventory_tables = {}
+
+def get_inventory_table(max_age=0):
+    ghcnd_invfile = fetch_resource(GHCND_URL + "ghcnd-inventory.txt", "ghcnd-inventory.txt", max_age)
+    info = os.stat(ghcnd_invfile)
+    version = (info.st_size, info.st_mtime_ns)
+    cached = _inventory_tables.get(ghcnd_invfile)
+    if cached is None or cached[0] != version:
+        with open(ghcnd_invfile, 'rb') as file_handle:
+            chars = _fixed_width_chars(file_handle.read(), INVENTORY_LINE_LENGTH)
+        inventory = {
+            "station_ids": chars[:, 0:11].copy().view("S11").ravel(),
+            "latitude": chars[:, 12:20].copy().view("S8").ravel().astype(np.float64),
+            "longitude": chars[:, 21:30].copy().view("S9").ravel().astype(np.float64),
+            "element": np.char.decode(chars[:, 31:35].copy().view("S4").ravel(), "ascii"),
+            "first_year": _parse_fixed_int(chars[:, 36:40]).astype(np.int32),
+            "last_year": _parse_fixed_int(chars[:, 41:45]).astype(np.int32),
+        }
+        cached = (version, inventory)
+        _inventory_tables[ghcnd_invfile] = cached
+    return cached[1]
+
+#################################################
+# MODULE: element_scale
+# Divisor turning raw GHCN-D integers into units
+#    tenths (degC, mm, m/s, ...) -> 10.0
+#    everything else (mm, cm, %, WT**) -> 1.0
+#################################################
+ELEMENT_SCALE = {
+    "TMAX": 10.0, "TMIN": 10.0, "TAVG": 10.0, "TOBS": 10.0,
+    "MDTN": 10.0, "MDTX": 10.0, "MNPN": 10.0, "MXPN": 10.0,
+    "PRCP": 10.0, "MDPR": 10.0, "EVAP": 10.0, "MDEV": 10.0,
+    "WESD": 10.0, "WESF": 10.0, "THIC": 10.0,
+    "AWND": 10.0, "WSF1": 10.0, "WSF2": 10.0, "WSF5": 10.0,
+    "WSFG": 10.0, "WSFI": 10.0, "WSFM": 10.0,
+    "SNOW": 1.0, "SNWD": 1.0,
+}
+
+# Core elements, in the column order used by the csv / list outputs
+CORE_ELEMENTS = ["TMAX", "TMIN", "PRCP", "SNOW", "SNWD"]
+
+def element_scale(element):
+    if element in ELEMENT_SCALE:
+        return ELEMENT_SCALE[element]
+    # Soil temperatures (SN*#, SX*#) are tenths of degC
+    if element[0:2] in ("SN", "SX") and element[2:4].isdigit():
+        return 10.0
+    return 1.0
+
+#################################################
+# MODULE: qflag_mask / filter_qflags
+# Quality flags are kept as uint8 (0 = blank) and
+# rejected through a bitmask, one bit per QFLAG
+#################################################
+QFLAG_CODES = "DGIKLMNORSTWXZ"
+
+_QFLAG_BITS = np.zeros(256, dtype=np.uint16)
+for _bit, _code in enumerate(QFLAG_CODES):
+    _QFLAG_BITS[ord(_code)] = 1 << _bit
+
+def qflag_mask(flags=QFLAG_CODES):
+    mask = 0
+    for code in flags:
+        mask |= int(_QFLAG_BITS[ord(code)])
+    return mask
+
+def filter_qflags(cube, reject=QFLAG_CODES):
+    if not isinstance(reject, int):
+        reject = qflag_mask(reject)
+    rejected = (_QFLAG_BITS[cube["qflag"]] & reject) != 0
+    filtered = dict(cube)
+    filtered["value"] = np.where(rejected, np.float32(-9999.0), cube["value"])
+    return filtered
+
+#################################################
+# MODULE: read_dly_ragged
+# Parse a .dly file into a ragged (CSR-style)
+# station record sized to actual coverage
+#    elements: element names
+#    element_ptr: rows of element e are
+#        element_ptr[e]:element_ptr[e + 1]
+#    months: year * 12 + (month - 1) per row,
+#        ascending within each element
+#    value: (rows, 31) float32, -9999 missing
+#    mflag/qflag/sflag: (rows, 31) uint8 codes
+#    begin_date / end_date: optional YYYYMM[DD]
+#        window, read through the offset index
+# Every line is decoded at once as a byte array
+# by_station .csv(.gz) files are read with
+# read_station_csv_ragged instead
+#################################################
+DLY_LINE_LENGTH = 269
+
+def _parse_fixed_int(chars):
+    # chars: (..., width) uint8, right aligned digits, optional '-'
+    digits = chars.astype(np.int32) - 48
+    negative = (digits == -3).any(axis=-1)
+    np.maximum(digits, 0, out=digits)
+    width = chars.shape[-1]
+    number = digits @ (10 ** np.arange(width - 1, -1, -1, dtype=np.int32))
+    return np.where(negative, -number, number)
+
+def _parse_dly_lines(raw):
+    chars = _fixed_width_chars(raw, DLY_LINE_LENGTH)
+
+    year = _parse_fixed_int(chars[:, 11:15])
+    month = _parse_fixed_int(chars[:, 15:17])
+    element = np.char.decode(chars[:, 17:21].copy().view("S4").ravel(), "ascii")
+
+    days = chars[:, 21:21 + 31 * 8].reshape(len(chars), 31, 8)
+    raw_value = _parse_fixed_int(days[:, :, 0:5])
+    flags = days[:, :, 5:8].copy()
+    flags[flags == 32] = 0
+    return year, month, element, raw_value, flags
+
+def read_dly_ragged(infile, elements=None, begin_date=None, end_date=None):
+    if is_station_csv(infile):
+        return read_station_csv_ragged(infile, elements, begin_date, end_date)
+    if begin_date is None and end_date is None:
+        raw = read_data_file(infile)
+    else:
+        raw = read_dly_window(infile, begin_date, end_date)
+    year, month, element, raw_value, flags = _parse_dly_lines(raw)
+    return _ragged_from_lines(os.path.basename(infile)[0:11], elements, year, month, element, raw_value, flags)
+
+def _ragged_from_lines(station_id, elements, year, month, element, raw_value, flags):
+    # Default to every element found in the file
+    if elements is None:
+        elements = sorted(set(element.tolist()))
+    elements = list(elements)
+    keep = np.flatnonzero(np.isin(element, elements))
+
+    line_elements, line_element_index = np.unique(element[keep], return_inverse=True)
+    element_index = np.array([elements.index(x) for x in line_elements], dtype=np.int64)[line_element_index]
+    months = (year[keep] * 12 + month[keep] - 1).astype(np.int32)
+
+    # Order rows by (element, month); a repeated month keeps its last line
+    order = np.lexsort((np.arange(len(keep)), months, element_index))
+    row_key = element_index[order] * 1000000 + months[order]
+    last = np.ones(len(row_key), dtype=bool)
+    last[:-1] = row_key[1:] != row_key[:-1]
+    order = order[last]
+    element_index = element_index[order]
+    rows = keep[order]
+
+    scale = np.array([element_scale(x) for x in elements], dtype='f')[element_index]
+    raw_value = raw_value[rows]
+    value = np.where(raw_value == -9999, np.float32(-9999.0),
+                     raw_value.astype('f') / scale[:, np.newaxis]).astype('f')
+    months = months[order]
+    if len(months):
+        ghcnd_begin_year, ghcnd_end_year = int(months.min() // 12), int(months.max() // 12)
+    else:
+        ghcnd_begin_year = ghcnd_end_year = datetime.datetime.now().year
+
+    return {
+        "station_id": station_id,
+        "begin_year": ghcnd_begin_year,
+        "end_year": ghcnd_end_year,
+        "elements": elements,
+        "element_ptr": np.searchsorted(element_index, np.arange(len(elements) + 1)).astype(np.int64),
+        "months": months,
+        "value": value,
+        "mflag": flags[rows, :, 0],
+        "qflag": flags[rows, :, 1],
+        "sflag": flags[rows, :, 2],
+    }
+
+#################################################
+# MODULE: read_station_csv_ragged
+# Parse a by_station {id}.csv(.gz) file into the
+# ragged record read_dly_ragged gives for the
+# station's .dly file
+#    rows: ID,DATE,ELEMENT,DATA_VALUE,M_FLAG,
+#          Q_FLAG,S_FLAG,OBS_TIME
+# The text is decompressed and parsed chunk by
+# chunk (whole lines, as byte arrays) into compact
+# columns; days are then gathered into .dly style
+# (element, month) lines
+#################################################
+def is_station_csv(path):
+    return path.endswith(".csv") or path.endswith(".csv.gz")
+
+def read_station_csv_ragged(infile, elements=None, begin_date=None, end_date=None, chunk_size=1 << 22):
+    begin_key = int(str(begin_date)[0:6]) if begin_date is not None else 0
+    end_key = int(str(end_date)[0:6]) if end_date is not None else 999999
+
+    parts = []
+    pending = b""
+    for chunk in iter_data_file(infile, chunk_size):
+        chunk = pending + chunk
+        cut = chunk.rfind(b"\n") + 1
+        pending = chunk[cut:]
+        if cut:
+            parts.append(_parse_csv_lines(chunk[:cut]))
+    if pending.strip():
+        parts.append(_parse_csv_lines(pending + b"\n"))
+    if not parts:
+        parts.append(_parse_csv_lines(b""))
+    date, element, raw_value, flags = (np.concatenate([part[counter] for part in parts]) for counter in range(4))
+    month_key = date // 100
+    keep = (month_key >= begin_key) & (month_key <= end_key)
+    date, element, raw_value, flags, month_key = date[keep], element[keep], raw_value[keep], flags[keep], month_key[keep]
+
+    # One line per (element, month), days as columns
+    element_names, element_code = np.unique(element.view(np.uint32), return_inverse=True)
+    element_names = element_names.view("S4")
+    line_key, line_index = np.unique(element_code.astype(np.int64) * 1000000 + month_key, return_inverse=True)
+    line_value = np.full((len(line_key), 31), -9999, dtype=np.int32)
+    line_flags = np.zeros((len(line_key), 31, 3), dtype=np.uint8)
+    line_value[line_index, date % 100 - 1] = raw_value
+    line_flags[line_index, date % 100 - 1] = flags
+    line_element = np.char.decode(element_names, "ascii")[line_key // 1000000] if len(line_key) else \
+        np.zeros(0, dtype="U4")
+    line_month = line_key % 1000000
+    return _ragged_from_lines(os.path.basename(infile)[0:11], elements, line_month // 100, line_month % 100,
+                              line_element, line_value, line_flags)
+
+#################################################
+# MODULE: station_csv_year_range
+# First / last year of a by_station csv file from
+# the DATE bytes at the start of each line only,
+# without parsing the rows
+#################################################
+def station_csv_year_range(infile, chunk_size=1 << 22):
+    begin_year = end_year = None
+    pending = b""
+    for chunk in iter_data_file(infile, chunk_size):
+        chunk = pending + chunk
+        cut = chunk.rfind(b"\n") + 1
+        pending = chunk[cut:]
+        raw = np.frombuffer(chunk, dtype=np.uint8, count=cut)
+        ends = np.flatnonzero(raw == 10)
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        # Blank lines have no DATE
+        starts = starts[ends - starts >= 20]
+        if len(starts):
+            year = _parse_fixed_int(raw[starts[:, np.newaxis] + np.arange(12, 16)])
+            begin_year = int(year.min()) if begin_year is None else min(begin_year, int(year.min()))
+            end_year = int(year.max()) if end_year is None else max(end_year, int(year.max()))
+    if len(pending.strip()) >= 20:
+        year = int(pending.strip()[12:16])
+        begin_year = year if begin_year is None else min(begin_year, year)
+        end_year = year if end_year is None else max(end_year, year)
+    if begin_year is None:
+        begin_year = end_year = datetime.datetime.now().year
+    return begin_year, end_year
+
+def _parse_csv_lines(text):
+    # Columns of whole CSV lines: date (YYYYMMDD), element (S4), raw value, flags (lines, 3)
+    if text.startswith(b"\n") or b"\n\n" in text:
+        text = re.sub(b"\n+", b"\n", text).lstrip(b"\n")
+    raw = np.frombuffer(text, dtype=np.uint8)
+
+    # Every line has 7 commas and a newline: one (lines, 8) table of field ends
+    fields = np.flatnonzero((raw == 44) | (raw == 10))
+    if len(fields) % 8:
+        raise ValueError("Malformed by_station csv line")
+    fields = fields.reshape(-1, 8)
+    starts = np.concatenate(([0], fields[:-1, 7] + 1)).astype(np.int64)[:len(fields)]
+    if (np.any(raw[fields[:, 7]] != 10) or np.any(fields[:, 0:3] != starts[:, np.newaxis] + [11, 20, 25])
+            or np.any(fields[:, 3] - fields[:, 2] > 7)):
+        raise ValueError("Malformed by_station csv line")
+
+    date = _parse_fixed_int(raw[starts[:, np.newaxis] + np.arange(12, 20)]).astype(np.int32)
+    element = raw[starts[:, np.newaxis] + np.arange(21, 25)].copy().view("S4").ravel()
+    # DATA_VALUE right aligned in a 6 byte window ending at its comma
+    window = fields[:, 3:4] - 6 + np.arange(6)
+    digits = raw[window].copy()
+    digits[window <= fields[:, 2:3]] = 32
+    raw_value = _parse_fixed_int(digits).astype(np.int32)
+    flags = np.where(fields[:, 4:7] - fields[:, 3:6] == 2, raw[fields[:, 3:6] + 1], 0).astype(np.uint8)
+    return date, element, raw_value, flags
+
+#################################################
+# MODULE: ragged_element
+# One element of a ragged record: its months,
+# values and flags (views, no copies)
+#################################################
+def ragged_element(ragged, element):
+    element_counter = ragged["elements"].index(element)
+    rows = slice(ragged["element_ptr"][element_counter], ragged["element_ptr"][element_counter + 1])
+    return {name: ragged[name][rows] for name in ("months", "value", "mflag", "qflag", "sflag")}
+
+#################################################
+# MODULE: select_ragged
+# Subset of a ragged record: some elements and /
+# or the months between begin_date and end_date
+# (YYYYMM[DD]); years are those of the rows kept,
+# as if only they had been read
+#################################################
+def select_ragged(ragged, elements=None, begin_date=None, end_date=None):
+    if elements is None:
+        elements = ragged["elements"]
+    elements = list(elements)
+    # YYYYMM keys, compared as in read_dly_window
+    begin_key = int(str(begin_date)[0:6]) if begin_date is not None else 0
+    end_key = int(str(end_date)[0:6]) if end_date is not None else 999999
+
+    parts = []
+    for element in elements:
+        if element not in ragged["elements"]:
+            parts.append(np.zeros(0, dtype=np.int64))
+            continue
+        element_counter = ragged["elements"].index(element)
+        rows = np.arange(ragged["element_ptr"][element_counter], ragged["element_ptr"][element_counter + 1])
+        keys = (ragged["months"][rows] // 12) * 100 + ragged["months"][rows] % 12 + 1
+        parts.append(rows[(keys >= begin_key) & (keys <= end_key)])
+    rows = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+    months = ragged["months"][rows]
+    if len(months):
+        begin_year, end_year = int(months.min() // 12), int(months.max() // 12)
+    else:
+        begin_year = end_year = datetime.datetime.now().year
+
+    selected = {
+        "station_id": ragged["station_id"],
+        "begin_year": begin_year,
+        "end_year": end_year,
+        "elements": elements,
+        "element_ptr": np.concatenate(([0], np.cumsum([len(part) for part in parts]))).astype(np.int64),
+        "months": months,
+    }
+    for name in ("value", "mflag", "qflag", "sflag"):
+        selected[name] = ragged[name][rows]
+    return selected
+
+#################################################
+# MODULE: ragged_to_dense
+# Dense cube view of a ragged record
+#    value: (years, 12, 31, elements) float32,
+#           -9999 where missing
+#    mflag/qflag/sflag: same shape, uint8 codes
+# Years default to the record's own coverage
+#################################################
+def ragged_to_dense(ragged, elements=None, begin_year=None, end_year=None):
+    if elements is None:
+        elements = ragged["elements"]
+    elements = list(elements)
+    if begin_year is None:
+        begin_year = ragged["begin_year"]
+    if end_year is None:
+        end_year = ragged["end_year"]
+    shape = (end_year - begin_year + 1, 12, 31, len(elements))
+
+    cube = {
+        "station_id": ragged["station_id"],
+        "begin_year": begin_year,
+        "end_year": end_year,
+        "elements": elements,
+        "value": np.full(shape, -9999.0, dtype='f'),
+        "mflag": np.zeros(shape, dtype=np.uint8),
+        "qflag": np.zeros(shape, dtype=np.uint8),
+        "sflag": np.zeros(shape, dtype=np.uint8),
+    }
+    for element_counter, element in enumerate(elements):
+        if element not in ragged["elements"]:
+            continue
+        rows = ragged_element(ragged, element)
+        year_index = rows["months"] // 12 - begin_year
+        inside = (year_index >= 0) & (year_index < shape[0])
+        year_index = year_index[inside]
+        month_index = rows["months"][inside] % 12
+        for name in ("value", "mflag", "qflag", "sflag"):
+            cube[name][year_index, month_index, :, element_counter] = rows[name][inside]
+    return cube
+
+#################################################
+# MODULE: read_dly
+# Parse a .dly file into a dense station cube
+# (see read_dly_ragged / ragged_to_dense)
+#################################################
+def read_dly(infile, elements=None, begin_date=None, end_date=None):
+    return ragged_to_dense(read_dly_ragged(infile, elements, begin_date, end_date))
+
+#################################################
+# MODULE: get_station_cube
+# Download a station and read it into a cube
+#################################################
+def get_station_cube(station_id, elements=None, begin_date=None, end_date=None, max_age=0):
+    infile = gp.get_data_station(station_id, max_age)
+    return read_dly(infile, elements, begin_date, end_date)
+
+#################################################
+# MODULE: get_dly_index
+# Byte offset index of a .dly file
+#    keys: YYYYMM of every line
+#    offsets: start of every line, plus file end
+# Built once and cached next to the file as
+# {infile}.idx.npz (rebuilt when the file changes);
+# offsets of compressed files are positions in
+# the decompressed text
+#################################################
+def build_dly_index(infile):
+    raw = np.frombuffer(read_data_file(infile), dtype=np.uint8)
+    starts = np.concatenate(([0], np.flatnonzero(raw == 10) + 1))
+    offsets = np.append(starts[starts < len(raw)], len(raw)).astype(np.int64)
+
+    # Skip blank / short lines, keep the byte span of every real line
+    lines = np.flatnonzero(offsets[1:] - offsets[:-1] >= 21)
+    line_starts = offsets[lines]
+    year = _parse_fixed_int(raw[line_starts[:, np.newaxis] + np.arange(11, 15)])
+    month = _parse_fixed_int(raw[line_starts[:, np.newaxis] + np.arange(15, 17)])
+    return {
+        "keys": (year * 100 + month).astype(np.int32),
+        "starts": line_starts,
+        "ends": offsets[lines + 1],
+    }
+
+def get_dly_index(infile):
+    index_file = infile + ".idx.npz"
+    status = os.stat(infile)
+    try:
+        with np.load(index_file) as stored:
+            if int(stored["size"]) == status.st_size and int(stored["mtime_ns"]) == status.st_mtime_ns:
+                return {"keys": stored["keys"], "starts": stored["starts"], "ends": stored["ends"]}
+    except (OSError, KeyError, ValueError):
+        pass
+
+    return _store_dly_index(infile, build_dly_index(infile))
+
+def _store_dly_index(infile, index):
+    status = os.stat(infile)
+    temp_file = infile + ".idx.%d.tmp.npz" % os.getpid()
+    np.savez(temp_file, size=status.st_size, mtime_ns=status.st_mtime_ns, **index)
+    os.replace(temp_file, infile + ".idx.npz")
+    return index
+
+#################################################
+# MODULE: read_dly_window
+# Raw .dly lines for months between begin_date
+# and end_date (YYYYMM[DD], either may be None):
+# seeks straight to them instead of reading the
+# whole file (compressed files are decompressed
+# only up to the last wanted line, then cut at
+# the same offsets)
+#################################################
+def read_dly_window(infile, begin_date=None, end_date=None):
+    begin_key = int(str(begin_date)[0:6]) if begin_date is not None else 0
+    end_key = int(str(end_date)[0:6]) if end_date is not None else 999999
+    index = get_dly_index(infile)
+    keys = index["keys"]
+
+    if np.all(keys[1:] >= keys[:-1]):
+        # Sorted by year / month: the window is one contiguous byte range
+        first = np.searchsorted(keys, begin_key, 'left')
+        last = np.searchsorted(keys, end_key, 'right')
+        spans = [(index["starts"][first], index["ends"][last - 1])] if first < last else []
+    else:
+        # Unsorted file: each wanted line
+        lines = np.flatnonzero((keys >= begin_key) & (keys <= end_key))
+        spans = list(zip(index["starts"][lines], index["ends"][lines]))
+
+    if compression_codec(infile) is not None:
+        # Keep decompressed chunks from the first wanted byte, stop after the last
+        first = min((start for start, end in spans), default=0)
+        stop = max((end for start, end in spans), default=0)
+        chunks, base, position = [], 0, 0
+        data = iter_data_file(infile)
+        for chunk in data if stop > 0 else ():
+            if position + len(chunk) <= first:
+                base = position + len(chunk)
+            else:
+                chunks.append(chunk)
+            position += len(chunk)
+            if position >= stop:
+                break
+        data.close()
+        raw = b"".join(chunks)
+        return b"".join(raw[start - base:end - base] for start, end in spans)
+    chunks = []
+    with open(infile, 'rb') as file_handle:
+        for start, end in spans:
+            file_handle.seek(start)
+            chunks.append(file_handle.read(end - start))
+    return b"".join(chunks)
+
+#################################################
+# MODULE: select_years
+# Re-grid a cube onto a fixed year range
+# (years outside the cube are filled as missing)
+#################################################
+def select_years(cube, begin_year, end_year):
+    num_years = end_year - begin_year + 1
+    selected = dict(cube)
+    selected["begin_year"] = begin_year
+    selected["end_year"] = end_year
+
+    first = max(begin_year, cube["begin_year"])
+    last = min(end_year, cube["end_year"])
+    for name, fill in (("value", -9999.0), ("mflag", 0), ("qflag", 0), ("sflag", 0)):
+        grid = np.full((num_years,) + cube[name].shape[1:], fill, dtype=cube[name].dtype)
+        if first <= last:
+            grid[first - begin_year:last - begin_year + 1] = cube[name][first - cube["begin_year"]:last - cube["begin_year"] + 1]
+        selected[name] = grid
+    return selected
+
+#################################################
+# MODULE: valid_dates
+# (years, 12, 31) boolean mask of real calendar
+# days, plus days per month / per year
+#################################################
+def valid_dates(begin_year, end_year):
+    years = np.arange(begin_year, end_year + 1)
+    leap = ((years % 4 == 0) & (years % 100 != 0)) | (years % 400 == 0)
+    days_in_month = np.tile(np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31], dtype='i'), (len(years), 1))
+    days_in_month[:, 1] += leap
+    valid = np.arange(31)[np.newaxis, np.newaxis, :] < days_in_month[:, :, np.newaxis]
+    return valid, days_in_month
+
+#################################################
+# MODULE: stack_cubes
+# Put many station cubes on one shared year range
+#    value: (stations, years, 12, 31, elements)
+#################################################
+def stack_cubes(cubes, elements=None, begin_year=None, end_year=None):
+    if elements is None:
+        elements = cubes[0]["elements"]
+    elements = list(elements)
+    if begin_year is None:
+        begin_year = min(cube["begin_year"] for cube in cubes)
+    if end_year is None:
+        end_year = max(cube["end_year"] for cube in cubes)
+    num_years = end_year - begin_year + 1
+
+    stacked = {
+        "station_ids": [cube["station_id"] for cube in cubes],
+        "begin_year": begin_year,
+        "end_year": end_year,
+        "elements": elements,
+    }
+    for name, fill in (("value", -9999.0), ("mflag", 0), ("qflag", 0), ("sflag", 0)):
+        stacked[name] = np.full((len(cubes), num_years, 12, 31, len(elements)), fill,
+                                dtype='f' if name == "value" else np.uint8)
+
+    for station_counter, cube in enumerate(cubes):
+        cube = select_years(cube, begin_year, end_year)
+        for element_counter, element in enumerate(elements):
+            if element not in cube["elements"]:
+                continue
+            source = cube["elements"].index(element)
+            for name in ("value", "mflag", "qflag", "sflag"):
+                stacked[name][station_counter, ..., element_counter] = cube[name][..., source]
+    return stacked
+
 #################################################
 # MODULE: output_to_csv
 # Output to csv (one station per csv)
+# (Station handle or station ID)
 #################################################
-def output_to_csv(station_id):
+def output_to_csv(station, elements=CORE_ELEMENTS, reject_qflags=QFLAG_CODES, begin_date=None, end_date=None):
+    station = gp.as_station(station)
+    station_id = station.station_id
     print("\nOUTPUTTING TO CSV: ", station_id, ".csv")
 
-    # 5 Elements of GHCN-D
-    num_elements = 5
-    tmax = 0
-    tmin = 1
-    prcp = 2
-    snow = 3
-    snwd = 4
-
-    # Grab Data
-    gp.get_data_station(station_id)
-
-    # Read in GHCN-D Data
-    infile = station_id + ".dly"
-    with open(infile, 'r') as file_handle:
-        ghcnd_contents = file_handle.readlines()
-
-    # Get Year Start and End of File for time dimensions
-    ghcnd_begin_year = int(ghcnd_contents[0][11:15])
-    ghcnd_end_year = int(ghcnd_contents[len(ghcnd_contents) - 1][11:15])
-    num_years = int((ghcnd_end_year - ghcnd_begin_year) + 1)
-
-    # Go through GHCN-D Data
-    ghcnd_data = np.zeros((num_years,12,31,num_elements),dtype='f')-(9999.0)
-
-    for counter in range(len(ghcnd_contents)):
-        element = ghcnd_contents[counter][17:21]
-        if element in ["TMAX", "TMIN", "PRCP", "SNOW", "SNWD"]:
-            if element == "TMAX":
-                element_counter = tmax
-                divisor = 10.0
-            if element == "TMIN":
-                element_counter = tmin
-                divisor = 10.0
-            if element == "PRCP":
-                element_counter = prcp
-                divisor = 10.0
-            if element == "SNOW":
-                element_counter = snow
-                divisor = 1.0
-            if element == "SNWD":
-                element_counter = snwd
-                divisor = 1.0
-
-            year = int(ghcnd_contents[counter][11:15])
-            year_counter = int(year - ghcnd_begin_year)
-            month = int(ghcnd_contents[counter][15:17])
-            month_counter = int(month - 1)
-
-            char = 21
-            for day_counter in range(0, 31):
-                if ghcnd_contents[counter][char:char+5] != "-9999" and ghcnd_contents[counter][char+6:char+7].strip() == "":
-                    ghcnd_data[year_counter,month_counter,day_counter,element_counter] = float(ghcnd_contents[counter][char:char+5]) / divisor
-                char = char + 8
+    # Read in GHCN-D Data, drop rejected quality flags
+    ghcnd_data = station.select(elements, begin_date, end_date, reject_qflags)
+    ghcnd_begin_year = ghcnd_data["begin_year"]
+    value = ghcnd_data["value"]
+
+    # Keep only dates with at least one valid element
+    year_counter, month_counter, day_counter = np.nonzero((value != -9999.).any(axis=3))
+    rows = np.column_stack((year_counter + ghcnd_begin_year, month_counter + 1, day_counter + 1,
+                            value[year_counter, month_counter, day_counter, :]))
 
     # Output data to csv file
     outfile_data = station_id + '.csv'
-    with open(outfile_data,'w') as out_data:
-        out_data.write("YYYY,MM,DD,TMAX,TMIN,PRCP,SNOW,SNWD\n")
-        for year_counter in range(0, num_years):
-            for month_counter in range(0, 12):
-                for day_counter in range(0, 31):
-                    # Output
-                    if (ghcnd_data[year_counter,month_counter,day_counter,tmax] != -9999. or
-                        ghcnd_data[year_counter,month_counter,day_counter,tmin] != -9999. or
-                        ghcnd_data[year_counter,month_counter,day_counter,prcp] != -9999. or
-                        ghcnd_data[year_counter,month_counter,day_counter,snow] != -9999. or
-                        ghcnd_data[year_counter,month_counter,day_counter,snwd] != -9999.):
-                        out_data.write("%04i,%02i,%02i,%7.1f,%7.1f,%7.1f,%7.1f,%7.1f\n" %
-                            (year_counter+ghcnd_begin_year, month_counter+1, day_counter+1,
-                             ghcnd_data[year_counter,month_counter,day_counter,tmax],
-                             ghcnd_data[year_counter,month_counter,day_counter,tmin],
-                             ghcnd_data[year_counter,month_counter,day_counter,prcp],
-                             ghcnd_data[year_counter,month_counter,day_counter,snow],
-                             ghcnd_data[year_counter,month_counter,day_counter,snwd]))
+    temp_data = outfile_data + ".%d.tmp" % os.getpid()
+    with open(temp_data,'w') as out_data:
+        out_data.write("YYYY,MM,DD," + ",".join(elements) + "\n")
+        row_format = "%04i,%02i,%02i" + ",%7.1f" * len(elements) + "\n"
+        out_data.writelines(row_format % tuple(row) for row in rows.tolist())
+    os.replace(temp_data, outfile_data)
     return None
 
-# The rest of your output_to_netcdf function: just replace any `xrange` with `range` similarly.
-def to_datastructure(station_id):
+#################################################
+# MODULE: to_datastructure
+# Same as output_to_csv, returned as a list of
+# [YYYY, MM, DD, element values...] per date
+#################################################
+def to_datastructure(station, elements=CORE_ELEMENTS, reject_qflags=QFLAG_CODES, begin_date=None, end_date=None):
+    station = gp.as_station(station)
+    station_id = station.station_id
     print("\nOUTPUTTING TO DATA STRUCTURE: ", station_id)
 
-    # 5 Elements of GHCN-D
-    num_elements = 5
-    tmax = 0
-    tmin = 1
-    prcp = 2
-    snow = 3
-    snwd = 4
-
-    # Grab Data
-    gp.get_data_station(station_id)
-
-    # Read in GHCN-D Data
-    infile = station_id + ".dly"
-    with open(infile, 'r') as file_handle:
-        ghcnd_contents = file_handle.readlines()
-
-    # Get Year Start and End of File for time dimensions
-    ghcnd_begin_year = int(ghcnd_contents[0][11:15])
-    ghcnd_end_year = int(ghcnd_contents[len(ghcnd_contents) - 1][11:15])
-    num_years = int((ghcnd_end_year - ghcnd_begin_year) + 1)
-
-    # Go through GHCN-D Data
-    ghcnd_data = np.zeros((num_years,12,31,num_elements),dtype='f')-(9999.0)
-
-    for counter in range(len(ghcnd_contents)):
-        element = ghcnd_contents[counter][17:21]
-        if element in ["TMAX", "TMIN", "PRCP", "SNOW", "SNWD"]:
-            if element == "TMAX":
-                element_counter = tmax
-                divisor = 10.0
-            if element == "TMIN":
-                element_counter = tmin
-                divisor = 10.0
-            if element == "PRCP":
-                element_counter = prcp
-                divisor = 10.0
-            if element == "SNOW":
-                element_counter = snow
-                divisor = 1.0
-            if element == "SNWD":
-                element_counter = snwd
-                divisor = 1.0
-
-            year = int(ghcnd_contents[counter][11:15])
-            year_counter = int(year - ghcnd_begin_year)
-            month = int(ghcnd_contents[counter][15:17])
-            month_counter = int(month - 1)
-
-            char = 21
-            for day_counter in range(0, 31):
-                if ghcnd_contents[counter][char:char+5] != "-9999" and ghcnd_contents[counter][char+6:char+7].strip() == "":
-                    ghcnd_data[year_counter,month_counter,day_counter,element_counter] = float(ghcnd_contents[counter][char:char+5]) / divisor
-                char = char + 8
+    # Read in GHCN-D Data, drop rejected quality flags
+    ghcnd_data = station.select(elements, begin_date, end_date, reject_qflags)
+    ghcnd_begin_year = ghcnd_data["begin_year"]
+    value = ghcnd_data["value"]
 
     # Return data as list of arrays instead of writing to CSV
-    data_list = []
-    
-    for year_counter in range(0, num_years):
-        for month_counter in range(0, 12):
-            for day_counter in range(0, 31):
-                # Check if there's any valid data for this date
-                if (ghcnd_data[year_counter,month_counter,day_counter,tmax] != -9999. or
-                    ghcnd_data[year_counter,month_counter,day_counter,tmin] != -9999. or
-                    ghcnd_data[year_counter,month_counter,day_counter,prcp] != -9999. or
-                    ghcnd_data[year_counter,month_counter,day_counter,snow] != -9999. or
-                    ghcnd_data[year_counter,month_counter,day_counter,snwd] != -9999.):
-                    
-                    # Create array for this date: [YYYY, MM, DD, TMAX, TMIN, PRCP, SNOW, SNWD]
-                    date_array = [
-                        year_counter + ghcnd_begin_year,
-                        month_counter + 1,
-                        day_counter + 1,
-                        ghcnd_data[year_counter,month_counter,day_counter,tmax],
-                        ghcnd_data[year_counter,month_counter,day_counter,tmin],
-                        ghcnd_data[year_counter,month_counter,day_counter,prcp],
-                        ghcnd_data[year_counter,month_counter,day_counter,snow],
-                        ghcnd_data[year_counter,month_counter,day_counter,snwd]
-                    ]
-                    data_list.append(date_array)
-    
-    return data_list
-def get_stations_in_datastructure():
+    year_counter, month_counter, day_counter = np.nonzero((value != -9999.).any(axis=3))
+    dates = np.column_stack((year_counter + ghcnd_begin_year, month_counter + 1, day_counter + 1)).tolist()
+    values = value[year_counter, month_counter, day_counter, :].tolist()
+    return [date_array + value_array for date_array, value_array in zip(dates, values)]
+
+#################################################
+# MODULE: StationTable
+# Compact, column-oriented ghcnd-stations.txt
+#    ids / state / gsn / hcn / wmo: fixed-width
+#        bytes arrays
+#    latitude_e4 / longitude_e4 / elevation_e1:
+#        int32 in 1e-4 deg / 0.1 m (exact), with
+#        float views latitude / longitude /
+#        elevation
+#    names: one bytes buffer plus offsets
+# Rows are built on demand as StationRecord views
+# laid out like the old list-of-lists:
+#    [index, station_id, latitude, longitude,
+#     elevation, station_name, gsn_flag, wmo_id]
+#################################################
+STATION_LINE_LENGTH = 85
+
+class StationRecord:
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def tolist(self):
+        table, index = self.table, self.index
+        return [index, table.station_id(index), int(table.latitude_e4[index]) / 1e4, int(table.longitude_e4[index]) / 1e4,
+                int(table.elevation_e1[index]) / 1e1, table.name(index), table.gsn[index].decode(),
+                table.wmo[index].decode()]
+
+    def __getitem__(self, item):
+        return self.tolist()[item]
+
+    def __len__(self):
+        return 8
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        if isinstance(other, StationRecord):
+            return self.table is other.table and self.index == other.index
+        return self.tolist() == list(other)
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    station_id = property(lambda self: self.table.station_id(self.index))
+    latitude = property(lambda self: int(self.table.latitude_e4[self.index]) / 1e4)
+    longitude = property(lambda self: int(self.table.longitude_e4[self.index]) / 1e4)
+    elevation = property(lambda self: int(self.table.elevation_e1[self.index]) / 1e1)
+    state = property(lambda self: self.table.state[self.index].decode())
+    name = property(lambda self: self.table.name(self.index))
+
+class StationTable:
+    def __init__(self, raw):
+        chars = _fixed_width_chars(raw, STATION_LINE_LENGTH)
+
+        # Text columns: padding blanks become NULs, which bytes arrays drop
+        def column(start, end):
+            field = chars[:, start:end].copy()
+            field[field == 32] = 0
+            return field.view("S%d" % (end - start)).ravel()
+
+        # Coordinates are F8.4 / F9.4 / F6.1: kept as exact scaled integers
+        def fixed_point(start, end, decimals):
+            point = end - decimals - 1
+            if (chars[:, point] == 46).all():
+                return _parse_fixed_int(np.concatenate((chars[:, start:point], chars[:, point + 1:end]), axis=1))
+            return np.rint(chars[:, start:end].copy().view("S%d" % (end - start)).ravel().astype(np.float64)
+                           * 10 ** decimals).astype(np.int32)
+
+        self.ids = column(0, 11)
+        self.latitude_e4 = fixed_point(12, 20, 4).astype(np.int32)
+        self.longitude_e4 = fixed_point(21, 30, 4).astype(np.int32)
+        self.elevation_e1 = fixed_point(31, 37, 1).astype(np.int32)
+        self.state = column(38, 40)
+        self.gsn = column(72, 75)
+        self.hcn = column(76, 79)
+        self.wmo = column(80, 85)
+
+        # Names: strip each 30-char field, then pack them end to end
+        names = chars[:, 41:71]
+        filled = (names != 32) & (names != 0)
+        has_name = filled.any(axis=1)
+        start = np.where(has_name, filled.argmax(axis=1), 0)
+        end = np.where(has_name, 30 - filled[:, ::-1].argmax(axis=1), 0)
+        keep = (np.arange(30) >= start[:, np.newaxis]) & (np.arange(30) < end[:, np.newaxis])
+        self.name_buffer = names[keep].tobytes()
+        self.name_offsets = np.concatenate(([0], np.cumsum(end - start))).astype(np.int32)
+        self._index = None
+        self._names = None
+
+    # Float columns, built on request for vectorized work
+    latitude = property(lambda self: self.latitude_e4 / 1e4)
+    longitude = property(lambda self: self.longitude_e4 / 1e4)
+    elevation = property(lambda self: self.elevation_e1 / 1e1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [StationRecord(self, index) for index in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("station index out of range")
+        return StationRecord(self, item)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield StationRecord(self, index)
+
+    def station_id(self, index):
+        return self.ids[index].decode()
+
+    def name(self, index):
+        return self.name_buffer[self.name_offsets[index]:self.name_offsets[index + 1]].decode("latin-1")
+
+    def names(self):
+        # Every name as a str list (decoded once, on first use)
+        if self._names is None:
+            text = self.name_buffer.decode("latin-1")
+            offsets = self.name_offsets.tolist()
+            self._names = [text[begin:end] for begin, end in zip(offsets[:-1], offsets[1:])]
+        return self._names
+
+    def find(self, station_id):
+        # Row of a station ID (dict built on first use), None if absent
+        if self._index is None:
+            self._index = {station_id: index for index, station_id in enumerate(self.ids.tolist())}
+        return self._index.get(station_id.encode() if isinstance(station_id, str) else station_id)
+
+    def nbytes(self):
+        return (sum(getattr(self, name).nbytes for name in ("ids", "latitude_e4", "longitude_e4", "elevation_e1",
+                                                            "state", "gsn", "hcn", "wmo", "name_offsets"))
+                + len(self.name_buffer))
+
+def _fixed_width_chars(raw, line_length):
+    # (lines, line_length) uint8 view; fast path when every line is exactly line_length
+    if len(raw) % (line_length + 1) == 0:
+        chars = np.frombuffer(raw, dtype=np.uint8).reshape(-1, line_length + 1)
+        if (chars[:, line_length] == 10).all():
+            return chars[:, :line_length]
+    lines = [line for line in raw.splitlines() if line.strip()]
+    return np.array(lines, dtype="S%d" % line_length).view(np.uint8).reshape(len(lines), line_length)
+
+#################################################
+# MODULE: get_station_table
+# Fetch ghcnd-stations.txt as a StationTable
+# The parsed table is reused until the file
+# itself changes (size / mtime)
+#################################################
+_station_tables = {}
+
+def get_station_table(max_age=0):
+    ghcnd_stnfile = fetch_resource(GHCND_URL + "ghcnd-stations.txt", "ghcnd-stations.txt", max_age)
+    info = os.stat(ghcnd_stnfile)
+    version = (info.st_size, info.st_mtime_ns)
+    cached = _station_tables.get(ghcnd_stnfile)
+    if cached is None or cached[0] != version:
+        with open(ghcnd_stnfile, 'rb') as file_handle:
+            cached = (version, StationTable(file_handle.read()))
+        _station_tables[ghcnd_stnfile] = cached
+    return cached[1]
+
+#################################################
+# MODULE: get_stations_in_datastructure
+# Station list with list-style rows:
+#    stations[i][1] -> station ID, etc.
+#################################################
+def get_stations_in_datastructure(max_age=0):
     print("\nGRABBING LATEST STATION METADATA FILE")
-    url = "https://www1.ncdc.noaa.gov/pub/data/ghcn/daily/ghcnd-stations.txt"
-    r = requests.get(url)
-    with open("ghcnd-stations.txt", "wb") as f:
-        f.write(r.content)
-    
-    # Read the station data and return as data structure with index
-    stations_list = []
-    
-    with open("ghcnd-stations.txt", 'r') as file_handle:
-        station_lines = file_handle.readlines()
-    
-    for index, line in enumerate(station_lines):
-        # Parse fixed-width format based on GHCN-D station file specification
-        station_id = line[0:11].strip()
-        latitude = float(line[12:20].strip())
-        longitude = float(line[21:30].strip())
-        elevation = float(line[31:37].strip())
-        station_name = line[41:71].strip()
-        
-        # Optional fields (may be empty)
-        gsn_flag = line[72:75].strip() if len(line) > 72 else ""
-        wmo_id = line[80:85].strip() if len(line) > 80 else ""
-        
-        # Create array for this station with index as first element
-        station_array = [
-            index,                # Index in the file (0, 1, 2, ...)
-            station_id,          # Station ID
-            latitude,            # Latitude
-            longitude,           # Longitude  
-            elevation,           # Elevation in meters
-            station_name,        # Station name
-            gsn_flag,            # GSN flag (if applicable)
-            wmo_id               # WMO ID (if applicable)
-        ]
-        
-        stations_list.append(station_array)
-    
-    return stations_list
+    return get_station_table(max_age)
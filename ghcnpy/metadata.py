@@ -2,6 +2,7 @@
 import re
 import json
 import requests
+import numpy as np
 from geopy.distance import great_circle
 import ghcnpy as gp
 
@@ -49,6 +50,69 @@ def find_station(*args):
         return None
     return None
 
+
+#################################################
+# MODULE: search_stations
+# Find stations without printing, vectorized over
+# the whole StationTable
+#    name: regular expression on station names
+#          (case-insensitive)
+#    lat / lon / distance: great circle distance
+#          limit in miles
+#    limit: keep only the first / closest matches
+# Returns list of dicts, closest first when a
+# distance limit is given
+#################################################
+EARTH_RADIUS_MILES = 3958.7613
+
+def search_stations(name=None, lat=None, lon=None, distance=None, limit=None, table=None, max_age=0):
+    if table is None:
+        table = gp.get_station_table(max_age)
+    rows = np.arange(len(table))
+
+    if name is not None:
+        rows = _name_matches(table, name)
+
+    miles = None
+    if lat is not None and lon is not None:
+        miles = haversine_miles(float(lat), float(lon), table.latitude[rows], table.longitude[rows])
+        if distance is not None:
+            close = miles <= distance
+            rows, miles = rows[close], miles[close]
+        order = np.argsort(miles, kind="stable")
+        rows, miles = rows[order], miles[order]
+
+    if limit is not None:
+        rows = rows[:limit]
+    results = []
+    for result_counter, row in enumerate(rows.tolist()):
+        station = table[row]
+        result = {
+            "station_id": station.station_id,
+            "latitude": station.latitude,
+            "longitude": station.longitude,
+            "elevation": station.elevation,
+            "state": station.state,
+            "name": station.name,
+        }
+        if miles is not None:
+            result["distance"] = round(float(miles[result_counter]), 3)
+        results.append(result)
+    return results
+
+def haversine_miles(lat, lon, lats, lons):
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2.0) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def _name_matches(table, name):
+    # Names are decoded once per table; the pattern is searched in each name on its own
+    names = table.names()
+    if not name:
+        return np.arange(len(table))
+    search = re.compile(name, re.IGNORECASE).search
+    return np.array([row for row, station_name in enumerate(names) if search(station_name)], dtype=np.int64)
+
 #################################################
 # MODULE: get_metadata
 # Get Metadata From Station
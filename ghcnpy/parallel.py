@@ -0,0 +1,192 @@
+# Import Modules
+import os
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import ghcnpy as gp
+
+#################################################
+# MODULE: station_layout
+# Deterministic station -> slot layout: stations
+# are sorted by ID, slot = position in that order
+#################################################
+def station_layout(station_ids):
+    station_ids = sorted(set(station_ids))
+    return station_ids, {station_id: slot for slot, station_id in enumerate(station_ids)}
+
+#################################################
+# MODULE: dly_year_range
+# First / last year of a .dly file, read from its
+# first and last line only (from the line index
+# for compressed files, the DATE column for
+# by_station csv files)
+# read_dly_parallel works these out on the pool
+# for every file that is not a plain .dly
+#################################################
+def dly_year_range(infile):
+    if gp.is_station_csv(infile):
+        return gp.station_csv_year_range(infile)
+    if gp.compression_codec(infile) is not None:
+        keys = gp.get_dly_index(infile)["keys"]
+        return int(keys.min() // 100), int(keys.max() // 100)
+    with open(infile, 'rb') as file_handle:
+        first_line = file_handle.readline()
+        file_handle.seek(0, os.SEEK_END)
+        size = file_handle.tell()
+        file_handle.seek(max(0, size - 2 * (gp.DLY_LINE_LENGTH + 2)))
+        last_line = file_handle.read().rstrip().splitlines()[-1]
+    return int(first_line[11:15]), int(last_line[11:15])
+
+#################################################
+# Shared memory blocks
+#    value: (stations, years, 12, 31, elements) f4
+#    flags: (3, stations, years, 12, 31, elements)
+#           uint8 (mflag, qflag, sflag)
+#################################################
+_worker = {}
+
+def _shared_arrays(value_name, flags_name, shape):
+    value_block = shared_memory.SharedMemory(name=value_name)
+    flags_block = shared_memory.SharedMemory(name=flags_name)
+    value = np.ndarray(shape, dtype='f', buffer=value_block.buf)
+    flags = np.ndarray((3,) + shape, dtype=np.uint8, buffer=flags_block.buf)
+    return value_block, flags_block, value, flags
+
+def _init_worker(value_name, flags_name, shape, elements, begin_year, end_year):
+    value_block, flags_block, value, flags = _shared_arrays(value_name, flags_name, shape)
+    _worker.update(blocks=(value_block, flags_block), value=value, flags=flags,
+                   elements=elements, begin_year=begin_year, end_year=end_year)
+
+def _parse_into_slot(task):
+    slot, infile = task
+    cube = gp.read_dly(infile, _worker["elements"])
+    cube = gp.select_years(cube, _worker["begin_year"], _worker["end_year"])
+    # Decoded values go straight into this station's slot, nothing large is returned
+    _worker["value"][slot] = cube["value"]
+    for flag_counter, flag_name in enumerate(("mflag", "qflag", "sflag")):
+        _worker["flags"][flag_counter, slot] = cube[flag_name]
+    return slot
+
+#################################################
+# MODULE: read_dly_parallel
+# Parse many .dly files on a process pool into
+# one stacked result (same keys as stack_cubes)
+#    infiles: .dly paths, named {station_id}.dly
+#    processes: pool size (default: all cores)
+#    copy: True (default) moves the arrays into
+#          private memory, peaking at about 1.6x
+#          the stack (values are copied and their
+#          block freed before the flags are);
+#          False keeps them in shared memory, held
+#          once, until release_shared(stack) (see
+#          read_dly_shared)
+#################################################
+def read_dly_parallel(infiles, elements=gp.CORE_ELEMENTS, begin_year=None, end_year=None,
+                      processes=None, copy=True):
+    print("\nPARSING", len(infiles), "STATION FILES IN PARALLEL")
+    elements = list(elements)
+    files = {os.path.basename(infile)[0:11]: infile for infile in infiles}
+    station_ids, slots = station_layout(files)
+
+    # Year range covering every file unless fixed by the caller
+    if begin_year is None or end_year is None:
+        year_ranges = np.array(_year_ranges([files[station_id] for station_id in station_ids], processes))
+        if begin_year is None:
+            begin_year = int(year_ranges[:, 0].min())
+        if end_year is None:
+            end_year = int(year_ranges[:, 1].max())
+    shape = (len(station_ids), end_year - begin_year + 1, 12, 31, len(elements))
+
+    value_size = max(1, int(np.prod(shape)) * 4)
+    value_block = shared_memory.SharedMemory(create=True, size=value_size)
+    flags_block = shared_memory.SharedMemory(create=True, size=max(1, value_size // 4 * 3))
+    stacked = {
+        "station_ids": station_ids,
+        "begin_year": begin_year,
+        "end_year": end_year,
+        "elements": elements,
+        "_shared": (value_block, flags_block),
+    }
+    try:
+        tasks = [(slots[station_id], files[station_id]) for station_id in station_ids]
+        _run_pool(value_block, flags_block, shape, tasks, elements, begin_year, end_year, processes)
+    except BaseException:
+        release_shared(stacked)
+        raise
+
+    value = np.ndarray(shape, dtype='f', buffer=value_block.buf)
+    flags = np.ndarray((3,) + shape, dtype=np.uint8, buffer=flags_block.buf)
+    if not copy:
+        stacked["value"] = value
+        for flag_counter, flag_name in enumerate(("mflag", "qflag", "sflag")):
+            stacked[flag_name] = flags[flag_counter]
+        return stacked
+
+    # One block at a time, so only one private copy coexists with the shared memory
+    stacked["value"] = value.copy()
+    del value
+    value_block.close()
+    value_block.unlink()
+    for flag_counter, flag_name in enumerate(("mflag", "qflag", "sflag")):
+        stacked[flag_name] = flags[flag_counter].copy()
+    del flags
+    flags_block.close()
+    flags_block.unlink()
+    del stacked["_shared"]
+    return stacked
+
+def _year_ranges(infiles, processes):
+    # Plain .dly files are read at both ends here, the rest in parallel
+    slow = [infile for infile in infiles if gp.is_station_csv(infile) or gp.compression_codec(infile) is not None]
+    ranges = {}
+    if slow:
+        processes = min(processes or os.cpu_count() or 1, len(slow))
+        with multiprocessing.Pool(processes) as pool:
+            ranges = dict(zip(slow, pool.map(dly_year_range, slow, chunksize=max(1, len(slow) // (processes * 4)))))
+    return [ranges[infile] if infile in ranges else dly_year_range(infile) for infile in infiles]
+
+def _run_pool(value_block, flags_block, shape, tasks, elements, begin_year, end_year, processes):
+    value = np.ndarray(shape, dtype='f', buffer=value_block.buf)
+    flags = np.ndarray((3,) + shape, dtype=np.uint8, buffer=flags_block.buf)
+    value[...] = -9999.0
+    flags[...] = 0
+    del value, flags
+
+    processes = processes or os.cpu_count() or 1
+    chunksize = max(1, len(tasks) // (processes * 4))
+    with multiprocessing.Pool(processes, initializer=_init_worker,
+                              initargs=(value_block.name, flags_block.name, shape,
+                                        elements, begin_year, end_year)) as pool:
+        for slot in pool.imap_unordered(_parse_into_slot, tasks, chunksize=chunksize):
+            pass
+    return None
+
+#################################################
+# MODULE: release_shared
+# Free the shared memory behind a stacked result
+# from read_dly_parallel(..., copy=False)
+#################################################
+def release_shared(stacked):
+    for name in ("value", "mflag", "qflag", "sflag"):
+        stacked.pop(name, None)
+    for block in stacked.pop("_shared", ()):
+        block.close()
+        block.unlink()
+    return None
+
+#################################################
+# MODULE: read_dly_shared
+# read_dly_parallel(..., copy=False) as a context
+# manager: the stack is held once, in shared
+# memory, and released on exit
+#################################################
+@contextlib.contextmanager
+def read_dly_shared(infiles, elements=gp.CORE_ELEMENTS, begin_year=None, end_year=None, processes=None):
+    stacked = read_dly_parallel(infiles, elements, begin_year, end_year, processes, copy=False)
+    try:
+        yield stacked
+    finally:
+        release_shared(stacked)
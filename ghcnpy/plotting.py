@@ -1,14 +1,19 @@
 # Import Modules
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import calendar
+import hashlib
+import io
+import os
 import re
 import gzip
+import pickle
+import threading
+from collections import OrderedDict
 
 import numpy as np
 import numpy.ma as ma
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-import matplotlib.colors as colors
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 import pylab
 from mpl_toolkits.basemap import Basemap
 
@@ -17,64 +22,71 @@ import ghcnpy as gp
 #################################################
 # MODULE: plot_temperature
 # Plot Temperature Data for a given station
+# (Station handle or station ID)
+#################################################
+def plot_temperature(station, begin_date, end_date):
+    station = gp.as_station(station)
+    print("\nPLOTTING TEMPERATURE DATA FOR STATION: ", station.station_id)
+    fig = _temperature_figure(station, begin_date, end_date)
+
+    # Save Figure
+    save_figure(fig, f"{station.station_id}_temperature.png", dpi=300)
+    return None
+
 #################################################
-def plot_temperature(station_id, begin_date, end_date):
-    print("\nPLOTTING TEMPERATURE DATA FOR STATION: ", station_id)
+# MODULE: save_figure
+# Write a figure by atomic rename, so readers
+# never see a half written image; the format
+# comes from the file extension (default png)
+#################################################
+def save_figure(fig, outfile, dpi=300):
+    fmt = os.path.splitext(outfile)[1][1:].lower() or "png"
+    temp_file = "%s.%d.%d.tmp" % (outfile, os.getpid(), threading.get_ident())
+    try:
+        fig.savefig(temp_file, format=fmt, dpi=dpi)
+        os.replace(temp_file, outfile)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return outfile
 
+#################################################
+# Temperature figure for a given station, drawn on its own Figure
+# (no pyplot state, safe to render in threads)
+#################################################
+def _temperature_figure(station, begin_date, end_date, figsize=(15, 8), dpi=300, max_age=0):
     # Declare Other Variables
-    begin_year = 1895
-    num_elements = 2  # TMAX/TMIN
     tmax = 0
     tmin = 1
-    end_year = datetime.now().year
-    num_years = (end_year - begin_year) + 1
 
-    # Get station metadatafile
-    ghcnd_stations = gp.get_ghcnd_stations()
-    ghcnd_meta = ghcnd_stations[ghcnd_stations[:, 0] == station_id]
-    ghcnd_id = ghcnd_meta[0][0]
-    ghcnd_lat = float(ghcnd_meta[0][1])
-    ghcnd_lon = float(ghcnd_meta[0][2])
-    ghcnd_alt = float(ghcnd_meta[0][3])
-    ghcnd_name = ghcnd_meta[0][5]
+    # Get station metadata
+    station = gp.as_station(station, max_age)
+    station_id = station.station_id
+    ghcnd_meta = station.metadata
+    ghcnd_id = ghcnd_meta.station_id
+    ghcnd_lat = ghcnd_meta.latitude
+    ghcnd_lon = ghcnd_meta.longitude
+    ghcnd_alt = ghcnd_meta.elevation
+    ghcnd_name = ghcnd_meta.name
     ghcnd_name = ghcnd_name.strip()
     ghcnd_name = re.sub(' +', ' ', ghcnd_name)
     ghcnd_name = ghcnd_name.replace(" ", "_")
 
-    # Grab Data
-    gp.get_data_station(station_id)
-
     #################################################
-    # Read in GHCN-D Data (Original, QC'd data removed)
-    infile = station_id + ".dly"
-    ghcnd_value = np.zeros((num_years, 12, 31, num_elements), dtype='f') - (9999.0)
-
-    with open(infile, 'r') as file_handle:
-        contents = file_handle.readlines()
+    # Grab / Read in GHCN-D Data (Original, QC'd data removed)
+    ghcnd_data = station.select(["TMAX", "TMIN"])
 
-    for counter in range(len(contents)):
-        element = contents[counter][17:21]
-
-        if element in ("TMAX", "TMIN"):
-            element_counter = tmax if element == "TMAX" else tmin
-
-            year = int(contents[counter][11:15])
-            year_counter = year - begin_year
-
-            month = int(contents[counter][15:17])
-            month_counter = month - 1
-
-            char = 21
-            for day_counter in range(0, 31):
-                if contents[counter][char:char + 5] != "-9999" and contents[counter][char + 6:char + 7] == " ":
-                    ghcnd_value[year_counter][month_counter][day_counter][element_counter] = float(contents[counter][char:char + 5]) / 10.0
-                char += 8
+    # Years covered by the station, widened to the dates requested
+    begin_year = min(ghcnd_data["begin_year"], int(begin_date[0:4]))
+    end_year = max(ghcnd_data["end_year"], int(end_date[0:4]))
+    ghcnd_value = gp.select_years(ghcnd_data, begin_year, end_year)["value"]
 
     # Mask Missing, convert from C to F
     ghcnd_nonmiss = ma.masked_values(ghcnd_value, -9999.)
     ghcnd_nonmiss = (ghcnd_nonmiss * 1.8) + 32
 
     # Get Record / Average Values for every day in year; averaging period 1981-2010
+    normals = slice(max(0, 1980 - begin_year), max(0, 2010 - begin_year))
     record_max_ghcnd = np.zeros((12, 31), dtype='f') - (9999.0)
     record_min_ghcnd = np.zeros((12, 31), dtype='f') - (9999.0)
     average_max_ghcnd = np.zeros((12, 31), dtype='f') - (9999.0)
@@ -84,9 +96,9 @@ def plot_temperature(station_id, begin_date, end_date):
             record_max_ghcnd[month_counter, day_counter] = ma.max(ghcnd_nonmiss[:, month_counter, day_counter, tmax])
             record_min_ghcnd[month_counter, day_counter] = ma.min(ghcnd_nonmiss[:, month_counter, day_counter, tmin])
             average_max_ghcnd[month_counter, day_counter] = ma.average(
-                ghcnd_nonmiss[(1980-begin_year):(2010-begin_year), month_counter, day_counter, tmax])
+                ghcnd_nonmiss[normals, month_counter, day_counter, tmax])
             average_min_ghcnd[month_counter, day_counter] = ma.average(
-                ghcnd_nonmiss[(1980-begin_year):(2010-begin_year), month_counter, day_counter, tmin])
+                ghcnd_nonmiss[normals, month_counter, day_counter, tmin])
 
     #################################################
     # Gather Data Based Upon Date Requested
@@ -107,151 +119,146 @@ def plot_temperature(station_id, begin_date, end_date):
     month_pos = np.zeros((num_months), dtype='i') - (9999.0)
     month_names = np.empty((num_months), dtype='S7')
 
-    day_index = 0
+    # Walk every calendar date from begin to end; a tick at the start of each month
+    begin_day = date(begin_yy, begin_mm, begin_dd)
     month_index = 0
-    for year_counter in range(begin_yy, end_yy + 1):
-        if year_counter == begin_yy:
-            start_month, end_month = begin_mm, 12
-        elif year_counter == end_yy:
-            start_month, end_month = 1, end_mm
-        else:
-            start_month, end_month = 1, 12
-        for month_counter in range(start_month, end_month + 1):
+    for day_index in range(num_days):
+        day_date = begin_day + timedelta(days=day_index)
+        year_counter, month_counter, day_counter = day_date.year, day_date.month, day_date.day
+        if day_index == 0 or day_counter == 1:
             month_pos[month_index] = day_index
             month_names[month_index] = calendar.month_name[month_counter][0:3] + " '" + str(year_counter)[2:4]
-            for day_counter in range(begin_dd, end_dd + 1):
-                try:
-                    # Check if date is valid
-                    datetime(year=year_counter, month=month_counter, day=day_counter)
-                    record_max[day_index] = record_max_ghcnd[month_counter - 1, day_counter - 1]
-                    record_min[day_index] = record_min_ghcnd[month_counter - 1, day_counter - 1]
-                    average_max[day_index] = average_max_ghcnd[month_counter - 1, day_counter - 1]
-                    average_min[day_index] = average_min_ghcnd[month_counter - 1, day_counter - 1]
-                    raw_max[day_index] = ghcnd_nonmiss[year_counter - begin_year, month_counter - 1, day_counter - 1, tmax]
-                    raw_min[day_index] = ghcnd_nonmiss[year_counter - begin_year, month_counter - 1, day_counter - 1, tmin]
-                    day_index += 1
-                except:
-                    pass
             month_index += 1
+        record_max[day_index] = record_max_ghcnd[month_counter - 1, day_counter - 1]
+        record_min[day_index] = record_min_ghcnd[month_counter - 1, day_counter - 1]
+        average_max[day_index] = average_max_ghcnd[month_counter - 1, day_counter - 1]
+        average_min[day_index] = average_min_ghcnd[month_counter - 1, day_counter - 1]
+        raw_max[day_index] = ghcnd_nonmiss[year_counter - begin_year, month_counter - 1, day_counter - 1, tmax]
+        raw_min[day_index] = ghcnd_nonmiss[year_counter - begin_year, month_counter - 1, day_counter - 1, tmin]
 
     x_axis = range(num_days)
 
     #################################################
     # PLOT
-    fig, ax1 = plt.subplots(figsize=(15, 8), edgecolor='white', facecolor='white', dpi=300)
+    fig = Figure(figsize=figsize, edgecolor='white', facecolor='white', dpi=dpi)
+    ax1 = fig.add_subplot()
 
     # Add grid lines
-    plt.grid(color='black', linestyle='--', linewidth=0.5, alpha=0.3)
+    ax1.grid(color='black', linestyle='--', linewidth=0.5, alpha=0.3)
 
     # Plot Record TMAX/TMIN
-    plt.bar(x_axis, record_max - record_min, bottom=record_min, edgecolor='none', color='#c3bba4', width=1, label="Record Max/Min")
+    ax1.bar(x_axis, record_max - record_min, bottom=record_min, edgecolor='none', color='#c3bba4', width=1, label="Record Max/Min")
 
     # Plot Average TMAX/TMIN
-    plt.bar(x_axis, average_max - average_min, bottom=average_min, edgecolor='none', color='#9a9180', width=1, label="Average Max/Min")
+    ax1.bar(x_axis, average_max - average_min, bottom=average_min, edgecolor='none', color='#9a9180', width=1, label="Average Max/Min")
 
     # Plot Raw TMAX/TMIN
-    plt.bar(x_axis, raw_max - raw_min, bottom=raw_min, edgecolor='black', linewidth=0.5, color='#5a3b49', width=1, label="Actual Max/Min")
+    ax1.bar(x_axis, raw_max - raw_min, bottom=raw_min, edgecolor='black', linewidth=0.5, color='#5a3b49', width=1, label="Actual Max/Min")
 
     # Find New Max/Min Records
     new_max_records = raw_max[raw_max >= record_max]
     new_min_records = raw_min[raw_min <= record_min]
 
     # Plot New Max/Min Records
-    plt.scatter(np.where(raw_max >= record_max)[0] + 0.5, new_max_records + 1.25, s=15, zorder=10, color='#d62728', alpha=0.75, linewidth=0, label="New Max Record")
-    plt.scatter(np.where(raw_min <= record_min)[0] + 0.5, new_min_records - 1.25, s=15, zorder=10, color='#1f77b4', alpha=0.75, linewidth=0, label="New Min Record")
+    ax1.scatter(np.where(raw_max >= record_max)[0] + 0.5, new_max_records + 1.25, s=15, zorder=10, color='#d62728', alpha=0.75, linewidth=0, label="New Max Record")
+    ax1.scatter(np.where(raw_min <= record_min)[0] + 0.5, new_min_records - 1.25, s=15, zorder=10, color='#1f77b4', alpha=0.75, linewidth=0, label="New Min Record")
 
     # Plot Legend
-    plt.legend(bbox_to_anchor=(0., -.102, 1., -1.02), loc=3, ncol=5, mode="expand", borderaxespad=0., fontsize=12)
+    ax1.legend(bbox_to_anchor=(0., -.102, 1., -1.02), loc=3, ncol=5, mode="expand", borderaxespad=0., fontsize=12)
 
     # Plot X/Y Limits
     ymin = int(5 * round(float((min(record_min) - 10)) / 5))
     ymax = int(5 * round(float((max(record_max) + 10)) / 5))
-    plt.ylim(ymin, ymax)
-    plt.xlim(-5, num_days)
+    ax1.set_ylim(ymin, ymax)
+    ax1.set_xlim(-5, num_days)
 
     # Plot Y-Axis Label
-    plt.yticks(range(ymin, ymax, 10), [r'{}$^\circ$'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
-    plt.ylabel(r'Temperature ($^\circ$F)', fontsize=12)
+    ax1.set_yticks(range(ymin, ymax, 10), [r'{}$^\circ$'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
+    ax1.set_ylabel(r'Temperature ($^\circ$F)', fontsize=12)
 
     # Plot X-Axis Label
-    plt.xticks(month_pos, month_names, fontsize=10)
+    ax1.set_xticks(month_pos, month_names, fontsize=10)
 
     # Plot 2nd Y Axis Labels
     ax3 = ax1.twinx()
-    plt.yticks(range(ymin, ymax, 10), [r'{}$^\circ$'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
-    plt.ylim(ymin, ymax)
+    ax3.set_yticks(range(ymin, ymax, 10), [r'{}$^\circ$'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
+    ax3.set_ylim(ymin, ymax)
 
     # Plot Title/Subtitle
-    plt.suptitle(f"{station_id}: {ghcnd_name}", fontsize=20)
-    plt.title(f"LAT= {ghcnd_lat} | LON= {ghcnd_lon} | ELEV= {int(ghcnd_alt * 3.2808399)}'", fontsize=15)
+    fig.suptitle(f"{station_id}: {ghcnd_name}", fontsize=20)
+    ax3.set_title(f"LAT= {ghcnd_lat} | LON= {ghcnd_lon} | ELEV= {int(ghcnd_alt * 3.2808399)}'", fontsize=15)
 
-    # Save Figure
-    plt.savefig(f"{station_id}_temperature.png", dpi=300)
-    plt.clf()
-    return None
+    return fig
+
+#################################################
+# Per-year accumulation lines as one LineCollection
+#    accum: (years, days), NaN breaks a line
+#    order: years sorted by end of year total;
+#           the first num_years are drawn, except
+#           the current year (num_years - 1),
+#           colored along GnBu from 0.5 to 1
+#################################################
+def _year_lines(accum, order, num_years):
+    years = order[:num_years]
+    years = years[years != num_years - 1]
+    color_pos = np.linspace(0.5, 1, num_years)[:len(years)]
+    x_axis = np.arange(accum.shape[1], dtype='f')
+    segments = np.stack((np.broadcast_to(x_axis, (len(years), len(x_axis))), accum[years]), axis=-1)
+    return LineCollection(segments, linewidths=0.5, colors=pylab.cm.GnBu(color_pos)[:, 0:3])
 
 #################################################
 # MODULE: plot_precipitation
 # Plot Accum. Precip Data for a given station
+# (Station handle or station ID)
 #################################################
-def plot_precipitation(station_id):
-    print("\nPLOTTING PRECIPITATION DATA FOR STATION: ", station_id)
+def plot_precipitation(station):
+    station = gp.as_station(station)
+    print("\nPLOTTING PRECIPITATION DATA FOR STATION: ", station.station_id)
+    fig = _precipitation_figure(station)
+
+    # Save Figure
+    save_figure(fig, station.station_id + '_precipitation.png', dpi=300)
+    return None
 
+#################################################
+# Accum. precip figure for a given station, drawn on its own Figure
+# (no pyplot state, safe to render in threads)
+#################################################
+def _precipitation_figure(station, figsize=(15, 8), dpi=300, max_age=0):
     # Declare Other Variables
-    begin_year = 1895
-    num_elements = 1 # PRCP
     prcp = 0
     num_days = 366
 
-    end_year = datetime.now().year
-    num_years = (end_year - begin_year) + 1
-
-    # Get station metadatafile
-    ghcnd_stations = gp.get_ghcnd_stations()
-
-    ghcnd_meta = ghcnd_stations[ghcnd_stations[:, 0] == station_id]
-    ghcnd_id = ghcnd_meta[0][0]
-    ghcnd_lat = float(ghcnd_meta[0][1])
-    ghcnd_lon = float(ghcnd_meta[0][2])
-    ghcnd_alt = float(ghcnd_meta[0][3])
-    ghcnd_name = ghcnd_meta[0][5]
+    # Get station metadata
+    station = gp.as_station(station, max_age)
+    station_id = station.station_id
+    ghcnd_meta = station.metadata
+    ghcnd_id = ghcnd_meta.station_id
+    ghcnd_lat = ghcnd_meta.latitude
+    ghcnd_lon = ghcnd_meta.longitude
+    ghcnd_alt = ghcnd_meta.elevation
+    ghcnd_name = ghcnd_meta.name
     ghcnd_name = ghcnd_name.strip()
     ghcnd_name = re.sub(' +', ' ', ghcnd_name)
     ghcnd_name = ghcnd_name.replace(" ", "_")
 
-    # Grab Data
-    gp.get_data_station(station_id)
-
     #################################################
-    # Read in GHCN-D Data (Original, QC'd data removed)
-    infile = f"{station_id}.dly"
-    ghcnd_value = np.zeros((num_years, 12, 31, num_elements), dtype='f')
-
-    with open(infile, 'r') as file_handle:
-        contents = file_handle.readlines()
-
-    valid_end = -9999
-    valid_begin = 9999
-    for counter in range(len(contents)):
-        element = contents[counter][17:21]
-
-        if element == "PRCP":
-            element_counter = prcp
-
-            year = int(contents[counter][11:15])
-            year_counter = year - begin_year
-            valid_begin = min(valid_begin, year)
-            valid_end = max(valid_end, year)
-
-            month = int(contents[counter][15:17])
-            month_counter = month - 1
+    # Grab / Read in GHCN-D Data (Original, QC'd data removed)
+    ghcnd_data = station.select(["PRCP"])
+    valid_begin = ghcnd_data["begin_year"]
+    valid_end = ghcnd_data["end_year"]
+
+    # Years covered by the station, through the current year
+    begin_year = valid_begin
+    end_year = max(valid_end, datetime.now().year)
+    num_years = (end_year - begin_year) + 1
+    ghcnd_value = gp.select_years(ghcnd_data, begin_year, end_year)["value"]
 
-            char = 21
-            for day_counter in range(0, 31):
-                if contents[counter][char:char+5] != "-9999" and contents[counter][char+6:char+7] == " ":
-                    ghcnd_value[year_counter][month_counter][day_counter][element_counter] = float(contents[counter][char:char+5]) / 10.0
-                    last_day = day_counter + 1
-                char = char + 8
+    # Find last day with valid data, missing days count as zero
+    valid = ghcnd_value != -9999.
+    year_counter, month_counter, last_day, element_counter = np.unravel_index(np.flatnonzero(valid)[-1], valid.shape)
+    year, month, last_day = year_counter + begin_year, month_counter + 1, last_day + 1
+    ghcnd_value = np.where(valid, ghcnd_value, np.float32(0.0))
 
     # Get day of year for last day with valid data
     last_day = datetime(year, month, last_day).timetuple().tm_yday
@@ -326,73 +333,64 @@ def plot_precipitation(station_id):
     avg_prcp = "%6.2f" % average_prcp[365]
 
     # Create Figure
-    fig, ax1 = plt.subplots(figsize=(15, 8), edgecolor='white', facecolor='white', dpi=300)
+    fig = Figure(figsize=figsize, edgecolor='white', facecolor='white', dpi=dpi)
+    ax1 = fig.add_subplot()
 
     # Add grid lines
-    plt.grid(color='black', linestyle='--', linewidth=0.5, alpha=0.3)
+    ax1.grid(color='black', linestyle='--', linewidth=0.5, alpha=0.3)
 
     # Plot Accumulated PRCP (Sort by end of year accumulation and plot by range of color)
+    # (every past year in one LineCollection, current year drawn on top below)
     order = np.argsort(prcp_accum[:, 364])
-    color_pos = np.linspace(0.5, 1, num_years)
-    order_counter = 0
-    color_counter = 0
-    for year_counter in range(0, num_years):
-        pos = order[order_counter]
-        if pos != (num_years - 1):
-            plt.plot(x_axis, prcp_accum[pos, :], linewidth=0.5, color=colors.rgb2hex(pylab.cm.GnBu(color_pos[color_counter])[0:3]))
-            color_counter += 1
-        order_counter += 1
+    ax1.add_collection(_year_lines(ma.filled(prcp_accum, np.nan), order, num_years))
 
     # Overlay Record Max Prcp Year
     if max_loc == current_loc:
-        plt.plot(x_axis_end, prcp_accum[max_loc, 0:last_day], color='#084081', linewidth=3, label='Max (' + str(max_year) + ': ' + str(max_prcp) + '")')
+        ax1.plot(x_axis_end, prcp_accum[max_loc, 0:last_day], color='#084081', linewidth=3, label='Max (' + str(max_year) + ': ' + str(max_prcp) + '")')
     else:
-        plt.plot(x_axis, prcp_accum[max_loc, :], color='#084081', linewidth=3, label='Max (' + str(max_year) + ': ' + str(max_prcp) + '")')
+        ax1.plot(x_axis, prcp_accum[max_loc, :], color='#084081', linewidth=3, label='Max (' + str(max_year) + ': ' + str(max_prcp) + '")')
 
     # Overlay Record Min Prcp Year
     if min_loc == current_loc:
-        plt.plot(x_axis_end, prcp_accum[min_loc, 0:last_day], color='#66ff99', linewidth=3, label='Min (' + str(min_year) + ': ' + str(min_prcp) + '")')
+        ax1.plot(x_axis_end, prcp_accum[min_loc, 0:last_day], color='#66ff99', linewidth=3, label='Min (' + str(min_year) + ': ' + str(min_prcp) + '")')
     else:
-        plt.plot(x_axis, prcp_accum[min_loc, :], color='#66ff99', linewidth=3, label='Min (' + str(min_year) + ': ' + str(min_prcp) + '")')
+        ax1.plot(x_axis, prcp_accum[min_loc, :], color='#66ff99', linewidth=3, label='Min (' + str(min_year) + ': ' + str(min_prcp) + '")')
 
     # Overlay Average PRCP
-    plt.plot(x_axis, average_prcp[:], color='#e6b800', linewidth=3, markeredgecolor='white', label='Avg (' + str(avg_prcp) + '")')
+    ax1.plot(x_axis, average_prcp[:], color='#e6b800', linewidth=3, markeredgecolor='white', label='Avg (' + str(avg_prcp) + '")')
 
     # Overlay Current Prcp Year
-    plt.plot(x_axis_end, current_data, color='black', linewidth=3, label='Current (' + str(current_year) + ': ' + str(current_prcp) + '")')
-    plt.plot(x_axis_end[last_day - 1], current_last, marker='o', color='black', markersize=10)
+    ax1.plot(x_axis_end, current_data, color='black', linewidth=3, label='Current (' + str(current_year) + ': ' + str(current_prcp) + '")')
+    ax1.plot(x_axis_end[last_day - 1], current_last, marker='o', color='black', markersize=10)
 
     # Plot Legend
-    plt.legend(bbox_to_anchor=(0., -.102, 1., -1.02), loc=3, ncol=4, mode="expand", borderaxespad=0., fontsize=12)
+    ax1.legend(bbox_to_anchor=(0., -.102, 1., -1.02), loc=3, ncol=4, mode="expand", borderaxespad=0., fontsize=12)
 
     # Plot X/Y Limits
     ymin = 0
     ymax = int(5 * round(float((np.max(prcp_accum) + 10)) / 5))
-    plt.ylim(ymin, ymax)
-    plt.xlim(-5, num_days)
+    ax1.set_ylim(ymin, ymax)
+    ax1.set_xlim(-5, num_days)
 
     # Plot Y-Axis Label
-    plt.yticks(range(ymin, ymax, 10), [r'{}"'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
-    plt.ylabel(r'Accumulated Precip (inches)', fontsize=12)
+    ax1.set_yticks(range(ymin, ymax, 10), [r'{}"'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
+    ax1.set_ylabel(r'Accumulated Precip (inches)', fontsize=12)
 
     # Plot X-Axis Label
     month_pos = [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335]
     month_names = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-    plt.xticks(month_pos, month_names, fontsize=10)
+    ax1.set_xticks(month_pos, month_names, fontsize=10)
 
     # Plot 2nd Y Axis Labels
     ax3 = ax1.twinx()
-    plt.yticks(range(ymin, ymax, 10), [r'{}"'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
-    plt.ylim(ymin, ymax)
+    ax3.set_yticks(range(ymin, ymax, 10), [r'{}"'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
+    ax3.set_ylim(ymin, ymax)
 
     # Plot Title/Subtitle
-    plt.suptitle(station_id + ': ' + ghcnd_name, fontsize=20)
-    plt.title('LAT= ' + str(ghcnd_lat) + ' | LON= ' + str(ghcnd_lon) + ' | ELEV= ' + str(int(ghcnd_alt * 3.2808399)) + '\'', fontsize=15)
+    fig.suptitle(station_id + ': ' + ghcnd_name, fontsize=20)
+    ax3.set_title('LAT= ' + str(ghcnd_lat) + ' | LON= ' + str(ghcnd_lon) + ' | ELEV= ' + str(int(ghcnd_alt * 3.2808399)) + '\'', fontsize=15)
 
-    # Save Figure
-    plt.savefig(station_id + '_precipitation.png', dpi=300)
-    plt.clf()
-    return None
+    return fig
 # Import Modules
 from datetime import datetime, date
 import calendar
@@ -401,9 +399,6 @@ import gzip
 
 import numpy as np
 import numpy.ma as ma
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-import matplotlib.colors as colors
 import pylab
 from mpl_toolkits.basemap import Basemap
 
@@ -412,66 +407,56 @@ import ghcnpy as gp
 #################################################
 # MODULE: plot_snowfall
 # Plot Accum. Snow Data for a given station
+# (Station handle or station ID)
 #################################################
-def plot_snowfall(station_id):
-    print("\nPLOTTING SNOWFALL DATA FOR STATION: ", station_id)
+def plot_snowfall(station):
+    station = gp.as_station(station)
+    print("\nPLOTTING SNOWFALL DATA FOR STATION: ", station.station_id)
+    fig = _snowfall_figure(station)
 
+    # Save Figure
+    save_figure(fig, station.station_id + '_snowfall.png', dpi=300)
+    return None
+
+#################################################
+# Accum. snow figure for a given station, drawn on its own Figure
+# (no pyplot state, safe to render in threads)
+#################################################
+def _snowfall_figure(station, figsize=(15, 8), dpi=300, max_age=0):
     # Declare Other Variables
-    begin_year = 1895
-    num_elements = 1  # SNOW
     snow = 0
     num_days = 366
 
-    end_year = datetime.now().year
-    num_years = (end_year - begin_year) + 1
-
-    # Get station metadatafile
-    ghcnd_stations = gp.get_ghcnd_stations()
-
-    ghcnd_meta = ghcnd_stations[ghcnd_stations[:, 0] == station_id]
-    ghcnd_id = ghcnd_meta[0][0]
-    ghcnd_lat = float(ghcnd_meta[0][1])
-    ghcnd_lon = float(ghcnd_meta[0][2])
-    ghcnd_alt = float(ghcnd_meta[0][3])
-    ghcnd_name = ghcnd_meta[0][5]
+    # Get station metadata
+    station = gp.as_station(station, max_age)
+    station_id = station.station_id
+    ghcnd_meta = station.metadata
+    ghcnd_id = ghcnd_meta.station_id
+    ghcnd_lat = ghcnd_meta.latitude
+    ghcnd_lon = ghcnd_meta.longitude
+    ghcnd_alt = ghcnd_meta.elevation
+    ghcnd_name = ghcnd_meta.name
     ghcnd_name = ghcnd_name.strip()
     ghcnd_name = re.sub(' +', ' ', ghcnd_name)
     ghcnd_name = ghcnd_name.replace(" ", "_")
 
-    # Grab Data
-    gp.get_data_station(station_id)
-
     #################################################
-    # Read in GHCN-D Data (Original, QC'd data removed)
-    infile = station_id + ".dly"
-    ghcnd_value = np.zeros((num_years, 12, 31, num_elements), dtype='f')
-
-    with open(infile, 'r') as file_handle:
-        contents = file_handle.readlines()
-
-    valid_end = -9999
-    valid_begin = 9999
-    for counter in range(len(contents)):
-
-        element = contents[counter][17:21]
-
-        if element == "SNOW":
-            element_counter = snow
-
-            year = int(contents[counter][11:15])
-            year_counter = year - begin_year
-            valid_begin = min(valid_begin, year)
-            valid_end = max(valid_end, year)
-
-            month = int(contents[counter][15:17])
-            month_counter = month - 1
+    # Grab / Read in GHCN-D Data (Original, QC'd data removed)
+    ghcnd_data = station.select(["SNOW"])
+    valid_begin = ghcnd_data["begin_year"]
+    valid_end = ghcnd_data["end_year"]
+
+    # Years covered by the station, through the current year
+    begin_year = valid_begin
+    end_year = max(valid_end, datetime.now().year)
+    num_years = (end_year - begin_year) + 1
+    ghcnd_value = gp.select_years(ghcnd_data, begin_year, end_year)["value"]
 
-            char = 21
-            for day_counter in range(0, 31):
-                if contents[counter][char:char + 5] != "-9999" and contents[counter][char + 6:char + 7] == " ":
-                    ghcnd_value[year_counter][month_counter][day_counter][element_counter] = float(contents[counter][char:char + 5])
-                    last_day = day_counter + 1
-                char = char + 8
+    # Find last day with valid data, missing days count as zero
+    valid = ghcnd_value != -9999.
+    year_counter, month_counter, last_day, element_counter = np.unravel_index(np.flatnonzero(valid)[-1], valid.shape)
+    year, month, last_day = year_counter + begin_year, month_counter + 1, last_day + 1
+    ghcnd_value = np.where(valid, ghcnd_value, np.float32(0.0))
 
     # Get day of year for last day with valid data
     last_day = datetime(year, month, last_day).timetuple().tm_yday
@@ -551,78 +536,307 @@ def plot_snowfall(station_id):
     avg_snow = "%6.2f" % average_snow[365]
 
     # Create Figure
-    fig, ax1 = plt.subplots(figsize=(15, 8), edgecolor='white', facecolor='white', dpi=300)
+    fig = Figure(figsize=figsize, edgecolor='white', facecolor='white', dpi=dpi)
+    ax1 = fig.add_subplot()
 
     # Add grid lines
-    plt.grid(color='black', linestyle='--', linewidth=0.5, alpha=0.3)
+    ax1.grid(color='black', linestyle='--', linewidth=0.5, alpha=0.3)
 
     # Plot Accumulated SNOW (Sort by end of year accumulation and plot by range of color)
+    # (every past season in one LineCollection, current season drawn on top below)
     order = np.argsort(snow_accum[:, 364])
-    color_pos = np.linspace(0.5, 1, num_years)
-    order_counter = 0
-    color_counter = 0
-    for year_counter in range(0, num_years):
-        pos = order[order_counter]
-        if pos != (num_years - 1):
-            plt.plot(x_axis, snow_accum[pos, :], linewidth=0.5,
-                     color=colors.rgb2hex(pylab.cm.GnBu(color_pos[color_counter])[0:3]))
-            color_counter = color_counter + 1
-        order_counter = order_counter + 1
+    ax1.add_collection(_year_lines(snow_accum, order, num_years))
 
     # Overlay Record Max Snow Year
     if max_loc == current_loc:
-        plt.plot(x_axis_end, snow_accum[max_loc, 0:last_day], color='#084081', linewidth=3,
+        ax1.plot(x_axis_end, snow_accum[max_loc, 0:last_day], color='#084081', linewidth=3,
                  label='Max (' + str(max_year - 1) + '-' + str(max_year) + ': ' + str(max_snow) + '")')
     else:
-        plt.plot(x_axis, snow_accum[max_loc, :], color='#084081', linewidth=3,
+        ax1.plot(x_axis, snow_accum[max_loc, :], color='#084081', linewidth=3,
                  label='Max (' + str(max_year - 1) + '-' + str(max_year) + ': ' + str(max_snow) + '")')
 
     # Overlay Record Min Snow Year
     if min_loc == current_loc:
-        plt.plot(x_axis_end, snow_accum[min_loc, 0:last_day], color='#66ff99', linewidth=3,
+        ax1.plot(x_axis_end, snow_accum[min_loc, 0:last_day], color='#66ff99', linewidth=3,
                  label='Min (' + str(min_year - 1) + '-' + str(min_year) + ': ' + str(min_snow) + '")')
     else:
-        plt.plot(x_axis, snow_accum[min_loc, :], color='#66ff99', linewidth=3,
+        ax1.plot(x_axis, snow_accum[min_loc, :], color='#66ff99', linewidth=3,
                  label='Min (' + str(min_year - 1) + '-' + str(min_year) + ': ' + str(min_snow) + '")')
 
     # Overlay Average SNOW
-    plt.plot(x_axis, average_snow[:], color='#e6b800', linewidth=3, markeredgecolor='white',
+    ax1.plot(x_axis, average_snow[:], color='#e6b800', linewidth=3, markeredgecolor='white',
              label='Avg (' + str(avg_snow) + '")')
 
     # Overlay Current Snow Year
-    plt.plot(x_axis_end, current_data, color='black', linewidth=3,
+    ax1.plot(x_axis_end, current_data, color='black', linewidth=3,
              label='Current (' + str(current_year - 1) + '-' + str(current_year) + ': ' + str(current_snow) + '")')
-    plt.plot(x_axis_end[last_day - 1], current_last, marker='o', color='black', markersize=10)
+    ax1.plot(x_axis_end[last_day - 1], current_last, marker='o', color='black', markersize=10)
 
     # Plot Legend
-    plt.legend(bbox_to_anchor=(0., -.102, 1., -1.02), loc=3, ncol=4, mode="expand", borderaxespad=0., fontsize=12)
+    ax1.legend(bbox_to_anchor=(0., -.102, 1., -1.02), loc=3, ncol=4, mode="expand", borderaxespad=0., fontsize=12)
 
     # Plot X/Y Limits
     ymin = 0
     ymax = int(5 * round(float((np.max(snow_accum) + 10)) / 5))
-    plt.ylim(ymin, ymax)
-    plt.xlim(-5, num_days)
+    ax1.set_ylim(ymin, ymax)
+    ax1.set_xlim(-5, num_days)
 
     # Plot Y-Axis Label
-    plt.yticks(range(ymin, ymax, 10), [r'{}"'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
-    plt.ylabel(r'Accumulated Snowfall (inches)', fontsize=12)
+    ax1.set_yticks(range(ymin, ymax, 10), [r'{}"'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
+    ax1.set_ylabel(r'Accumulated Snowfall (inches)', fontsize=12)
 
     # Plot X-Axis Label
     month_pos = [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335]
     month_names = ["Oct", "Nov", "Dec", "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep"]
-    plt.xticks(month_pos, month_names, fontsize=10)
+    ax1.set_xticks(month_pos, month_names, fontsize=10)
 
     # Plot 2nd Y Axis Labels
     ax3 = ax1.twinx()
-    plt.yticks(range(ymin, ymax, 10), [r'{}"'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
-    plt.ylim(ymin, ymax)
+    ax3.set_yticks(range(ymin, ymax, 10), [r'{}"'.format(x) for x in range(ymin, ymax, 10)], fontsize=10)
+    ax3.set_ylim(ymin, ymax)
 
     # Plot Title/Subtitle
-    plt.suptitle(station_id + ': ' + ghcnd_name, fontsize=20)
-    plt.title('LAT= ' + str(ghcnd_lat) + ' | LON= ' + str(ghcnd_lon) + ' | ELEV= ' + str(int(ghcnd_alt * 3.2808399)) + '\'',
+    fig.suptitle(station_id + ': ' + ghcnd_name, fontsize=20)
+    ax3.set_title('LAT= ' + str(ghcnd_lat) + ' | LON= ' + str(ghcnd_lon) + ' | ELEV= ' + str(int(ghcnd_alt * 3.2808399)) + '\'',
               fontsize=15)
 
+    return fig
+
+#################################################
+# Rendered Plot Cache
+# In-memory LRU of encoded images keyed by a hash
+# of (station, plot type, parameters, data
+# version), bounded by entry count and bytes
+#################################################
+class PlotCache:
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            image = self.entries.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= len(self.entries.pop(key))
+            if len(image) > self.max_bytes:
+                return image
+            self.entries[key] = image
+            self.nbytes += len(image)
+            # Evict least recently used images until both limits hold
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                old_key, old_image = self.entries.popitem(last=False)
+                self.nbytes -= len(old_image)
+        return image
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+PLOT_CACHE = PlotCache()
+
+PLOT_FIGURES = {
+    "temperature": _temperature_figure,
+    "precipitation": _precipitation_figure,
+    "snowfall": _snowfall_figure,
+}
+
+# Matplotlib is not thread safe, figures are drawn one at a time
+_render_lock = threading.Lock()
+
+#################################################
+# MODULE: plot_cache_key
+# Content address of a rendered plot; the data
+# version is the station file's size and mtime
+#################################################
+def plot_cache_key(station_id, plot_type, params, data_version):
+    key = repr((station_id, plot_type, sorted(params.items()), data_version))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def station_data_version(station, max_age=None):
+    info = os.stat(gp.as_station(station, max_age).infile)
+    return (info.st_size, info.st_mtime_ns)
+
+#################################################
+# MODULE: render_plot
+# Render a station plot to an in-memory image
+#    station: Station handle or station ID
+#    plot_type: temperature, precipitation or
+#               snowfall
+#    begin_date / end_date: YYYYMMDD, temperature
+#               only (default: this year so far)
+#    width / height: pixels, dpi: resolution
+#    fmt: png, svg, pdf, jpg ...
+#    max_age: reuse station files this recent
+#    cache: PlotCache (default PLOT_CACHE), or
+#           False to always render
+# Returns the encoded image as bytes
+#################################################
+def render_plot(station, plot_type, begin_date=None, end_date=None, width=1500, height=800, dpi=100,
+                fmt="png", max_age=86400, cache=None):
+    if plot_type not in PLOT_FIGURES:
+        raise ValueError("Unknown plot type: " + str(plot_type))
+    station = gp.as_station(station, max_age)
+    station_id = station.station_id
+    if cache is None:
+        cache = PLOT_CACHE
+    params = {"width": int(width), "height": int(height), "dpi": int(dpi), "fmt": fmt}
+    if plot_type == "temperature":
+        today = date.today()
+        params["begin_date"] = begin_date or today.strftime("%Y0101")
+        params["end_date"] = end_date or today.strftime("%Y%m%d")
+
+    key = plot_cache_key(station_id, plot_type, params, station_data_version(station))
+    if cache is not False:
+        image = cache.get(key)
+        if image is not None:
+            return image
+
+    print("\nRENDERING", plot_type.upper(), "PLOT FOR STATION: ", station_id)
+    figsize = (params["width"] / float(params["dpi"]), params["height"] / float(params["dpi"]))
+    dates = (params["begin_date"], params["end_date"]) if plot_type == "temperature" else ()
+    buffer = io.BytesIO()
+    with _render_lock:
+        fig = PLOT_FIGURES[plot_type](station, *dates, figsize=figsize, dpi=params["dpi"], max_age=max_age)
+        fig.savefig(buffer, format=fmt, dpi=params["dpi"])
+    image = buffer.getvalue()
+    if cache is not False:
+        cache.put(key, image)
+    return image
+
+#################################################
+# MODULE: get_basemap
+# Build a Basemap projection once and pickle it
+# (with its coastlines) to cache_dir, so later
+# maps only have to unpickle it
+#################################################
+_basemap_cache = {}
+
+def get_basemap(projection='cyl', bounds=(-90., 90., -180., 180.), resolution='c', cache_dir=None):
+    if cache_dir is None:
+        cache_dir = gp.get_data_dir()
+    llcrnrlat, urcrnrlat, llcrnrlon, urcrnrlon = [float(x) for x in bounds]
+    cache_name = "basemap_%s_%s_%g_%g_%g_%g.pickle" % (projection, resolution, llcrnrlat, urcrnrlat, llcrnrlon, urcrnrlon)
+    cache_file = os.path.join(cache_dir, cache_name)
+
+    # Reuse in-memory, then on-disk copy before building a new one
+    if cache_file in _basemap_cache:
+        return _basemap_cache[cache_file]
+    try:
+        with open(cache_file, 'rb') as file_handle:
+            basemap = pickle.load(file_handle)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        if projection in ('cyl', 'merc', 'mill'):
+            basemap = Basemap(projection=projection, resolution=resolution,
+                              llcrnrlat=llcrnrlat, urcrnrlat=urcrnrlat, llcrnrlon=llcrnrlon, urcrnrlon=urcrnrlon)
+        else:
+            basemap = Basemap(projection=projection, resolution=resolution,
+                              lat_0=(llcrnrlat + urcrnrlat) / 2.0, lon_0=(llcrnrlon + urcrnrlon) / 2.0)
+        temp_file = cache_file + ".%d.tmp" % os.getpid()
+        with open(temp_file, 'wb') as file_handle:
+            pickle.dump(basemap, file_handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, cache_file)
+    _basemap_cache[cache_file] = basemap
+    return basemap
+
+#################################################
+# MODULE: plot_station_map
+# Plot many stations on a map as one scatter
+#    stations: StationTable (default), or the
+#              legacy get_ghcnd_stations array
+#    values: one value per station used for
+#            color (default: elevation)
+#    preview: fast render, stations binned into
+#             a low-res image instead of markers
+#################################################
+def plot_station_map(stations=None, values=None, label='Elevation (m)', projection='cyl',
+                     bounds=(-90., 90., -180., 180.), preview=False, cmap='viridis',
+                     outfile='station_map.png', cache_dir=None):
+    print("\nPLOTTING STATION MAP")
+
+    if stations is None:
+        stations = gp.get_station_table()
+
+    # Pull coordinates out as whole columns, never per station
+    if isinstance(stations, gp.StationTable):
+        station_lat, station_lon, elevation = stations.latitude, stations.longitude, stations.elevation
+    else:
+        stations = np.asarray(stations)
+        station_lat, station_lon, elevation = stations[:, 1], stations[:, 2], stations[:, 3]
+    station_lat = np.asarray(station_lat, dtype='f')
+    station_lon = np.asarray(station_lon, dtype='f')
+    if values is None:
+        values = elevation
+    values = ma.masked_invalid(ma.masked_values(np.asarray(values, dtype='f'), -9999.))
+
+    # Keep only stations inside the requested box
+    llcrnrlat, urcrnrlat, llcrnrlon, urcrnrlon = bounds
+    inside = ((station_lat >= llcrnrlat) & (station_lat <= urcrnrlat) &
+              (station_lon >= llcrnrlon) & (station_lon <= urcrnrlon))
+    station_lat = station_lat[inside]
+    station_lon = station_lon[inside]
+    values = values[inside]
+
+    # Preview uses crude coastlines, small figure, low dpi
+    if preview:
+        resolution, figsize, dpi, marker_size = 'c', (10, 5), 72, 1
+    else:
+        resolution, figsize, dpi, marker_size = 'l', (15, 8), 300, 4
+    basemap = get_basemap(projection, bounds, resolution, cache_dir)
+
+    # Create Figure
+    fig = Figure(figsize=figsize, edgecolor='white', facecolor='white', dpi=dpi)
+    ax1 = fig.add_subplot()
+    basemap.ax = ax1
+    basemap.drawcoastlines(linewidth=0.5, color='#555555', ax=ax1, zorder=15)
+    basemap.drawcountries(linewidth=0.25, color='#999999', ax=ax1, zorder=15)
+
+    # Project every station at once
+    x, y = basemap(station_lon, station_lat)
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    if preview:
+        # Bin stations straight into an image (mean value per pixel)
+        nx, ny = int(figsize[0] * dpi), int(figsize[1] * dpi)
+        on_map = (np.isfinite(x) & np.isfinite(y) & ~ma.getmaskarray(values) &
+                  (x >= basemap.xmin) & (x < basemap.xmax) & (y >= basemap.ymin) & (y < basemap.ymax))
+        col = ((x[on_map] - basemap.xmin) / (basemap.xmax - basemap.xmin) * nx).astype('i')
+        row = ((y[on_map] - basemap.ymin) / (basemap.ymax - basemap.ymin) * ny).astype('i')
+        pixel = row * nx + col
+        pixel_count = np.bincount(pixel, minlength=nx * ny)
+        pixel_sum = np.bincount(pixel, weights=ma.getdata(values)[on_map], minlength=nx * ny)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            image = ma.masked_equal(pixel_count, 0)
+            image = (pixel_sum / image).reshape(ny, nx)
+        points = ax1.imshow(image, origin='lower', cmap=cmap, interpolation='nearest', zorder=10,
+                            extent=(basemap.xmin, basemap.xmax, basemap.ymin, basemap.ymax))
+    else:
+        # Plot every station in a single scatter call
+        points = ax1.scatter(x, y, c=values, s=marker_size, cmap=cmap, linewidths=0, zorder=10)
+    cbar = fig.colorbar(points, ax=ax1, orientation='horizontal', pad=0.05, fraction=0.05)
+    cbar.set_label(label, fontsize=12)
+
+    # Plot Title
+    ax1.set_title('GHCN-D Stations (' + str(int(np.sum(inside))) + ')', fontsize=15)
+
     # Save Figure
-    plt.savefig(station_id + '_snowfall.png', dpi=300)
-    plt.clf()
-    return None
+    save_figure(fig, outfile, dpi=dpi)
+    return outfile
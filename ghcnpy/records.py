@@ -0,0 +1,281 @@
+# Import Modules
+import os
+import numpy as np
+import pandas as pd
+
+import ghcnpy as gp
+
+#################################################
+# Daily Record Table
+#    station_ids: (stations,) GHCN-D IDs
+#    elements: elements tracked
+#    keys: (cells,) sorted int64 cell keys,
+#          (slot * 366 + doy) * elements + element,
+#          one per day of year and element a
+#          station has observed (sparse: most
+#          stations report only a few elements)
+#    high / low: (cells,) float32 record value,
+#                NaN where only the other kind
+#                has been set
+#    high_year / low_year: year record was set
+#    last_date: newest YYYYMMDD folded in
+# Day of year runs on a leap-year calendar, so
+# Feb 29 keeps its own slot (59)
+#################################################
+RECORD_ELEMENTS = ["TMAX", "TMIN", "PRCP", "SNOW", "SNWD"]
+
+# Which records get reported for each element
+RECORD_KINDS = {
+    "TMAX": ("high", "low"),
+    "TMIN": ("high", "low"),
+    "PRCP": ("high",),
+    "SNOW": ("high",),
+    "SNWD": ("high",),
+}
+
+# Zero amounts never count as setting or tying a record
+ZERO_IS_NOT_RECORD = ("PRCP", "SNOW", "SNWD")
+
+_DOY_OFFSET = np.array([0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335], dtype='i')
+
+BY_YEAR_COLUMNS = ["ID", "DATE", "ELEMENT", "DATA_VALUE", "M_FLAG", "Q_FLAG", "S_FLAG", "OBS_TIME"]
+
+#################################################
+# MODULE: new_record_table
+# Empty record table for a set of elements
+#################################################
+def new_record_table(elements=RECORD_ELEMENTS):
+    elements = list(elements)
+    table = {
+        "station_ids": np.empty(0, dtype='U11'),
+        "elements": elements,
+        "keys": np.empty(0, dtype=np.int64),
+        "high": np.empty(0, dtype='f'),
+        "low": np.empty(0, dtype='f'),
+        "high_year": np.empty(0, dtype=np.int16),
+        "low_year": np.empty(0, dtype=np.int16),
+        "last_date": 0,
+        "_slots": {},
+    }
+    return table
+
+def _station_slots(table, station_ids):
+    # Map IDs to slots, adding new stations at the end
+    slots = table["_slots"]
+    new_ids = [station_id for station_id in station_ids if station_id not in slots]
+    if new_ids:
+        for station_id in new_ids:
+            slots[station_id] = len(slots)
+        table["station_ids"] = np.concatenate((table["station_ids"], np.array(new_ids, dtype='U11')))
+    return np.array([slots[station_id] for station_id in station_ids], dtype=np.int64)
+
+#################################################
+# Fold a batch of observations into the table
+#    station_ids, dates (YYYYMMDD), element index
+#    and values are parallel 1-D arrays
+# When report is set, returns every record tied
+# or broken compared to the table before the batch
+#################################################
+def _apply_observations(table, station_ids, dates, element_index, values, report):
+    events = []
+    if len(values) == 0:
+        return events
+
+    unique_ids, station_code = np.unique(np.asarray(station_ids), return_inverse=True)
+    slot = _station_slots(table, unique_ids.tolist())[station_code]
+    month = (dates // 100) % 100
+    day = dates % 100
+    doy = _DOY_OFFSET[month - 1] + day - 1
+    num_elements = len(table["elements"])
+    key = (slot * 366 + doy) * num_elements + element_index
+
+    for kind in ("high", "low"):
+        # Best value per key in this batch (earliest date wins a tie)
+        if kind == "high":
+            order = np.lexsort((-dates, values, key))
+            last = np.r_[key[order][1:] != key[order][:-1], True]
+            pick = order[last]
+        else:
+            order = np.lexsort((dates, values, key))
+            first = np.r_[True, key[order][1:] != key[order][:-1]]
+            pick = order[first]
+
+        pick_key = key[pick]
+        pick_value = values[pick]
+        pick_date = dates[pick]
+        position = np.searchsorted(table["keys"], pick_key)
+        in_range = position < len(table["keys"])
+        found = np.zeros(len(pick), dtype=bool)
+        found[in_range] = table["keys"][position[in_range]] == pick_key[in_range]
+        previous = np.full(len(pick), np.nan, dtype='f')
+        previous[found] = table[kind][position[found]]
+        previous_year = np.zeros(len(pick), dtype=np.int16)
+        previous_year[found] = table[kind + "_year"][position[found]]
+
+        counts = np.ones(len(pick), dtype=bool)
+        for element_counter, element in enumerate(table["elements"]):
+            if kind == "high" and element in ZERO_IS_NOT_RECORD:
+                counts &= ~((element_index[pick] == element_counter) & (pick_value <= 0))
+        if kind == "high":
+            broken = pick_value > previous
+        else:
+            broken = pick_value < previous
+        tied = counts & (pick_value == previous)
+        broken &= counts
+        first_seen = np.isnan(previous)
+
+        if report:
+            reported = np.array([kind in RECORD_KINDS.get(element, ()) for element in table["elements"]])
+            event_rows = np.flatnonzero((broken | tied) & reported[element_index[pick]])
+            for row in event_rows:
+                source = pick[row]
+                events.append({
+                    "station_id": str(station_ids[source]),
+                    "date": int(pick_date[row]),
+                    "element": table["elements"][element_index[source]],
+                    "kind": kind,
+                    "status": "broken" if broken[row] else "tied",
+                    "value": float(pick_value[row]),
+                    "previous": float(previous[row]),
+                    "previous_year": int(previous_year[row]),
+                })
+
+        update = (broken | first_seen) & found
+        table[kind][position[update]] = pick_value[update]
+        table[kind + "_year"][position[update]] = pick_date[update] // 10000
+
+        # Cells seen for the first time are merged in, in key order
+        new = ~found
+        if new.any():
+            other = "low" if kind == "high" else "high"
+            at = position[new]
+            table["keys"] = np.insert(table["keys"], at, pick_key[new])
+            table[kind] = np.insert(table[kind], at, pick_value[new])
+            table[kind + "_year"] = np.insert(table[kind + "_year"], at, pick_date[new] // 10000)
+            table[other] = np.insert(table[other], at, np.nan)
+            table[other + "_year"] = np.insert(table[other + "_year"], at, 0)
+
+    table["last_date"] = max(table["last_date"], int(dates.max()))
+    return events
+
+#################################################
+# Observation readers
+#    by_year csv.gz read in bounded chunks, or a
+#    station cube (see read_dly)
+#################################################
+def _year_file_observations(year_file, elements, reject_qflags, since, chunksize):
+    reject = set(reject_qflags)
+    reader = pd.read_csv(year_file, header=None, names=BY_YEAR_COLUMNS, usecols=[0, 1, 2, 3, 5],
+                         dtype={"ID": str, "DATE": np.int64, "ELEMENT": str, "DATA_VALUE": np.int64, "Q_FLAG": str},
+                         compression='infer', chunksize=chunksize)
+    for chunk in reader:
+        keep = chunk["ELEMENT"].isin(elements).to_numpy() & (chunk["DATE"].to_numpy() > since)
+        keep &= ~chunk["Q_FLAG"].isin(reject).to_numpy()
+        chunk = chunk[keep]
+        if len(chunk) == 0:
+            continue
+        element_index = pd.Categorical(chunk["ELEMENT"], categories=elements).codes.astype(np.int64)
+        scale = np.array([gp.element_scale(element) for element in elements], dtype='f')
+        values = chunk["DATA_VALUE"].to_numpy().astype('f') / scale[element_index]
+        yield chunk["ID"].to_numpy(), chunk["DATE"].to_numpy(), element_index, values
+
+def _cube_observations(cube, elements, reject_qflags, since):
+    if reject_qflags:
+        cube = gp.filter_qflags(cube, reject_qflags)
+    valid, days_in_month = gp.valid_dates(cube["begin_year"], cube["end_year"])
+    for element_counter, element in enumerate(elements):
+        if element not in cube["elements"]:
+            continue
+        value = cube["value"][..., cube["elements"].index(element)]
+        year, month, day = np.nonzero(valid & (value != -9999.))
+        dates = (year + cube["begin_year"]) * 10000 + (month + 1) * 100 + (day + 1)
+        keep = dates > since
+        station_ids = np.full(int(keep.sum()), cube["station_id"], dtype='U11')
+        yield (station_ids, dates[keep].astype(np.int64), np.full(int(keep.sum()), element_counter, dtype=np.int64),
+               value[year[keep], month[keep], day[keep]].astype('f'))
+
+def _observations(source, elements, reject_qflags, since, chunksize):
+    if isinstance(source, dict):
+        return _cube_observations(source, elements, reject_qflags, since)
+    return _year_file_observations(source, elements, reject_qflags, since, chunksize)
+
+#################################################
+# MODULE: build_record_table
+# One pass over by_year files (oldest first) or
+# station cubes to build the daily record table
+#################################################
+def build_record_table(sources, elements=RECORD_ELEMENTS, reject_qflags=gp.QFLAG_CODES, chunksize=1000000):
+    print("\nBUILDING DAILY RECORD TABLE")
+    table = new_record_table(elements)
+    for source in sources:
+        for observations in _observations(source, table["elements"], reject_qflags, 0, chunksize):
+            _apply_observations(table, *observations, report=False)
+    return table
+
+#################################################
+# MODULE: update_records
+# Fold new days into the table and report every
+# record tied or broken. Only dates after the
+# table's last_date are used unless since is set
+#################################################
+def update_records(table, source, since=None, reject_qflags=gp.QFLAG_CODES, chunksize=1000000):
+    if since is None:
+        since = table["last_date"]
+    events = []
+    for observations in _observations(source, table["elements"], reject_qflags, since, chunksize):
+        events.extend(_apply_observations(table, *observations, report=True))
+    events.sort(key=lambda event: (event["date"], event["station_id"], event["element"], event["kind"]))
+    return events
+
+#################################################
+# MODULE: station_records
+# Record values for one station, per day of year
+#################################################
+def station_records(table, station_id, element):
+    slot = table["_slots"][station_id]
+    num_elements = len(table["elements"])
+    element_counter = table["elements"].index(element)
+    begin, end = np.searchsorted(table["keys"], [slot * 366 * num_elements, (slot + 1) * 366 * num_elements])
+    keys = table["keys"][begin:end] - slot * 366 * num_elements
+    cells = begin + np.flatnonzero(keys % num_elements == element_counter)
+    doy = keys[cells - begin] // num_elements
+    records = {}
+    for kind in ("high", "low"):
+        records[kind] = np.full(366, np.nan, dtype='f')
+        records[kind][doy] = table[kind][cells]
+        records[kind + "_year"] = np.zeros(366, dtype=np.int16)
+        records[kind + "_year"][doy] = table[kind + "_year"][cells]
+    return records
+
+#################################################
+# MODULE: save_record_table / load_record_table
+# Store the table as a compressed .npz file
+#################################################
+def save_record_table(table, outfile):
+    temp_file = outfile + ".tmp.npz"
+    np.savez_compressed(temp_file,
+                        station_ids=table["station_ids"],
+                        elements=np.array(table["elements"]),
+                        keys=table["keys"],
+                        high=table["high"],
+                        low=table["low"],
+                        high_year=table["high_year"],
+                        low_year=table["low_year"],
+                        last_date=np.array(table["last_date"]))
+    os.replace(temp_file, outfile)
+    return outfile
+
+def load_record_table(infile):
+    with np.load(infile) as stored:
+        table = {
+            "station_ids": stored["station_ids"],
+            "elements": stored["elements"].tolist(),
+            "keys": stored["keys"],
+            "high": stored["high"],
+            "low": stored["low"],
+            "high_year": stored["high_year"],
+            "low_year": stored["low_year"],
+            "last_date": int(stored["last_date"]),
+        }
+    table["_slots"] = {station_id: slot for slot, station_id in enumerate(table["station_ids"].tolist())}
+    return table
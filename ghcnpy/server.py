@@ -0,0 +1,362 @@
+# Import Modules
+import json
+import os
+import re
+import sys
+import time
+import threading
+import argparse
+from collections import OrderedDict
+import urllib.request
+import urllib.error
+from urllib.parse import urlsplit, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+import ghcnpy as gp
+
+#################################################
+# Query Service
+# Station table, name index, parsed station files
+# and response cache are loaded once and shared
+# by every request
+#    GET /stations?name=&lat=&lon=&distance=&limit=
+#    GET /stations/{id}
+#    GET /data/{id}?elements=&begin=&end=
+#    GET /climatology/{id}?element=&begin_year=&end_year=
+#    GET /plot/{id}/{type}.{fmt}?width=&height=&dpi=&begin=&end=
+# Files older than max_age (seconds) are fetched
+# again; responses and parsed station files are
+# cached against the version (size / mtime) of
+# the files behind them. Images live only in the
+# plot cache (see render_plot)
+# NotFound -> 404, BadRequest -> 400, anything
+# else unexpected -> 500
+#################################################
+class NotFound(Exception):
+    pass
+
+class BadRequest(Exception):
+    pass
+
+class StationService:
+    def __init__(self, max_age=86400, cache_entries=4096, cache_mb=256, record_entries=256):
+        self.max_age = max_age
+        self.responses = gp.PlotCache(max_entries=cache_entries, max_bytes=cache_mb * 1024 * 1024)
+        self.plots = gp.PlotCache(max_entries=cache_entries, max_bytes=cache_mb * 1024 * 1024)
+        self.record_entries = record_entries
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+        # Warm the station table and its name index
+        gp.search_stations(name="", limit=0, table=self.station_table())
+
+    def station_table(self):
+        return gp.get_station_table(self.max_age)
+
+    def file_version(self, infile):
+        info = os.stat(infile)
+        return (info.st_size, info.st_mtime_ns)
+
+    def station_record(self, station_id):
+        # Parsed (ragged) station file, reused until the file changes; least recently used dropped first
+        infile = gp.station_file(station_id, self.max_age)
+        version = self.file_version(infile)
+        with self.lock:
+            cached = self.records.get(infile)
+            if cached is not None and cached[0] == version:
+                self.records.move_to_end(infile)
+                return cached[1]
+        record = gp.read_dly_ragged(infile)
+        with self.lock:
+            self.records[infile] = (version, record)
+            self.records.move_to_end(infile)
+            while len(self.records) > self.record_entries:
+                self.records.popitem(last=False)
+        return record
+
+    def handle(self, path, query):
+        parts = [part for part in path.split("/") if part]
+        if not parts:
+            raise NotFound("Unknown path: " + path)
+
+        table = self.station_table()
+        if parts[0] != "stations" and len(parts) > 1:
+            _station_row(table, parts[1])
+
+        # Images are cached once, by render_plot
+        if parts[0] == "plot" and len(parts) == 3:
+            return self.plot(parts[1], parts[2], query)
+
+        # Every response depends on the station list; station endpoints also on the .dly file
+        version = [self.file_version(gp.data_path("ghcnd-stations.txt"))]
+        if parts[0] != "stations" and len(parts) > 1:
+            version.append(self.file_version(gp.station_file(parts[1], self.max_age)))
+        key = gp.plot_cache_key(path, "response", {name: tuple(values) for name, values in query.items()},
+                                tuple(version))
+        cached = self.responses.get(key)
+        if cached is not None:
+            return cached
+
+        if parts[0] == "stations" and len(parts) == 1:
+            response = self.search(table, query)
+        elif parts[0] == "stations" and len(parts) == 2:
+            response = self.station(table, parts[1])
+        elif parts[0] == "data" and len(parts) == 2:
+            response = self.data(parts[1], query)
+        elif parts[0] == "climatology" and len(parts) == 2:
+            response = self.climatology(parts[1], query)
+        else:
+            raise NotFound("Unknown path: " + path)
+        return self.responses.put(key, response)
+
+    def search(self, table, query):
+        try:
+            results = gp.search_stations(name=_arg(query, "name"), lat=_arg(query, "lat", float),
+                                         lon=_arg(query, "lon", float), distance=_arg(query, "distance", float),
+                                         limit=_arg(query, "limit", int, 100), table=table)
+        except (ValueError, re.error) as error:
+            raise BadRequest(str(error))
+        return _json({"count": len(results), "stations": results})
+
+    def station(self, table, station_id):
+        station = table[_station_row(table, station_id)]
+        return _json({
+            "station_id": station.station_id,
+            "latitude": station.latitude,
+            "longitude": station.longitude,
+            "elevation": station.elevation,
+            "state": station.state,
+            "name": station.name,
+        })
+
+    def data(self, station_id, query):
+        elements = _arg(query, "elements", str, ",".join(gp.CORE_ELEMENTS)).upper().split(",")
+        begin, end = _arg(query, "begin", _full_date), _arg(query, "end", lambda end: _full_date(end, "31"))
+        record = gp.select_ragged(self.station_record(station_id), elements, _arg(query, "begin"), _arg(query, "end"))
+        cube = gp.filter_qflags(gp.ragged_to_dense(record), _arg(query, "reject", str, gp.QFLAG_CODES))
+        value = cube["value"]
+
+        # Dates with at least one valid element, missing values as null
+        year, month, day = np.nonzero((value != -9999.).any(axis=3))
+        dates = ((year + cube["begin_year"]) * 10000 + (month + 1) * 100 + day + 1).tolist()
+        rows = np.round(value[year, month, day, :].astype(np.float64), 2).astype(object)
+        rows[rows == -9999.] = None
+        data = [[date_value] + row for date_value, row in zip(dates, rows.tolist())
+                if (begin is None or date_value >= begin) and (end is None or date_value <= end)]
+        return _json({"station_id": station_id, "elements": elements, "rows": data})
+
+    def climatology(self, station_id, query):
+        element = _arg(query, "element", str, "TMAX").upper()
+        cube = gp.ragged_to_dense(gp.select_ragged(self.station_record(station_id), [element]))
+        if not (cube["value"] != -9999.).any():
+            raise NotFound("No %s data for station %s" % (element, station_id))
+        climatology = gp.daily_climatology(cube, element, _arg(query, "begin_year", int),
+                                           _arg(query, "end_year", int))
+        response = {"station_id": station_id}
+        for name, stat in climatology.items():
+            if isinstance(stat, np.ndarray) and stat.dtype.kind == 'f':
+                stat = np.round(stat.astype(np.float64), 3).astype(object)
+                stat[stat == -9999.] = None
+                stat = stat.tolist()
+            elif isinstance(stat, np.ndarray):
+                stat = stat.tolist()
+            response[name] = stat
+        return _json(response)
+
+    def plot(self, station_id, name, query):
+        plot_type, _, fmt = name.partition(".")
+        if plot_type not in gp.PLOT_FIGURES:
+            raise NotFound("Unknown plot type: " + plot_type)
+        if fmt and fmt not in CONTENT_TYPES:
+            raise NotFound("Unknown image format: " + fmt)
+        _arg(query, "begin", _full_date), _arg(query, "end", _full_date)
+        return gp.render_plot(station_id, plot_type, _arg(query, "begin"), _arg(query, "end"),
+                              width=_arg(query, "width", int, 1500), height=_arg(query, "height", int, 800),
+                              dpi=_arg(query, "dpi", int, 100), fmt=fmt or "png", max_age=self.max_age,
+                              cache=self.plots)
+
+def _arg(query, name, convert=str, default=None):
+    if name not in query:
+        return default
+    try:
+        return convert(query[name][-1])
+    except ValueError:
+        raise BadRequest("Bad value for %s: %s" % (name, query[name][-1]))
+
+def _station_row(table, station_id):
+    row = table.find(station_id)
+    if row is None:
+        raise NotFound("Unknown station: " + station_id)
+    return row
+
+def _full_date(value, day="01"):
+    # YYYYMM[DD] -> YYYYMMDD integer
+    return int(value if len(value) == 8 else value[0:6] + day)
+
+def _json(response):
+    return json.dumps(response, separators=(",", ":")).encode("utf-8")
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml",
+    "pdf": "application/pdf",
+    "jpg": "image/jpeg",
+}
+
+#################################################
+# HTTP layer
+# Connections are handled on a fixed size thread
+# pool; at most workers + backlog requests are in
+# flight, the accept loop waits beyond that
+#################################################
+class StationRequestHandler(BaseHTTPRequestHandler):
+    server_version = "ghcnpy"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        try:
+            body = self.server.service.handle(url.path, parse_qs(url.query))
+            status = 200
+        except NotFound as error:
+            body, status = _json({"error": str(error)}), 404
+        except BadRequest as error:
+            body, status = _json({"error": str(error)}), 400
+        except requests.HTTPError as error:
+            status = error.response.status_code if error.response is not None else 502
+            body, status = _json({"error": str(error)}), 404 if status == 404 else 502
+        except requests.RequestException as error:
+            body, status = _json({"error": str(error)}), 502
+        except Exception as error:
+            body, status = _json({"error": repr(error)}), 500
+
+        extension = url.path.rsplit(".", 1)[-1] if url.path.startswith("/plot/") else ""
+        self.send_response(status)
+        self.send_header("Content-Type", CONTENT_TYPES.get(extension, "application/json")
+                         if status == 200 else "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class PooledHTTPServer(HTTPServer):
+    def __init__(self, address, handler, service, workers=8, backlog=64, verbose=False):
+        HTTPServer.__init__(self, address, handler)
+        self.service = service
+        self.verbose = verbose
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + backlog)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.executor.shutdown(wait=True)
+
+#################################################
+# MODULE: make_server / serve
+# Build (or build and run) the query service
+#    port 0 picks a free port (server.server_port)
+#################################################
+def make_server(host="127.0.0.1", port=8000, workers=8, backlog=64, max_age=86400, cache_mb=256, verbose=False):
+    service = StationService(max_age=max_age, cache_mb=cache_mb)
+    return PooledHTTPServer((host, port), StationRequestHandler, service, workers, backlog, verbose)
+
+def serve(host="127.0.0.1", port=8000, workers=8, backlog=64, max_age=86400, cache_mb=256, verbose=False):
+    server = make_server(host, port, workers, backlog, max_age, cache_mb, verbose)
+    print("\nSERVING GHCN-D ON http://%s:%i" % (host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return None
+
+#################################################
+# MODULE: benchmark
+# Replay request paths against a running server
+#    paths: cycled through num_requests times
+#    concurrency: client threads
+# Returns throughput (requests / s) and latency
+# percentiles in milliseconds
+#################################################
+def benchmark(base_url, paths, num_requests=1000, concurrency=8, timeout=60):
+    def fetch(path):
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(base_url.rstrip("/") + path, timeout=timeout) as response:
+                response.read()
+                ok = response.status == 200
+        except (urllib.error.URLError, OSError):
+            ok = False
+        return time.perf_counter() - started, ok
+
+    work = [paths[request_counter % len(paths)] for request_counter in range(num_requests)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fetch, work))
+    elapsed = time.perf_counter() - started
+
+    latency = np.array([result[0] for result in results]) * 1000.0
+    return {
+        "requests": num_requests,
+        "concurrency": concurrency,
+        "errors": sum(1 for result in results if not result[1]),
+        "seconds": elapsed,
+        "throughput": num_requests / elapsed,
+        "p50_ms": float(np.percentile(latency, 50)),
+        "p90_ms": float(np.percentile(latency, 90)),
+        "p99_ms": float(np.percentile(latency, 99)),
+        "max_ms": float(latency.max()),
+    }
+
+#################################################
+# Command line
+#    python -m ghcnpy.server --port 8000
+#    python -m ghcnpy.server --benchmark URL PATH ...
+#################################################
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="GHCN-D query service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--backlog", type=int, default=64)
+    parser.add_argument("--max-age", type=int, default=86400)
+    parser.add_argument("--cache-mb", type=int, default=256)
+    parser.add_argument("--data-dir", default=None)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--benchmark", nargs="+", metavar=("URL", "PATH"))
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        if len(args.benchmark) < 2:
+            parser.error("--benchmark needs a URL and at least one PATH")
+        result = benchmark(args.benchmark[0], args.benchmark[1:], args.requests, args.concurrency)
+        print(json.dumps(result, indent=2))
+        return None
+    if args.data_dir:
+        gp.set_data_dir(args.data_dir)
+    serve(args.host, args.port, args.workers, args.backlog, args.max_age, args.cache_mb, args.verbose)
+    return None
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,368 @@
+# Import Modules
+import warnings
+
+import numpy as np
+
+import ghcnpy as gp
+
+#################################################
+# Daily Series
+# A cube (or stack of cubes) flattened to real
+# calendar days
+#    value: (stations, days) float64, NaN missing
+#    dates: (days,) YYYYMMDD
+#    year: (days,) calendar year
+#    month: (days,) 1-12
+#    doy: (days,) day of year on a leap-year
+#         calendar (Feb 29 keeps slot 59)
+#################################################
+_DOY_OFFSET = np.array([0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335], dtype='i')
+
+def daily_series(data, element):
+    if element not in data["elements"]:
+        raise ValueError("Data has no element " + element)
+    single = "station_ids" not in data
+    value = data["value"][np.newaxis] if single else data["value"]
+    value = value[..., data["elements"].index(element)]
+
+    valid, days_in_month = gp.valid_dates(data["begin_year"], data["end_year"])
+    year, month, day = np.nonzero(valid)
+    value = value[:, year, month, day].astype(np.float64)
+    value[value == -9999.] = np.nan
+    return {
+        "station_ids": [data["station_id"]] if single else list(data["station_ids"]),
+        "single": single,
+        "begin_year": data["begin_year"],
+        "end_year": data["end_year"],
+        "value": value,
+        "dates": (year + data["begin_year"]) * 10000 + (month + 1) * 100 + (day + 1),
+        "year": year + data["begin_year"],
+        "month": month + 1,
+        "doy": _DOY_OFFSET[month] + day,
+    }
+
+#################################################
+# MODULE: rolling_sum / rolling_mean
+# Trailing N-day window along the last axis, the
+# value at day i covers days i-window+1 .. i
+#    min_valid: valid days needed in a window
+#               (default: all of them), else NaN
+# Sums over partial windows count missing days
+# as zero; means divide by the valid days
+#################################################
+def _rolling(value, window):
+    present = ~np.isnan(value)
+    shape = value.shape[:-1] + (1,)
+    total = np.concatenate((np.zeros(shape), np.cumsum(np.where(present, value, 0.0), axis=-1)), axis=-1)
+    count = np.concatenate((np.zeros(shape, dtype=np.int64), np.cumsum(present, axis=-1)), axis=-1)
+    window_total = np.full(value.shape, np.nan)
+    window_count = np.zeros(value.shape, dtype=np.int64)
+    if window <= value.shape[-1]:
+        window_total[..., window - 1:] = total[..., window:] - total[..., :-window]
+        window_count[..., window - 1:] = count[..., window:] - count[..., :-window]
+    return window_total, window_count
+
+def rolling_sum(value, window, min_valid=None):
+    min_valid = window if min_valid is None else min_valid
+    window_total, window_count = _rolling(value, window)
+    return np.where(window_count >= max(min_valid, 1), window_total, np.nan)
+
+def rolling_mean(value, window, min_valid=None):
+    min_valid = window if min_valid is None else min_valid
+    window_total, window_count = _rolling(value, window)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(window_count >= max(min_valid, 1), window_total / window_count, np.nan)
+
+#################################################
+# MODULE: run_encode
+# Run-length encoding of True stretches along the
+# last axis of a boolean array, from the edges of
+# the mask (no Python loop)
+#    boundaries: optional (days,) bool, a run is
+#                cut before every True position
+# Returns row (flat index over leading axes),
+# start and length of every run
+#################################################
+def run_encode(mask, boundaries=None):
+    mask = np.asarray(mask, dtype=bool)
+    flat = mask.reshape(-1, mask.shape[-1])
+    padding = np.zeros((flat.shape[0], 1), dtype=bool)
+    before = np.concatenate((padding, flat[:, :-1]), axis=1)
+    after = np.concatenate((flat[:, 1:], padding), axis=1)
+    if boundaries is not None:
+        boundaries = np.asarray(boundaries, dtype=bool)
+        before = before & ~boundaries
+        after = after & ~np.r_[boundaries[1:], True]
+    row, start = np.nonzero(flat & ~before)
+    end = np.nonzero(flat & ~after)[1]
+    return row, start, end - start + 1
+
+def _consecutive(mask):
+    # Length of the True stretch so far at every position
+    counts = np.cumsum(mask, axis=-1)
+    return counts - np.maximum.accumulate(np.where(mask, 0, counts), axis=-1)
+
+#################################################
+# Spells with gap tolerance
+#    condition: day meets the spell condition
+#    valid: day has data (missing otherwise)
+#    max_gap: missing days a spell may run
+#             through; longer gaps end it
+#             (None: any gap)
+#    boundaries: optional (days,) bool, spells
+#             never cross these positions (e.g.
+#             the first day of each year)
+# Missing days inside a spell are bridged but not
+# counted in its length
+#################################################
+def _spell_breaks(condition, valid, max_gap):
+    missing = ~valid
+    breaks = valid & ~condition
+    if max_gap is not None:
+        # Missing stretch length at each day: forward run + backward run - 1
+        gap = _consecutive(missing) + _consecutive(missing[..., ::-1])[..., ::-1] - 1
+        breaks |= missing & (gap > max_gap)
+    return breaks, condition & valid
+
+def _running_length(condition, valid, max_gap, boundaries):
+    # Spell length so far at every day
+    breaks, counted = _spell_breaks(condition, valid, max_gap)
+    counts = np.cumsum(counted, axis=-1)
+    reset = np.where(breaks, counts, 0)
+    if boundaries is not None:
+        # Restart at each boundary from the count before it
+        cut = np.flatnonzero(boundaries[1:]) + 1
+        reset[..., cut] = np.maximum(reset[..., cut], counts[..., cut - 1])
+    return counts - np.maximum.accumulate(reset, axis=-1)
+
+#################################################
+# MODULE: spell_events
+# Every spell as an event
+#    min_length: counted days needed
+# Returns row (station), start / end position
+# (first / last counted day) and length
+#################################################
+def spell_events(condition, valid, max_gap=0, min_length=1, boundaries=None):
+    condition = np.asarray(condition, dtype=bool)
+    valid = np.asarray(valid, dtype=bool)
+    breaks, counted = _spell_breaks(condition, valid, max_gap)
+    row, start, length = run_encode(~breaks, boundaries)
+
+    counted = counted.reshape(-1, counted.shape[-1])
+    counts = np.concatenate((np.zeros((counted.shape[0], 1), dtype=np.int64), np.cumsum(counted, axis=-1)), axis=1)
+    spell_length = counts[row, start + length] - counts[row, start]
+    keep = spell_length >= max(min_length, 1)
+    row, start, length, spell_length = row[keep], start[keep], length[keep], spell_length[keep]
+
+    # Trim bridged missing days off both ends
+    days = np.arange(counted.shape[1])
+    next_counted = np.minimum.accumulate(np.where(counted, days, counted.shape[1])[:, ::-1], axis=1)[:, ::-1]
+    last_counted = np.maximum.accumulate(np.where(counted, days, -1), axis=1)
+    return {
+        "row": row,
+        "start": next_counted[row, start],
+        "end": last_counted[row, start + length - 1],
+        "length": spell_length,
+    }
+
+#################################################
+# Period grouping of a daily series
+#    annual / monthly: start position and label of
+#    every period (days are contiguous in time)
+#################################################
+def _periods(series, freq):
+    if freq == "annual":
+        key = series["year"]
+    elif freq == "monthly":
+        key = series["year"] * 12 + series["month"] - 1
+    else:
+        raise ValueError("Unknown freq: " + str(freq))
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    return starts, key[starts]
+
+def _reduce_periods(value, starts, reduce):
+    # NaN-aware max / sum over contiguous periods along the last axis
+    if reduce == "max":
+        result = np.fmax.reduceat(value, starts, axis=-1)
+    else:
+        result = np.add.reduceat(value, starts, axis=-1)
+    return result
+
+def _result(series, name, freq, starts, labels, values):
+    single = series["single"]
+    result = {
+        "index": name,
+        "freq": freq,
+        "station_ids": series["station_ids"],
+        "begin_year": series["begin_year"],
+        "end_year": series["end_year"],
+        "year": labels // 12 if freq == "monthly" else labels,
+    }
+    if freq == "monthly":
+        result["month"] = labels % 12 + 1
+    for key, value in values.items():
+        result[key] = value[0] if single and isinstance(value, np.ndarray) and value.ndim > 1 else value
+    return result
+
+#################################################
+# MODULE: max_n_day_total
+# Largest N-day total per station and period
+# (RX5DAY style); a window belongs to the period
+# of its last day
+#    min_valid: valid days needed in a window
+#               (default: all N)
+#################################################
+def max_n_day_total(data, n=5, element="PRCP", freq="annual", min_valid=None, reject_qflags=gp.QFLAG_CODES):
+    series = daily_series(gp.filter_qflags(data, reject_qflags), element)
+    totals = rolling_sum(series["value"], n, min_valid)
+    starts, labels = _periods(series, freq)
+    largest = _reduce_periods(totals, starts, "max")
+    end_day = _argmax_periods(totals, starts)
+    end_dates = np.where(np.isnan(largest), -9999, series["dates"][end_day])
+    largest = np.where(np.isnan(largest), -9999., largest).astype('f')
+    return _result(series, "RX%iDAY" % n, freq, starts, labels, {"value": largest, "end_date": end_dates})
+
+def _argmax_periods(value, starts):
+    # Position of the (first) largest value in each period
+    filled = np.where(np.isnan(value), -np.inf, value)
+    period = np.cumsum(np.isin(np.arange(value.shape[-1]), starts)) - 1
+    largest = np.maximum.reduceat(filled, starts, axis=-1)
+    hit = filled == largest[..., period]
+    days = np.where(hit, np.arange(value.shape[-1]), value.shape[-1])
+    return np.minimum.reduceat(days, starts, axis=-1).clip(max=value.shape[-1] - 1)
+
+#################################################
+# MODULE: dry_spells
+# Longest run of dry days (PRCP < threshold mm)
+# per station and period (CDD style), plus the
+# number of dry spells of at least min_length
+#    max_gap: missing days a spell runs through
+#    split: False lets a spell carry on from the
+#           previous period (it is credited to
+#           the period where it ends)
+#################################################
+def dry_spells(data, threshold=1.0, min_length=5, freq="annual", max_gap=0, split=False,
+               reject_qflags=gp.QFLAG_CODES):
+    series = daily_series(gp.filter_qflags(data, reject_qflags), "PRCP")
+    valid = ~np.isnan(series["value"])
+    with np.errstate(invalid='ignore'):
+        dry = series["value"] < threshold
+    return _spell_summary(series, "CDD", dry, valid, min_length, freq, max_gap, split)
+
+#################################################
+# MODULE: wet_spells
+# Longest run of wet days (PRCP >= threshold mm)
+# per station and period (CWD style)
+#################################################
+def wet_spells(data, threshold=1.0, min_length=3, freq="annual", max_gap=0, split=False,
+               reject_qflags=gp.QFLAG_CODES):
+    series = daily_series(gp.filter_qflags(data, reject_qflags), "PRCP")
+    valid = ~np.isnan(series["value"])
+    with np.errstate(invalid='ignore'):
+        wet = series["value"] >= threshold
+    return _spell_summary(series, "CWD", wet, valid, min_length, freq, max_gap, split)
+
+def _spell_summary(series, name, condition, valid, min_length, freq, max_gap, split, peak_value=None):
+    starts, labels = _periods(series, freq)
+    boundaries = None
+    if split:
+        boundaries = np.zeros(condition.shape[-1], dtype=bool)
+        boundaries[starts] = True
+    running = _running_length(condition, valid, max_gap, boundaries)
+    longest = np.maximum.reduceat(running, starts, axis=-1)
+
+    # Events are credited to the period they end in
+    events = spell_events(condition, valid, max_gap, min_length, boundaries)
+    num_periods = len(starts)
+    slot = events["row"] * num_periods + np.searchsorted(starts, events["end"], side="right") - 1
+    shape = (condition.shape[0], num_periods)
+    count = np.bincount(slot, minlength=shape[0] * num_periods).reshape(shape)
+    days = np.bincount(slot, weights=events["length"], minlength=shape[0] * num_periods).reshape(shape)
+
+    extra = None
+    if peak_value is not None:
+        # Largest value inside each event, one reduceat over (start, end + 1) pairs
+        num_days = peak_value.shape[-1]
+        flat = np.r_[peak_value.ravel(), np.nan]
+        bounds = np.column_stack((events["row"] * num_days + events["start"],
+                                  events["row"] * num_days + events["end"] + 1)).ravel()
+        peaks = np.fmax.reduceat(flat, bounds)[::2] if len(bounds) else np.zeros(0)
+        extra = {"peak": [round(float(peak), 2) for peak in peaks]}
+
+    # Periods without any data are missing
+    has_data = np.add.reduceat(valid, starts, axis=-1) > 0
+    values = {
+        "longest": np.where(has_data, longest, -9999).astype(np.int32),
+        "count": np.where(has_data, count, -9999).astype(np.int32),
+        "days": np.where(has_data, days, -9999).astype(np.int32),
+        "events": _event_list(series, events, extra),
+    }
+    return _result(series, name, freq, starts, labels, values)
+
+def _event_list(series, events, extra=None):
+    event_list = []
+    for event_counter in range(len(events["row"])):
+        event = {
+            "station_id": series["station_ids"][events["row"][event_counter]],
+            "begin_date": int(series["dates"][events["start"][event_counter]]),
+            "end_date": int(series["dates"][events["end"][event_counter]]),
+            "length": int(events["length"][event_counter]),
+        }
+        if extra is not None:
+            event.update({key: value[event_counter] for key, value in extra.items()})
+        event_list.append(event)
+    return event_list
+
+#################################################
+# MODULE: percentile_thresholds
+# Day-of-year percentile of an element over a base
+# period, pooled over a centred window of days
+# (ETCCDI style, window=5), one day of year at a
+# time so only (stations, years x window) values
+# are pooled at once
+# Returns (stations, 366) thresholds, NaN where
+# the base period has no data
+#################################################
+def percentile_thresholds(series, percentile=90, window=5, base_begin=None, base_end=None):
+    base_begin = series["begin_year"] if base_begin is None else base_begin
+    base_end = series["end_year"] if base_end is None else base_end
+    in_base = (series["year"] >= base_begin) & (series["year"] <= base_end)
+    num_years = base_end - base_begin + 1
+
+    # (stations, years, 366) grid of base period values by day of year
+    grid = np.full((series["value"].shape[0], num_years, 366), np.nan, dtype='f')
+    grid[:, series["year"][in_base] - base_begin, series["doy"][in_base]] = series["value"][:, in_base]
+    half = window // 2
+    thresholds = np.full((grid.shape[0], 366), np.nan, dtype='f')
+    with warnings.catch_warnings():
+        # All-NaN windows are left NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for doy in range(366):
+            pooled = grid[:, :, np.arange(doy - half, doy + half + 1) % 366].reshape(grid.shape[0], -1)
+            thresholds[:, doy] = np.nanpercentile(pooled, percentile, axis=1)
+    return thresholds
+
+#################################################
+# MODULE: heat_waves
+# Runs of at least min_length days above the
+# day-of-year percentile threshold of an element
+# (TMAX by default) per station and period
+#    percentile / window / base_begin / base_end:
+#        see percentile_thresholds
+#    max_gap: missing days a heat wave runs through
+# Returns longest run, number of heat waves, heat
+# wave days and every event (with its peak value)
+#################################################
+def heat_waves(data, element="TMAX", percentile=90, min_length=3, window=5, base_begin=None, base_end=None,
+               freq="annual", max_gap=0, split=False, reject_qflags=gp.QFLAG_CODES):
+    series = daily_series(gp.filter_qflags(data, reject_qflags), element)
+    thresholds = percentile_thresholds(series, percentile, window, base_begin, base_end)
+    day_threshold = thresholds[:, series["doy"]]
+    valid = ~np.isnan(series["value"]) & ~np.isnan(day_threshold)
+    with np.errstate(invalid='ignore'):
+        hot = series["value"] > day_threshold
+
+    summary = _spell_summary(series, "HW" + element, hot, valid, min_length, freq, max_gap, split,
+                             peak_value=series["value"])
+    summary["thresholds"] = thresholds[0] if series["single"] else thresholds
+    return summary
@@ -0,0 +1,123 @@
+# Import Modules
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+import ghcnpy as gp
+
+#################################################
+# MODULE: Station
+# Handle on one station: metadata and the data
+# file are resolved once, the file is parsed
+# once, and every view below is built on first
+# use and kept
+#    metadata: StationRecord (ghcnd-stations.txt)
+#    infile: local station file (.dly, or
+#            by_station .csv.gz, see
+#            set_station_source)
+#    ragged: every element of the file
+#    cube: dense cube of every element
+#    dataframe: QC'd values by date, one column
+#               per element, NaN missing
+#    climatology: element -> daily_climatology
+#    accumulations: PRCP / SNOW -> (years, 366)
+#               year-to-date totals, NaN after
+#               the end of each year
+#    inventory: element -> (first_year, last_year)
+# select() returns QC'd cubes of some elements /
+# dates, memoized the same way
+#################################################
+class Station:
+    def __init__(self, station_id, max_age=0):
+        self.station_id = station_id
+        self.max_age = max_age
+        self._selections = {}
+
+    def __repr__(self):
+        return "Station(%r)" % self.station_id
+
+    @cached_property
+    def metadata(self):
+        table = gp.get_station_table(self.max_age)
+        row = table.find(self.station_id)
+        if row is None:
+            raise ValueError("Unknown station: " + str(self.station_id))
+        return table[row]
+
+    @cached_property
+    def infile(self):
+        return gp.station_file(self.station_id, self.max_age)
+
+    @cached_property
+    def ragged(self):
+        return gp.read_dly_ragged(self.infile)
+
+    @cached_property
+    def cube(self):
+        return gp.ragged_to_dense(self.ragged)
+
+    def select(self, elements=None, begin_date=None, end_date=None, reject_qflags=gp.QFLAG_CODES):
+        # Same cube as read_dly(infile, elements, begin_date, end_date) after filter_qflags
+        key = (tuple(elements) if elements is not None else None, begin_date, end_date, reject_qflags)
+        cube = self._selections.get(key)
+        if cube is None:
+            cube = gp.ragged_to_dense(gp.select_ragged(self.ragged, elements, begin_date, end_date))
+            if reject_qflags:
+                cube = gp.filter_qflags(cube, reject_qflags)
+            self._selections[key] = cube
+        return cube
+
+    @cached_property
+    def dataframe(self):
+        cube = self.select()
+        value = cube["value"]
+
+        # Dates with at least one valid element
+        valid, days_in_month = gp.valid_dates(cube["begin_year"], cube["end_year"])
+        year, month, day = np.nonzero(valid & (value != -9999.).any(axis=3))
+        rows = value[year, month, day, :].astype(np.float64)
+        rows[rows == -9999.] = np.nan
+        dates = pd.to_datetime(pd.DataFrame({"year": year + cube["begin_year"], "month": month + 1, "day": day + 1}))
+        return pd.DataFrame(rows, index=pd.DatetimeIndex(dates, name="DATE"), columns=cube["elements"])
+
+    @cached_property
+    def climatology(self):
+        return {element: gp.daily_climatology(self.cube, element) for element in self.cube["elements"]}
+
+    @cached_property
+    def accumulations(self):
+        cube = self.select()
+        valid, days_in_month = gp.valid_dates(cube["begin_year"], cube["end_year"])
+        num_years = cube["end_year"] - cube["begin_year"] + 1
+        valid = valid.reshape(num_years, 12 * 31)
+
+        # Running totals over each year's real dates, missing days count as zero
+        position = np.cumsum(valid, axis=1) - 1
+        year, day = np.nonzero(valid)
+        accumulations = {}
+        for element in ("PRCP", "SNOW"):
+            if element not in cube["elements"]:
+                continue
+            value = cube["value"][..., cube["elements"].index(element)].reshape(num_years, 12 * 31)
+            total = np.where(valid & (value != -9999.), value, 0.0).cumsum(axis=1)
+            accumulation = np.full((num_years, 366), np.nan)
+            accumulation[year, position[year, day]] = total[year, day]
+            accumulations[element] = accumulation
+        return accumulations
+
+    @cached_property
+    def inventory(self):
+        inventory = gp.get_inventory_table(self.max_age)
+        rows = np.flatnonzero(inventory["station_ids"] == self.station_id.encode())
+        return {str(inventory["element"][row]): (int(inventory["first_year"][row]), int(inventory["last_year"][row]))
+                for row in rows}
+
+#################################################
+# MODULE: as_station
+# Station handle for a handle or a station ID
+#################################################
+def as_station(station, max_age=0):
+    if isinstance(station, Station):
+        return station
+    return Station(station, max_age)
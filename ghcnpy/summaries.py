@@ -0,0 +1,263 @@
+# Import Modules
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import netCDF4 as nc
+
+import ghcnpy as gp
+
+#################################################
+# Monthly / Annual Summaries (GSOM / GSOY style)
+# One row per (station, year[, month], element):
+#    mean, total, min, max over valid days,
+#    count of valid days, completeness (count /
+#    days in the period)
+#################################################
+SUMMARY_STATS = ["mean", "total", "min", "max", "count", "completeness"]
+
+#################################################
+# Output writers, appended to batch by batch
+#    csv: long table with a header row
+#    netcdf: same columns along an unlimited
+#            "record" dimension
+#################################################
+class _SummaryWriter:
+    def __init__(self, outfile, freq, output_format):
+        self.freq = freq
+        self.output_format = output_format
+        self.columns = ["station", "year"] + (["month"] if freq == "monthly" else []) + ["element"] + SUMMARY_STATS
+        self.rows = 0
+        if output_format == "csv":
+            self.handle = open(outfile, 'w')
+            self.handle.write(",".join(column.upper() for column in self.columns) + "\n")
+        elif output_format == "netcdf":
+            self.handle = nc.Dataset(outfile, 'w')
+            self.handle.createDimension("record", None)
+            self.handle.createDimension("id_len", 11)
+            self.handle.createDimension("element_len", 4)
+            self.handle.createVariable("station", 'S1', ("record", "id_len"))
+            self.handle.createVariable("element", 'S1', ("record", "element_len"))
+            self.handle.createVariable("year", 'i2', ("record",))
+            if freq == "monthly":
+                self.handle.createVariable("month", 'i1', ("record",))
+            for stat in SUMMARY_STATS:
+                dtype = 'i2' if stat == "count" else 'f4'
+                self.handle.createVariable(stat, dtype, ("record",), zlib=True)
+        else:
+            raise ValueError("Unknown output format: " + str(output_format))
+
+    def write(self, batch):
+        num_rows = len(batch["year"])
+        if num_rows == 0:
+            return
+        if self.output_format == "csv":
+            frame = pd.DataFrame({column: batch[column] for column in self.columns})
+            frame.to_csv(self.handle, header=False, index=False, float_format="%.2f")
+        else:
+            record = slice(self.rows, self.rows + num_rows)
+            self.handle["station"][record] = nc.stringtochar(np.asarray(batch["station"], dtype='S11'))
+            self.handle["element"][record] = nc.stringtochar(np.asarray(batch["element"], dtype='S4'))
+            for column in self.columns:
+                if column not in ("station", "element"):
+                    self.handle[column][record] = batch[column]
+        self.rows += num_rows
+
+    def close(self):
+        self.handle.close()
+
+#################################################
+# Reduce a stacked batch of cubes over days
+#    (stations, years, 12, 31, elements) ->
+#    rows for every period with a valid day
+#################################################
+def _reduce_stack(stacked, freq):
+    value = stacked["value"]
+    valid, days_in_month = gp.valid_dates(stacked["begin_year"], stacked["end_year"])
+    present = valid[np.newaxis, :, :, :, np.newaxis] & (value != -9999.)
+
+    axes = (3,) if freq == "monthly" else (2, 3)
+    possible = days_in_month if freq == "monthly" else days_in_month.sum(axis=1)
+    count = present.sum(axis=axes)
+    total = np.where(present, value, 0.0).sum(axis=axes)
+    stats = {
+        "mean": total / np.maximum(count, 1),
+        "total": total,
+        "min": np.where(present, value, np.inf).min(axis=axes),
+        "max": np.where(present, value, -np.inf).max(axis=axes),
+        "count": count,
+        "completeness": count / possible[np.newaxis, ..., np.newaxis],
+    }
+
+    # Keep only periods with data, in station / year / month / element order
+    where = np.nonzero(count > 0)
+    batch = {
+        "station": np.asarray(stacked["station_ids"])[where[0]],
+        "year": where[1] + stacked["begin_year"],
+        "element": np.asarray(stacked["elements"])[where[-1]],
+    }
+    if freq == "monthly":
+        batch["month"] = where[2] + 1
+    for stat in SUMMARY_STATS:
+        batch[stat] = stats[stat][where]
+    return batch
+
+#################################################
+# MODULE: summarize_stations
+# Summaries for many .dly files in batches sized
+# so that each batch fits in max_memory_mb; a
+# batch is stacked over the years of all its
+# stations, so that whole range is counted for
+# every station in it
+#    freq: monthly or annual
+#    output_format: csv or netcdf
+#################################################
+def summarize_stations(infiles, outfile, elements=gp.CORE_ELEMENTS, freq="monthly", output_format="csv",
+                       max_memory_mb=512, reject_qflags=gp.QFLAG_CODES):
+    print("\nSUMMARIZING", len(infiles), "STATIONS TO", outfile)
+    if freq not in ("monthly", "annual"):
+        raise ValueError("Unknown freq: " + str(freq))
+    elements = list(elements)
+
+    # Bytes per station year: cube value / flags plus working copies during the reduction
+    year_bytes = 12 * 31 * len(elements) * 32
+    writer = _SummaryWriter(outfile, freq, output_format)
+    try:
+        batch_files = []
+        batch_years = None
+        for infile in infiles:
+            first_year, last_year = gp.dly_year_range(infile)
+            years = (first_year, last_year) if batch_years is None else \
+                (min(batch_years[0], first_year), max(batch_years[1], last_year))
+            if batch_files and (len(batch_files) + 1) * (years[1] - years[0] + 1) * year_bytes > max_memory_mb * 1e6:
+                writer.write(_summarize_batch(batch_files, elements, freq, reject_qflags))
+                batch_files = []
+                years = (first_year, last_year)
+            batch_files.append(infile)
+            batch_years = years
+        if batch_files:
+            writer.write(_summarize_batch(batch_files, elements, freq, reject_qflags))
+    finally:
+        writer.close()
+    return outfile
+
+def _summarize_batch(batch_files, elements, freq, reject_qflags):
+    cubes = [gp.filter_qflags(gp.read_dly(batch_file, elements), reject_qflags) for batch_file in batch_files]
+    return _reduce_stack(gp.stack_cubes(cubes, elements), freq)
+
+#################################################
+# MODULE: summarize_year_files
+# Summaries straight from by_year csv.gz files,
+# streamed in chunks of rows sized by
+# max_memory_mb; partial sums are merged per
+# (station, month, element) and written out once
+# each year file is done
+# Partial sums beyond max_memory_mb are spilled to
+# temporary files in SPILL_BUCKETS ranges of
+# station IDs and merged one range at a time, so
+# memory does not grow with the station count
+#################################################
+SPILL_BUCKETS = 64
+
+def summarize_year_files(year_files, outfile, elements=gp.CORE_ELEMENTS, freq="monthly", output_format="csv",
+                         max_memory_mb=512, reject_qflags=gp.QFLAG_CODES):
+    print("\nSUMMARIZING", len(year_files), "YEAR FILES TO", outfile)
+    if freq not in ("monthly", "annual"):
+        raise ValueError("Unknown freq: " + str(freq))
+    elements = list(elements)
+    scale = pd.Series({element: gp.element_scale(element) for element in elements})
+    reject = set(reject_qflags)
+    # About 400 bytes a row: the chunk being read and the merged partial sums get half of the memory each
+    chunksize = max(10000, int(max_memory_mb * 1e6 / 800))
+    max_groups = max(1, int(max_memory_mb * 1e6 / 800))
+
+    writer = _SummaryWriter(outfile, freq, output_format)
+    try:
+        for year_file in year_files:
+            with tempfile.TemporaryDirectory() as spill_dir:
+                _summarize_year_file(year_file, writer, elements, scale, reject, freq, chunksize, max_groups,
+                                     spill_dir)
+    finally:
+        writer.close()
+    return outfile
+
+def _summarize_year_file(year_file, writer, elements, scale, reject, freq, chunksize, max_groups, spill_dir):
+    spill = {"directory": spill_dir, "boundaries": None, "count": 0}
+    partials = []
+    reader = pd.read_csv(year_file, header=None, names=gp.BY_YEAR_COLUMNS, usecols=[0, 1, 2, 3, 5],
+                         dtype={"ID": str, "DATE": np.int64, "ELEMENT": str, "DATA_VALUE": np.int64, "Q_FLAG": str},
+                         compression='infer', chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[chunk["ELEMENT"].isin(elements) & ~chunk["Q_FLAG"].isin(reject)]
+        chunk = pd.DataFrame({
+            "station": chunk["ID"],
+            "year": chunk["DATE"] // 10000,
+            "month": (chunk["DATE"] // 100) % 100 if freq == "monthly" else 0,
+            "element": chunk["ELEMENT"],
+            "value": chunk["DATA_VALUE"] / chunk["ELEMENT"].map(scale),
+        })
+        partials.append(chunk.groupby(["station", "year", "month", "element"])["value"]
+                        .agg(["sum", "min", "max", "count"]))
+        # Fold partials together once they pile up, spill them once they outgrow memory
+        if len(partials) > 8:
+            partials = [_merge_partials(partials)]
+        if sum(len(partial) for partial in partials) > max_groups:
+            _spill_partials(spill, _merge_partials(partials))
+            partials = []
+
+    if spill["count"] == 0:
+        if partials:
+            writer.write(_partials_batch(_merge_partials(partials), freq))
+        return None
+    if partials:
+        _spill_partials(spill, _merge_partials(partials))
+    # Station ranges in order, so rows come out sorted as without spilling
+    for bucket in range(len(spill["boundaries"]) + 1):
+        paths = [os.path.join(spill_dir, "%d.%d.pkl" % (bucket, spill_counter))
+                 for spill_counter in range(spill["count"])]
+        pieces = [pd.read_pickle(path) for path in paths if os.path.exists(path)]
+        if pieces:
+            writer.write(_partials_batch(_merge_partials(pieces), freq))
+    return None
+
+def _spill_partials(spill, merged):
+    # Station ID ranges are fixed at the first spill from the stations seen so far
+    stations = merged.index.get_level_values(0).to_numpy().astype(str)
+    if spill["boundaries"] is None:
+        unique = np.unique(stations)
+        spill["boundaries"] = np.unique(unique[np.linspace(0, len(unique), SPILL_BUCKETS, endpoint=False)
+                                               .astype(np.int64)[1:]])
+    bucket = np.searchsorted(spill["boundaries"], stations, side="right")
+    for bucket_counter in np.unique(bucket):
+        merged[bucket == bucket_counter].to_pickle(os.path.join(
+            spill["directory"], "%d.%d.pkl" % (bucket_counter, spill["count"])))
+    spill["count"] += 1
+    return None
+
+def _partials_batch(merged, freq):
+    merged = merged.reset_index()
+    year = merged["year"].to_numpy()
+    if freq == "monthly":
+        valid, days_in_month = gp.valid_dates(int(year.min()), int(year.max()))
+        possible = days_in_month[year - year.min(), merged["month"].to_numpy() - 1]
+    else:
+        possible = np.where(((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0), 366, 365)
+    batch = {
+        "station": merged["station"].to_numpy(),
+        "year": year,
+        "element": merged["element"].to_numpy(),
+        "mean": (merged["sum"] / merged["count"]).to_numpy(),
+        "total": merged["sum"].to_numpy(),
+        "min": merged["min"].to_numpy(),
+        "max": merged["max"].to_numpy(),
+        "count": merged["count"].to_numpy(),
+        "completeness": merged["count"].to_numpy() / possible,
+    }
+    if freq == "monthly":
+        batch["month"] = merged["month"].to_numpy()
+    return batch
+
+def _merge_partials(partials):
+    combined = pd.concat(partials)
+    return combined.groupby(level=[0, 1, 2, 3]).agg({"sum": "sum", "min": "min", "max": "max", "count": "sum"})
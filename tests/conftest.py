@@ -0,0 +1,136 @@
+# Shared fixtures: a small synthetic GHCN-D region written to disk in
+# the NOAA formats (.dly, by_station .csv.gz, ghcnd-stations.txt,
+# ghcnd-inventory.txt), so every test runs offline
+import calendar
+import gzip
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import ghcnpy as gp
+
+BEGIN_YEAR = 1981
+END_YEAR = 2020
+ELEMENTS = ("TMAX", "TMIN", "PRCP", "SNOW")
+NUM_STATIONS = 8
+
+
+def station_ids(num_stations=NUM_STATIONS):
+    return ["USC%08d" % (100 + counter) for counter in range(num_stations)]
+
+
+def make_region(directory, num_stations=NUM_STATIONS, begin_year=BEGIN_YEAR, end_year=END_YEAR, seed=0):
+    # Correlated stations: shared weather plus a per-station bias and noise
+    rng = np.random.default_rng(seed)
+    dates = [(year, month, day) for year in range(begin_year, end_year + 1) for month in range(1, 13)
+             for day in range(1, calendar.monthrange(year, month)[1] + 1)]
+    year = np.array([date[0] for date in dates])
+    month = np.array([date[1] for date in dates])
+    day = np.array([date[2] for date in dates])
+    doy = np.array([(np.datetime64("%04d-%02d-%02d" % date) - np.datetime64("%04d-01-01" % date[0])).astype(int)
+                    for date in dates])
+    season = 12.0 * np.sin((doy - 100) / 365.25 * 2 * np.pi)
+    shared = rng.normal(0, 4, len(dates))
+    wet = rng.random(len(dates)) < 0.35
+    amount = rng.gamma(0.8, 9, len(dates))
+
+    stations = []
+    for counter, station_id in enumerate(station_ids(num_stations)):
+        bias = rng.normal(0, 2)
+        first_year = begin_year + (counter % 3) * 2
+        last_year = end_year - (counter % 2)
+        tmax = 18 + season + bias + shared + rng.normal(0, 1, len(dates))
+        series = {
+            "TMAX": tmax,
+            "TMIN": tmax - 10 - rng.gamma(2, 1, len(dates)),
+            "PRCP": np.where(wet & (rng.random(len(dates)) < 0.9), amount * rng.uniform(0.7, 1.3), 0.0),
+            "SNOW": np.where(np.isin(month, (12, 1, 2)) & wet, rng.gamma(1, 20, len(dates)), 0.0),
+        }
+        present = {element: (year >= first_year) & (year <= last_year) & (rng.random(len(dates)) > 0.06)
+                   for element in ELEMENTS}
+        flags = {element: (np.where(rng.random(len(dates)) < 0.01, ord("T"), 0),
+                           np.where(rng.random(len(dates)) < 0.02, rng.choice(np.frombuffer(b"GIX", np.uint8),
+                                                                               len(dates)), 0),
+                           rng.choice(np.frombuffer(b"07X", np.uint8), len(dates)))
+                 for element in ELEMENTS}
+        raw = {element: np.rint(series[element] * gp.element_scale(element)).astype(int) for element in ELEMENTS}
+        station = {"station_id": station_id, "year": year, "month": month, "day": day, "raw": raw,
+                   "present": present, "flags": flags, "first_year": first_year, "last_year": last_year,
+                   "latitude": 35.0 + 0.1 * counter, "longitude": -82.0 - 0.1 * counter}
+        write_dly(os.path.join(directory, station_id + ".dly"), station)
+        write_station_csv(os.path.join(directory, station_id + ".csv.gz"), station)
+        stations.append(station)
+
+    with open(os.path.join(directory, "ghcnd-stations.txt"), "w") as out:
+        for counter, station in enumerate(stations):
+            out.write("%-11s %8.4f %9.4f %6.1f NC %-30s %-3s %-3s %-5s\n" % (
+                station["station_id"], station["latitude"], station["longitude"], 300.0 + counter,
+                "TEST STATION %d" % counter, "GSN" if counter % 2 else "", "", ""))
+    with open(os.path.join(directory, "ghcnd-inventory.txt"), "w") as out:
+        for station in stations:
+            for element in ELEMENTS:
+                out.write("%-11s %8.4f %9.4f %s %4d %4d\n" % (station["station_id"], station["latitude"],
+                                                              station["longitude"], element, station["first_year"],
+                                                              station["last_year"]))
+    return stations
+
+
+def _flag(code):
+    return chr(code) if code else " "
+
+
+def write_dly(path, station):
+    lines = []
+    year, month, day = station["year"], station["month"], station["day"]
+    for line_year in range(station["first_year"], station["last_year"] + 1):
+        for line_month in range(1, 13):
+            days = np.flatnonzero((year == line_year) & (month == line_month))
+            for element in ELEMENTS:
+                line = "%s%04d%02d%s" % (station["station_id"], line_year, line_month, element)
+                for day_counter in range(31):
+                    if day_counter < len(days) and station["present"][element][days[day_counter]]:
+                        index = days[day_counter]
+                        mflag, qflag, sflag = (flags[index] for flags in station["flags"][element])
+                        line += "%5d%s%s%s" % (station["raw"][element][index], _flag(mflag), _flag(qflag),
+                                               _flag(sflag))
+                    else:
+                        line += "-9999   "
+                lines.append(line)
+    with open(path, "w") as out:
+        out.write("\n".join(lines) + "\n")
+
+
+def write_station_csv(path, station):
+    # by_station layout: one row per reported day and element, ordered by date
+    rows = []
+    for index in range(len(station["year"])):
+        for element in ELEMENTS:
+            if not station["present"][element][index]:
+                continue
+            mflag, qflag, sflag = (flags[index] for flags in station["flags"][element])
+            rows.append("%s,%04d%02d%02d,%s,%d,%s,%s,%s,0700\n" % (
+                station["station_id"], station["year"][index], station["month"][index], station["day"][index],
+                element, station["raw"][element][index], _flag(mflag).strip(), _flag(qflag).strip(),
+                _flag(sflag).strip()))
+    with gzip.open(path, "wt") as out:
+        out.writelines(rows)
+
+
+@pytest.fixture(scope="session")
+def region_source(tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("region"))
+    return {"directory": directory, "stations": make_region(directory)}
+
+
+@pytest.fixture
+def region(region_source, tmp_path):
+    # A private copy of the region as the data directory
+    directory = str(tmp_path / "data")
+    shutil.copytree(region_source["directory"], directory)
+    previous = gp.get_data_dir()
+    gp.set_data_dir(directory)
+    yield {"directory": directory, "stations": region_source["stations"],
+           "station_ids": [station["station_id"] for station in region_source["stations"]]}
+    gp.set_data_dir(previous)
@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pytest
+
+import ghcnpy as gp
+
+
+def pairwise_corrcoef(matrix, min_pairs):
+    # Brute force: np.corrcoef over the days each pair has in common
+    num_rows = matrix.shape[0]
+    correlation = np.full((num_rows, num_rows), np.nan)
+    pairs = np.zeros((num_rows, num_rows), dtype=np.int64)
+    for row in range(num_rows):
+        for column in range(num_rows):
+            common = ~np.isnan(matrix[row]) & ~np.isnan(matrix[column])
+            pairs[row, column] = common.sum()
+            if common.sum() >= max(min_pairs, 2):
+                correlation[row, column] = np.corrcoef(matrix[row, common], matrix[column, common])[0, 1]
+    return correlation, pairs
+
+
+@pytest.fixture
+def anomalies():
+    rng = np.random.default_rng(3)
+    shared = rng.normal(size=400)
+    matrix = shared + rng.normal(scale=rng.uniform(0.3, 3.0, (11, 1)), size=(11, 400))
+    matrix[rng.random(matrix.shape) < 0.2] = np.nan
+    matrix[4, 60:] = np.nan
+    return matrix.astype('f')
+
+
+def test_block_correlation(anomalies):
+    expected, expected_pairs = pairwise_corrcoef(anomalies, 30)
+    correlation, pairs = gp.block_correlation(anomalies[:5], anomalies[3:], min_pairs=30)
+    np.testing.assert_array_equal(pairs, expected_pairs[:5, 3:])
+    np.testing.assert_allclose(correlation, expected[:5, 3:], atol=1e-4, equal_nan=True)
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 4, 256])
+def test_correlation_neighbors(anomalies, block_size):
+    expected, expected_pairs = pairwise_corrcoef(anomalies, 50)
+    np.fill_diagonal(expected, np.nan)
+    neighbors = gp.correlation_neighbors(anomalies, k=3, block_size=block_size, min_pairs=50)
+    for row in range(anomalies.shape[0]):
+        order = np.argsort(-np.nan_to_num(expected[row], nan=-np.inf), kind="stable")[:3]
+        order = order[~np.isnan(expected[row, order])]
+        assert list(neighbors["neighbors"][row, :len(order)]) == list(order)
+        assert (neighbors["neighbors"][row, len(order):] == -1).all()
+        np.testing.assert_allclose(neighbors["correlation"][row, :len(order)], expected[row, order], atol=1e-4)
+        np.testing.assert_array_equal(neighbors["pairs"][row, :len(order)], expected_pairs[row, order])
+
+
+def test_region_reference_stations(region):
+    files = [os.path.join(region["directory"], station_id + ".dly") for station_id in region["station_ids"]]
+    anomaly = gp.anomaly_matrix(gp.read_dly_parallel(files, ["TMAX"]), "TMAX")
+    neighbors = gp.correlation_neighbors(anomaly, k=3, block_size=3)
+    references = gp.reference_stations(neighbors, region["station_ids"][0])
+    assert len(references) == 3
+    assert all(station_id != region["station_ids"][0] and correlation > 0.5
+               for station_id, correlation, pairs in references)
@@ -0,0 +1,153 @@
+import gzip
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import ghcnpy as gp
+
+PAYLOAD = bytes(range(256)) * 4096
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Serves PAYLOAD at any path; behaviour is set on the server (see stand_in)
+    def do_GET(self):
+        server = self.server
+        with server.guard:
+            server.requests.append(dict(self.headers))
+            request_counter = len(server.requests)
+        if server.delay:
+            threading.Event().wait(server.delay)
+        if self.path.endswith("/missing"):
+            self.send_error(404)
+            return
+
+        body, status, headers = PAYLOAD, 200, {"ETag": '"v1"'}
+        range_header = self.headers.get("Range")
+        if range_header and server.ranges:
+            offset = int(range_header.split("=")[1].rstrip("-"))
+            if offset >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % len(PAYLOAD))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body, status = PAYLOAD[offset:], 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (offset, len(PAYLOAD) - 1, len(PAYLOAD))
+        elif "gzip" in self.headers.get("Accept-Encoding", ""):
+            # Like the NOAA servers: compress on the fly when the client allows it
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if request_counter <= server.cut_requests:
+            # Drop the connection part way through
+            self.wfile.write(body[:server.cut_at])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    httpd.guard = threading.Lock()
+    httpd.requests = []
+    httpd.ranges = True
+    httpd.cut_requests = 0
+    httpd.cut_at = 300000
+    httpd.delay = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = "http://127.0.0.1:%d/" % httpd.server_port
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download(stand_in, tmp_path):
+    outfile = gp.download_file(stand_in.url + "file", str(tmp_path / "file"))
+    assert read(outfile) == PAYLOAD
+    assert not os.path.exists(outfile + ".part")
+    assert stand_in.requests[0]["Accept-Encoding"] == "identity"
+
+
+def test_download_resumes(stand_in, tmp_path):
+    stand_in.cut_requests = 2
+    outfile = gp.download_file(stand_in.url + "file", str(tmp_path / "file"))
+    assert read(outfile) == PAYLOAD
+    assert len(stand_in.requests) == 3
+    assert "Range" not in stand_in.requests[0]
+    assert [request["Range"] for request in stand_in.requests[1:]] == ["bytes=300000-", "bytes=600000-"]
+    assert all(request["If-Range"] == '"v1"' for request in stand_in.requests[1:])
+    assert all(request["Accept-Encoding"] == "identity" for request in stand_in.requests)
+
+
+def test_download_range_ignored(stand_in, tmp_path):
+    # A 200 to a ranged request starts the file over
+    stand_in.ranges = False
+    stand_in.cut_requests = 1
+    outfile = gp.download_file(stand_in.url + "file", str(tmp_path / "file"))
+    assert read(outfile) == PAYLOAD
+    assert stand_in.requests[1]["Range"] == "bytes=300000-"
+
+
+def test_download_complete_part_file(stand_in, tmp_path):
+    # 416: the part file already holds everything
+    outfile = str(tmp_path / "file")
+    with open(outfile + ".part", "wb") as f:
+        f.write(PAYLOAD)
+    gp.download_file(stand_in.url + "file", outfile)
+    assert read(outfile) == PAYLOAD
+
+
+def test_download_checks(stand_in, tmp_path):
+    outfile = str(tmp_path / "file")
+    with pytest.raises(IOError):
+        gp.download_file(stand_in.url + "file", outfile, expected_size=len(PAYLOAD) + 1)
+    with pytest.raises(IOError):
+        gp.download_file(stand_in.url + "file", outfile, checksum="0" * 32)
+    assert not os.path.exists(outfile) and not os.path.exists(outfile + ".part")
+
+
+def test_download_client_error(stand_in, tmp_path):
+    with pytest.raises(requests.HTTPError):
+        gp.download_file(stand_in.url + "missing", str(tmp_path / "file"))
+    assert len(stand_in.requests) == 1
+
+
+def test_fetch_resource_single_flight(stand_in, tmp_path):
+    # Threads asking at once share one download
+    previous = gp.get_data_dir()
+    gp.set_data_dir(str(tmp_path))
+    stand_in.delay = 0.5
+    try:
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(gp.fetch_resource(stand_in.url + "file", "file")))
+                   for thread_counter in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        gp.set_data_dir(previous)
+    assert len(stand_in.requests) == 1
+    assert results == [str(tmp_path / "file")] * 4
+    assert read(results[0]) == PAYLOAD
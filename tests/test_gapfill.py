@@ -0,0 +1,158 @@
+import numpy as np
+import pytest
+
+import ghcnpy as gp
+from ghcnpy import gapfill
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    gp.clear_gapfill_cache()
+    yield
+    gp.clear_gapfill_cache()
+
+
+@pytest.fixture
+def pair():
+    rng = np.random.default_rng(5)
+    neighbors = rng.normal(10, 5, (2, 6, 12, 31))
+    target = 1.5 * neighbors[0] - 2.0 + rng.normal(0, 0.5, (6, 12, 31))
+    target[rng.random(target.shape) < 0.1] = np.nan
+    neighbors[1, rng.random((6, 12, 31)) < 0.3] = np.nan
+    return target, neighbors
+
+
+def test_fit_regression(pair):
+    target, neighbors = pair
+    fits = gp.fit_neighbors(target, neighbors, "regression", min_pairs=30)
+    for neighbor_counter in range(2):
+        for month in range(12):
+            x, y = neighbors[neighbor_counter, :, month].ravel(), target[:, month].ravel()
+            both = ~np.isnan(x) & ~np.isnan(y)
+            slope, intercept = np.polyfit(x[both], y[both], 1)
+            correlation = np.corrcoef(x[both], y[both])[0, 1]
+            assert fits["pairs"][neighbor_counter, month] == both.sum()
+            if correlation > 0:
+                assert fits["slope"][neighbor_counter, month] == pytest.approx(slope)
+                assert fits["intercept"][neighbor_counter, month] == pytest.approx(intercept)
+                assert fits["weight"][neighbor_counter, month] == pytest.approx(correlation ** 2)
+            else:
+                assert fits["weight"][neighbor_counter, month] == 0
+    assert (fits["weight"][0] > 0.9).all()
+
+
+def test_fit_ratio_and_min_pairs(pair):
+    target, neighbors = pair
+    fits = gp.fit_neighbors(target, neighbors, "ratio", min_pairs=30)
+    both = ~np.isnan(target) & ~np.isnan(neighbors[0])
+    expected = np.where(both, target, 0).sum(axis=(0, 2)) / np.where(both, neighbors[0], 0).sum(axis=(0, 2))
+    np.testing.assert_allclose(fits["slope"][0], expected)
+    assert (fits["intercept"] == 0).all()
+    assert (gp.fit_neighbors(target, neighbors, "ratio", min_pairs=1000)["weight"] == 0).all()
+    with pytest.raises(ValueError):
+        gp.fit_neighbors(target, neighbors, "median")
+
+
+def test_fill_gaps(pair):
+    target, neighbors = pair
+    fits = gp.fit_neighbors(target, neighbors, "regression")
+    cube = {"station_id": "USC00000100", "begin_year": 2001, "end_year": 2006, "elements": ["TMAX"],
+            "value": np.where(np.isnan(target), -9999., target).astype('f')[..., np.newaxis]}
+    for name in ("mflag", "qflag", "sflag"):
+        cube[name] = np.zeros(cube["value"].shape, dtype=np.uint8)
+    filled = gp.fill_gaps(cube, "TMAX", neighbors, fits)
+
+    # Brute force: weighted mean of the neighbors' estimates on every missing real date
+    valid, days_in_month = gp.valid_dates(2001, 2006)
+    count = 0
+    for year, month, day in zip(*np.nonzero(valid & np.isnan(target))):
+        estimates, weights = [], []
+        for neighbor_counter in range(2):
+            neighbor = neighbors[neighbor_counter, year, month, day]
+            if not np.isnan(neighbor) and fits["weight"][neighbor_counter, month] > 0:
+                estimates.append(fits["slope"][neighbor_counter, month] * neighbor +
+                                 fits["intercept"][neighbor_counter, month])
+                weights.append(fits["weight"][neighbor_counter, month])
+        if weights:
+            count += 1
+            assert filled["value"][year, month, day, 0] == pytest.approx(round(np.average(estimates, weights=weights), 1),
+                                                                         abs=0.051)
+            assert filled["mflag"][year, month, day, 0] == ord(gp.FILL_MFLAG)
+    assert filled["filled"] == count > 0
+    # Reported days and impossible dates are left alone
+    keep = ~np.isnan(target) | ~valid
+    np.testing.assert_array_equal(filled["value"][..., 0][keep], cube["value"][..., 0][keep])
+    assert (filled["mflag"][..., 0][keep] == 0).all()
+
+
+def test_find_neighbors(region):
+    neighbors = gp.find_neighbors(region["station_ids"][0], "TMAX", k=3, max_age=None)
+    assert [station_id for station_id, distance in neighbors] == region["station_ids"][1:4]
+    assert [distance for station_id, distance in neighbors] == sorted(distance for station_id, distance in neighbors)
+    assert gp.find_neighbors(region["station_ids"][0], "TMAX", max_distance=1, max_age=None) == []
+    assert gp.find_neighbors(region["station_ids"][0], "WESD", max_age=None) == []
+
+
+def test_gap_fill_station(region):
+    station = region["stations"][2]
+    filled = gp.gap_fill_station(station["station_id"], "TMAX", k=4, max_age=None)
+    assert len(filled["neighbors"]) == 4 and filled["filled"] > 0
+
+    # Filled days (held back or QC rejected) against the fixture's values
+    errors = []
+    for index in range(len(station["year"])):
+        year, month, day = station["year"][index], station["month"][index], station["day"][index]
+        if not filled["begin_year"] <= year <= filled["end_year"]:
+            continue
+        cell = (year - filled["begin_year"], month - 1, day - 1, 0)
+        if filled["mflag"][cell] == ord(gp.FILL_MFLAG):
+            errors.append(filled["value"][cell] - station["raw"]["TMAX"][index] / 10.0)
+    assert len(errors) == filled["filled"]
+    assert np.mean(np.abs(errors)) < 2.0
+
+
+def test_gap_fill_region_shares_fits(region, monkeypatch):
+    calls = []
+    fit_neighbors = gapfill.fit_neighbors
+    monkeypatch.setattr(gapfill, "fit_neighbors", lambda *args: calls.append(1) or fit_neighbors(*args))
+    station_ids = region["station_ids"][:3]
+    first = gp.gap_fill_region(station_ids, "PRCP", k=2, max_age=None)
+    fitted = len(calls)
+    second = gp.gap_fill_region(station_ids, "PRCP", k=2, max_age=None)
+    assert fitted == 6 and len(calls) == fitted
+    for station_id in station_ids:
+        np.testing.assert_array_equal(first[station_id]["value"], second[station_id]["value"])
+        assert (first[station_id]["value"][first[station_id]["mflag"] == ord(gp.FILL_MFLAG)] >= 0).all()
+
+
+def test_gap_fill_region_default_max_age(region, monkeypatch):
+    # Default max_age: nothing is downloaded again, each station is parsed once, each table fetched once
+    from ghcnpy import iotools
+
+    def no_download(*args, **kwargs):
+        raise AssertionError("downloaded %s" % (args,))
+    monkeypatch.setattr(iotools, "download_file", no_download)
+    counts = {"parse": [], "stations": 0, "inventory": 0}
+    read_dly_ragged, get_station_table, get_inventory_table = gp.read_dly_ragged, gp.get_station_table, \
+        gp.get_inventory_table
+
+    def parse(infile, *args):
+        counts["parse"].append(infile)
+        return read_dly_ragged(infile, *args)
+
+    def station_table(*args):
+        counts["stations"] += 1
+        return get_station_table(*args)
+
+    def inventory_table(*args):
+        counts["inventory"] += 1
+        return get_inventory_table(*args)
+    monkeypatch.setattr(gp, "read_dly_ragged", parse)
+    monkeypatch.setattr(gp, "get_station_table", station_table)
+    monkeypatch.setattr(gp, "get_inventory_table", inventory_table)
+
+    station_ids = region["station_ids"][:6]
+    gp.gap_fill_region(station_ids, "TMAX", k=3)
+    gp.gap_fill_region(station_ids, "TMAX", k=3)
+    assert sorted(counts["parse"]) == sorted(set(counts["parse"]))
+    assert (counts["stations"], counts["inventory"]) == (2, 2)
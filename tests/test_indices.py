@@ -0,0 +1,123 @@
+import calendar
+import os
+
+import numpy as np
+import pytest
+
+import ghcnpy as gp
+
+
+def observed(station, element, reject_flagged=False):
+    # (year, month, day) -> value, straight from the generated series
+    keep = station["present"][element]
+    if reject_flagged:
+        keep = keep & (station["flags"][element][1] == 0)
+    scale = np.float32(gp.element_scale(element))
+    return {(int(station["year"][index]), int(station["month"][index]), int(station["day"][index])):
+            np.float32(station["raw"][element][index]) / scale for index in np.flatnonzero(keep)}
+
+
+def read_cube(region, counter, elements):
+    return gp.read_dly(os.path.join(region["directory"], region["station_ids"][counter] + ".dly"), elements)
+
+
+def brute_force_index(station, elements, daily, aggregate, begin_year, end_year, freq, min_complete):
+    series = [observed(station, element) for element in elements]
+    periods = [(year, month) for year in range(begin_year, end_year + 1) for month in range(1, 13)]
+    if freq == "annual":
+        periods = [(year, None) for year in range(begin_year, end_year + 1)]
+    result = {}
+    for year, month in periods:
+        months = [month] if month else range(1, 13)
+        dates = [(year, m, day) for m in months for day in range(1, calendar.monthrange(year, m)[1] + 1)]
+        values = [daily(*(values[date] for values in series)) for date in dates
+                  if all(date in values for values in series)]
+        if not values or len(values) / len(dates) < min_complete:
+            result[(year, month)] = -9999.
+        elif aggregate == "mean":
+            result[(year, month)] = np.mean(values)
+        elif aggregate == "max":
+            result[(year, month)] = max(values)
+        else:
+            result[(year, month)] = sum(values)
+    return result
+
+
+@pytest.mark.parametrize("freq", ["monthly", "annual"])
+def test_heating_degree_days(region, freq):
+    station = region["stations"][2]
+    cube = read_cube(region, 2, ["TMAX", "TMIN"])
+    result = gp.compute_index(cube, "HDD", freq, min_complete=0.85)
+    expected = brute_force_index(station, ["TMAX", "TMIN"], lambda tmax, tmin: max(18.3 - (tmax + tmin) / 2.0, 0.0),
+                                 "sum", cube["begin_year"], cube["end_year"], freq, 0.85)
+    assert result["station_ids"] == [station["station_id"]]
+    assert (result["value"] != -9999.).any()
+    assert (result["value"] == -9999.).any() == (freq == "monthly")
+    for (year, month), value in expected.items():
+        cell = result["value"][year - cube["begin_year"]] if month is None else \
+            result["value"][year - cube["begin_year"], month - 1]
+        assert cell == pytest.approx(value, rel=1e-5, abs=1e-3)
+
+
+def test_stacked_index_matches_single_cubes(region):
+    cubes = [read_cube(region, counter, ["TMAX", "TMIN"]) for counter in range(4)]
+    stack = gp.stack_cubes(cubes)
+    stacked = gp.compute_index(stack, "FD", "annual")
+    for counter, cube in enumerate(cubes):
+        single = gp.compute_index(gp.select_years(cube, stack["begin_year"], stack["end_year"]), "FD", "annual")
+        np.testing.assert_array_equal(stacked["value"][counter], single["value"])
+        np.testing.assert_array_equal(stacked["completeness"][counter], single["completeness"])
+
+
+def test_registered_index(region):
+    def warm_and_wet(data, params):
+        return (data["TMAX"] > params["warm"]) & (data["PRCP"] >= params["wet"])
+
+    gp.register_index("WARMWET", ["TMAX", "PRCP"], warm_and_wet, "count", {"warm": 25.0, "wet": 1.0})
+    try:
+        station = region["stations"][0]
+        cube = read_cube(region, 0, ["TMAX", "PRCP"])
+        for warm in (25.0, 28.0):
+            result = gp.compute_index(cube, "WARMWET", "monthly", min_complete=0.0, warm=warm)
+            assert result["params"] == {"warm": warm, "wet": 1.0}
+            expected = brute_force_index(station, ["TMAX", "PRCP"],
+                                         lambda tmax, prcp: float(tmax > warm and prcp >= 1.0),
+                                         "count", cube["begin_year"], cube["end_year"], "monthly", 0.0)
+            assert sum(value for value in expected.values() if value != -9999.) > 0
+            for (year, month), value in expected.items():
+                assert result["value"][year - cube["begin_year"], month - 1] == value
+        with pytest.raises(ValueError):
+            gp.compute_index(read_cube(region, 0, ["TMAX"]), "WARMWET")
+    finally:
+        gp.INDICES.pop("WARMWET")
+    with pytest.raises(ValueError):
+        gp.register_index("WARMWET", ["TMAX"], warm_and_wet, "median")
+    assert "WARMWET" not in gp.INDICES
+
+
+@pytest.mark.parametrize("begin_year, end_year", [(None, None), (1981, 1990), (1981, 1984)])
+def test_daily_climatology_with_missing_days(region, begin_year, end_year):
+    # Station 2 starts in 1985, and 6% of its days (plus every flagged one) are missing
+    station = region["stations"][2]
+    cube = read_cube(region, 2, ["TMAX"])
+    climatology = gp.daily_climatology(cube, "TMAX", begin_year, end_year)
+    begin_year = cube["begin_year"] if begin_year is None else begin_year
+    end_year = cube["end_year"] if end_year is None else end_year
+
+    values = observed(station, "TMAX", reject_flagged=True)
+    for month in range(1, 13):
+        for day in range(1, 32):
+            days = [values[(year, month, day)] for year in range(begin_year, end_year + 1)
+                    if (year, month, day) in values]
+            assert climatology["count"][month - 1, day - 1] == len(days)
+            if not days:
+                for stat in ("mean", "min", "max"):
+                    assert climatology[stat][month - 1, day - 1] == -9999.
+                continue
+            assert climatology["mean"][month - 1, day - 1] == pytest.approx(np.mean(days), abs=1e-4)
+            assert climatology["min"][month - 1, day - 1] == min(days)
+            assert climatology["max"][month - 1, day - 1] == max(days)
+    if end_year < station["first_year"]:
+        assert (climatology["count"] == 0).all()
+    else:
+        assert climatology["count"][1, 28] < climatology["count"][1, 27]
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+import ghcnpy as gp
+
+
+def names(results):
+    return [result["name"] for result in results]
+
+
+@pytest.mark.parametrize("pattern, expected", [
+    ("station 3", ["TEST STATION 3"]),
+    ("^test", ["TEST STATION %d" % counter for counter in range(8)]),
+    ("[27]$", ["TEST STATION 2", "TEST STATION 7"]),
+    ("^TEST STATION [^4]+$", ["TEST STATION %d" % counter for counter in range(8) if counter != 4]),
+    # A class may not run into the next name
+    ("6[^X]+TEST", []),
+    ("nowhere", []),
+])
+def test_search_by_name(region, pattern, expected):
+    assert names(gp.search_stations(name=pattern, max_age=None)) == expected
+
+
+def test_station_table_names(region):
+    table = gp.get_station_table(None)
+    names = table.names()
+    assert names == [table.name(index) for index in range(len(table))]
+    assert table.names() is names
+    assert not hasattr(table, "_search_names")
+
+
+def test_empty_name_matches_all(region):
+    table = gp.get_station_table(None)
+    assert len(gp.search_stations(name="", table=table)) == len(table)
+    assert len(gp.search_stations(name="", limit=0, table=table)) == 0
+
+
+def test_search_by_distance(region):
+    stations = region["stations"]
+    results = gp.search_stations(lat=stations[3]["latitude"], lon=stations[3]["longitude"], distance=10, max_age=None)
+    assert results[0]["station_id"] == stations[3]["station_id"]
+    assert results[0]["distance"] == 0.0
+    assert [result["distance"] for result in results] == sorted(result["distance"] for result in results)
+    assert all(result["distance"] <= 10 for result in results)
+    assert len(results) < len(stations)
+
+
+def test_search_by_name_and_distance(region):
+    stations = region["stations"]
+    results = gp.search_stations(name="station [0-3]", lat=stations[0]["latitude"], lon=stations[0]["longitude"],
+                                 limit=2, max_age=None)
+    assert names(results) == ["TEST STATION 0", "TEST STATION 1"]
+
+
+def legacy_stations(path):
+    # The list-of-lists get_stations_in_datastructure used to build, line by line
+    stations = []
+    with open(path) as file_handle:
+        for index, line in enumerate(file_handle.readlines()):
+            stations.append([index, line[0:11].strip(), float(line[12:20].strip()), float(line[21:30].strip()),
+                             float(line[31:37].strip()), line[41:71].strip(),
+                             line[72:75].strip() if len(line) > 72 else "",
+                             line[80:85].strip() if len(line) > 80 else ""])
+    return stations
+
+
+def assert_same_rows(table, expected):
+    assert len(table) == len(expected)
+    assert [row.tolist() for row in table] == expected
+    for index, row in enumerate(expected):
+        assert table[index] == row
+        assert list(table[index]) == row and len(table[index]) == len(row)
+        assert [table[index][field] for field in range(len(row))] == row
+        assert table[index - len(expected)].tolist() == row
+    assert [row.tolist() for row in table[1:5:2]] == expected[1:5:2]
+    with pytest.raises(IndexError):
+        table[len(expected)]
+
+
+def test_station_table_matches_legacy_rows(region):
+    expected = legacy_stations(os.path.join(region["directory"], "ghcnd-stations.txt"))
+    table = gp.get_stations_in_datastructure(None)
+    assert isinstance(table, gp.StationTable)
+    assert_same_rows(table, expected)
+    for row in expected:
+        record = table[table.find(row[1])]
+        assert (record.station_id, record.latitude, record.longitude, record.elevation, record.name) == \
+            tuple(row[1:6])
+
+
+def test_station_table_edge_rows(tmp_path):
+    # Southern/western coordinates, WMO IDs, blank names and lines cut short after the name
+    rows = [("ASN00001000", -12.3456, -130.0001, -99.9, "", "EDGE ONE", "GSN", "", "94101"),
+            ("CA001234567", 49.1, -0.05, 1234.5, "BC", "  TWO  WORDS", "", "HCN", "71234"),
+            ("US1AKAB0001", 61.2, -149.9, 5.0, "AK", "", "", "", ""),
+            ("ZI000067983", -20.2, 32.616, 1132.0, "", "CHIPINGE", "", "", "")]
+    lines = ["%-11s %8.4f %9.4f %6.1f %-2s %-30s %-3s %-3s %-5s" % row for row in rows]
+    lines[-1] = lines[-1].rstrip()
+    path = str(tmp_path / "ghcnd-stations.txt")
+    with open(path, "w") as out:
+        out.write("\n".join(lines) + "\n")
+    with open(path, "rb") as file_handle:
+        table = gp.StationTable(file_handle.read())
+    assert_same_rows(table, legacy_stations(path))
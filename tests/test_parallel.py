@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pytest
+
+import ghcnpy as gp
+
+
+def serial_stack(infiles, elements, begin_year=None, end_year=None):
+    # Same stations in the same (sorted ID) order, parsed one by one
+    cubes = [gp.read_dly(infile, elements) for infile in sorted(infiles, key=os.path.basename)]
+    return gp.stack_cubes(cubes, elements, begin_year, end_year)
+
+
+def assert_same_stack(stack, expected):
+    assert stack["station_ids"] == expected["station_ids"]
+    assert (stack["begin_year"], stack["end_year"], stack["elements"]) == \
+        (expected["begin_year"], expected["end_year"], expected["elements"])
+    for name in ("value", "mflag", "qflag", "sflag"):
+        np.testing.assert_array_equal(stack[name], expected[name])
+
+
+@pytest.fixture
+def infiles(region):
+    # Out of ID order on purpose
+    return [os.path.join(region["directory"], station_id + ".dly") for station_id in region["station_ids"][::-1]]
+
+
+@pytest.mark.parametrize("processes", [1, 3])
+def test_parallel_matches_serial(infiles, processes):
+    elements = ["TMAX", "TMIN", "PRCP", "SNOW"]
+    assert_same_stack(gp.read_dly_parallel(infiles, elements, processes=processes), serial_stack(infiles, elements))
+
+
+@pytest.mark.parametrize("begin_year, end_year", [(1990, 1999), (1975, 1985), (2019, 2025)])
+def test_parallel_year_window(infiles, begin_year, end_year):
+    stack = gp.read_dly_parallel(infiles, ["PRCP", "WESD"], begin_year, end_year, processes=2)
+    assert_same_stack(stack, serial_stack(infiles, ["PRCP", "WESD"], begin_year, end_year))
+    assert (stack["value"][..., 1] == -9999.).all()
+
+
+def test_parallel_shared(infiles):
+    stack = gp.read_dly_parallel(infiles[:3], ["TMAX"], processes=2, copy=False)
+    try:
+        assert_same_stack(stack, serial_stack(infiles[:3], ["TMAX"]))
+        assert "_shared" in stack
+    finally:
+        gp.release_shared(stack)
+    assert "value" not in stack and "_shared" not in stack
+
+
+def test_read_dly_shared(infiles):
+    from multiprocessing import shared_memory
+    with gp.read_dly_shared(infiles[:3], ["TMAX", "PRCP"], processes=2) as stack:
+        assert_same_stack(stack, serial_stack(infiles[:3], ["TMAX", "PRCP"]))
+        names = [block.name for block in stack["_shared"]]
+    assert "value" not in stack and "_shared" not in stack
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+
+
+def test_station_layout():
+    station_ids, slots = gp.station_layout(["USC00000102", "USC00000100", "USC00000102", "USC00000101"])
+    assert station_ids == ["USC00000100", "USC00000101", "USC00000102"]
+    assert slots == {"USC00000100": 0, "USC00000101": 1, "USC00000102": 2}
+
+
+def test_dly_year_range(region, infiles):
+    stations = {station["station_id"]: station for station in region["stations"]}
+    for infile in infiles:
+        station = stations[os.path.basename(infile)[0:11]]
+        assert gp.dly_year_range(infile) == (station["first_year"], station["last_year"])
@@ -0,0 +1,71 @@
+import pytest
+
+import ghcnpy as gp
+
+
+@pytest.mark.parametrize("plot_type", ["temperature", "precipitation", "snowfall"])
+def test_render_plot_defaults(region, plot_type):
+    image = gp.render_plot(region["station_ids"][0], plot_type, cache=False)
+    assert image.startswith(b"\x89PNG")
+
+
+@pytest.mark.parametrize("begin_date, end_date", [
+    ("20200101", "20201231"),
+    ("20200315", "20200410"),
+    ("20191120", "20200205"),
+    ("20200229", "20200229"),
+])
+def test_temperature_partial_windows(region, begin_date, end_date):
+    image = gp.render_plot(region["station_ids"][0], "temperature", begin_date, end_date, cache=False)
+    assert image.startswith(b"\x89PNG")
+
+
+def test_render_plot_cache(region):
+    cache = gp.PlotCache()
+    station_id = region["station_ids"][1]
+    first = gp.render_plot(station_id, "precipitation", width=600, height=400, cache=cache)
+    second = gp.render_plot(station_id, "precipitation", width=600, height=400, cache=cache)
+    assert first is second
+    assert (cache.hits, cache.misses, len(cache)) == (1, 1, 1)
+
+    # Other parameters are another entry
+    gp.render_plot(station_id, "precipitation", width=300, height=200, cache=cache)
+    assert len(cache) == 2
+
+
+def test_plot_cache_eviction():
+    cache = gp.PlotCache(max_entries=2, max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"5678")
+    cache.get("a")
+    cache.put("c", b"90")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234"
+    assert cache.nbytes == 6
+    cache.put("d", b"x" * 11)
+    assert cache.get("d") is None
+
+
+def test_render_plot_formats(region):
+    image = gp.render_plot(region["station_ids"][0], "snowfall", fmt="svg", cache=False)
+    assert b"<svg" in image[:500]
+
+
+def test_unknown_plot_type(region):
+    with pytest.raises(ValueError):
+        gp.render_plot(region["station_ids"][0], "wind")
+
+
+@pytest.mark.parametrize("preview", [True, False])
+def test_station_map_from_station_table(region, tmp_path, preview):
+    # A StationTable and the legacy genfromtxt array draw the same map
+    bounds = (34., 37., -84., -81.)
+    table = gp.get_station_table(None)
+    assert isinstance(table, gp.StationTable)
+    from_table = gp.plot_station_map(table, bounds=bounds, preview=preview, outfile=str(tmp_path / "table.png"),
+                                     cache_dir=str(tmp_path))
+    from_array = gp.plot_station_map(gp.get_ghcnd_stations(None), bounds=bounds, preview=preview,
+                                     outfile=str(tmp_path / "array.png"), cache_dir=str(tmp_path))
+    with open(from_table, "rb") as f, open(from_array, "rb") as g:
+        image = f.read()
+        assert image.startswith(b"\x89PNG") and image == g.read()
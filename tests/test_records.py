@@ -0,0 +1,120 @@
+import gzip
+import os
+
+import numpy as np
+import pytest
+
+import ghcnpy as gp
+
+DOY_OFFSET = [0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335]
+
+
+def brute_force_highs(cube, element):
+    # Highest value per leap-year day of year, straight from the cube
+    value = cube["value"][..., cube["elements"].index(element)]
+    highs = np.full(366, np.nan)
+    for year_counter in range(value.shape[0]):
+        for month_counter in range(12):
+            for day_counter in range(31):
+                observed = value[year_counter, month_counter, day_counter]
+                if observed == -9999.:
+                    continue
+                doy = DOY_OFFSET[month_counter] + day_counter
+                highs[doy] = observed if np.isnan(highs[doy]) else max(highs[doy], observed)
+    return highs
+
+
+@pytest.mark.parametrize("reject_qflags", [gp.QFLAG_CODES, "", "X"])
+def test_cube_records_respect_reject_qflags(region, reject_qflags):
+    station_id = region["station_ids"][0]
+    cube = gp.read_dly(os.path.join(region["directory"], station_id + ".dly"), ["TMAX"])
+    table = gp.build_record_table([cube], ["TMAX"], reject_qflags=reject_qflags)
+    expected = brute_force_highs(gp.filter_qflags(cube, reject_qflags) if reject_qflags else cube, "TMAX")
+    np.testing.assert_allclose(gp.station_records(table, station_id, "TMAX")["high"], expected, equal_nan=True)
+
+
+def test_reject_qflags_changes_records(region):
+    station_id = region["station_ids"][0]
+    cube = gp.read_dly(os.path.join(region["directory"], station_id + ".dly"), ["TMAX"])
+    unfiltered = gp.build_record_table([cube], ["TMAX"], reject_qflags="")
+    filtered = gp.build_record_table([cube], ["TMAX"])
+    high = gp.station_records(unfiltered, station_id, "TMAX")["high"]
+    assert (high >= gp.station_records(filtered, station_id, "TMAX")["high"]).all()
+    assert (high > gp.station_records(filtered, station_id, "TMAX")["high"]).any()
+
+
+def write_year_files(region, directory):
+    # by_year layout: every station's rows for one year, ordered by date
+    rows = {}
+    for station_id in region["station_ids"]:
+        with gzip.open(os.path.join(region["directory"], station_id + ".csv.gz"), "rt") as f:
+            for line in f:
+                rows.setdefault(int(line[12:16]), []).append(line)
+    year_files = []
+    for year in sorted(rows):
+        year_files.append(os.path.join(directory, "%d.csv.gz" % year))
+        with gzip.open(year_files[-1], "wt") as out:
+            out.writelines(sorted(rows[year], key=lambda line: (line[12:20], line[0:11])))
+    return year_files
+
+
+def brute_force_events(region, years, elements):
+    # Walk every unflagged observation in date order, tracking records cell by cell
+    records, events = {}, []
+    for station in region["stations"]:
+        for element in elements:
+            for index in np.flatnonzero(station["present"][element] & (station["flags"][element][1] == 0)):
+                year, month, day = station["year"][index], station["month"][index], station["day"][index]
+                value = np.float32(station["raw"][element][index]) / np.float32(gp.element_scale(element))
+                key = (station["station_id"], DOY_OFFSET[month - 1] + day - 1, element)
+                if key not in records:
+                    records[key] = {"high": (value, year), "low": (value, year)}
+                    continue
+                for kind in ("high", "low"):
+                    previous, previous_year = records[key][kind]
+                    if kind == "high" and element in gp.ZERO_IS_NOT_RECORD and value <= 0:
+                        continue
+                    broken = value > previous if kind == "high" else value < previous
+                    if year in years and (broken or value == previous) and kind in gp.RECORD_KINDS[element]:
+                        events.append((int(year * 10000 + month * 100 + day), station["station_id"], element, kind,
+                                       "broken" if broken else "tied", float(value), float(previous),
+                                       int(previous_year)))
+                    if broken:
+                        records[key][kind] = (value, year)
+    events.sort(key=lambda event: (event[0], event[1], event[2], event[3]))
+    return records, events
+
+
+def test_incremental_updates_match_full_pass(region, tmp_path):
+    elements = ["TMAX", "TMIN", "PRCP", "SNOW"]
+    year_files = write_year_files(region, str(tmp_path))
+    cubes = [gp.read_dly(os.path.join(region["directory"], station_id + ".dly"), elements)
+             for station_id in region["station_ids"]]
+    full = gp.build_record_table(cubes, elements)
+
+    # Nightly workflow on by_year files: a base table, then one update per year
+    table = gp.build_record_table(year_files[:20], elements, chunksize=5000)
+    events = []
+    for year_file in year_files[20:]:
+        events.extend(gp.update_records(table, year_file, chunksize=5000))
+    assert table["last_date"] == full["last_date"] == 20201231
+    table = gp.load_record_table(gp.save_record_table(table, str(tmp_path / "records.npz")))
+
+    records, expected = brute_force_events(region, range(2001, 2021), elements)
+    assert expected
+    assert [tuple(event[name] for name in ("date", "station_id", "element", "kind", "status", "value", "previous",
+                                           "previous_year")) for event in events] == pytest.approx(expected)
+    assert len(table["keys"]) == len(full["keys"]) == len(records)
+    for station_id in region["station_ids"]:
+        for element_counter, element in enumerate(elements):
+            incremental = gp.station_records(table, station_id, element)
+            direct = gp.station_records(full, station_id, element)
+            for name in ("high", "low", "high_year", "low_year"):
+                np.testing.assert_allclose(incremental[name], direct[name], equal_nan=True)
+            for doy in range(366):
+                if (station_id, doy, element) in records:
+                    cell = records[(station_id, doy, element)]
+                    assert incremental["high"][doy] == pytest.approx(cell["high"][0])
+                    assert incremental["low_year"][doy] == cell["low"][1]
+                else:
+                    assert np.isnan(incremental["high"][doy])
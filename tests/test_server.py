@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import ghcnpy as gp
+from ghcnpy import server as gs
+
+
+@pytest.fixture
+def base_url(region):
+    httpd = gs.make_server(port=0, workers=2, backlog=4, max_age=None)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%d" % httpd.server_port
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def get(base_url, path):
+    try:
+        with urllib.request.urlopen(base_url + path, timeout=60) as response:
+            return response.status, response.headers["Content-Type"], response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.headers["Content-Type"], error.read()
+
+
+def test_search(base_url, region):
+    status, content_type, body = get(base_url, "/stations?name=test%20station&limit=3")
+    assert (status, content_type) == (200, "application/json")
+    assert json.loads(body)["count"] == 3
+
+
+def test_station(base_url, region):
+    status, _, body = get(base_url, "/stations/" + region["station_ids"][2])
+    assert status == 200
+    assert json.loads(body)["name"] == "TEST STATION 2"
+
+
+def test_data(base_url, region):
+    station_id = region["station_ids"][0]
+    status, _, body = get(base_url, "/data/%s?elements=TMAX,PRCP&begin=20100101&end=20100131" % station_id)
+    assert status == 200
+    response = json.loads(body)
+    assert response["elements"] == ["TMAX", "PRCP"]
+    dates = [row[0] for row in response["rows"]]
+    assert dates and min(dates) >= 20100101 and max(dates) <= 20100131
+
+
+def test_climatology(base_url, region):
+    status, _, body = get(base_url, "/climatology/%s?element=tmin" % region["station_ids"][0])
+    assert status == 200
+    assert json.loads(body)["station_id"] == region["station_ids"][0]
+
+
+def test_plot(base_url, region):
+    status, content_type, body = get(base_url, "/plot/%s/precipitation.png?width=400&height=300"
+                                     % region["station_ids"][0])
+    assert (status, content_type) == (200, "image/png")
+    assert body.startswith(b"\x89PNG")
+
+
+@pytest.mark.parametrize("path", [
+    "/",
+    "/nothing",
+    "/stations/USC99999999",
+    "/data/USC99999999",
+    "/climatology/{station}?element=WSFG",
+    "/plot/{station}/wind.png",
+    "/plot/{station}/temperature.gif",
+])
+def test_not_found(base_url, region, path):
+    status, content_type, body = get(base_url, path.format(station=region["station_ids"][0]))
+    assert (status, content_type) == (404, "application/json")
+    assert "error" in json.loads(body)
+
+
+@pytest.mark.parametrize("path", [
+    "/stations?limit=ten",
+    "/stations?name=[",
+    "/data/{station}?begin=2010XX01",
+    "/plot/{station}/snowfall.png?width=wide",
+])
+def test_bad_request(base_url, region, path):
+    status, _, _ = get(base_url, path.format(station=region["station_ids"][0]))
+    assert status == 400
+
+
+def test_internal_error(base_url, region, monkeypatch):
+    # Bugs are a 500, not a missing resource
+    def broken(*args, **kwargs):
+        raise KeyError("bug")
+    monkeypatch.setattr(gp, "daily_climatology", broken)
+    status, _, body = get(base_url, "/climatology/%s" % region["station_ids"][1])
+    assert status == 500
+    assert "KeyError" in json.loads(body)["error"]
+
+
+def test_service_parses_each_file_once(region, monkeypatch):
+    service = gs.StationService(max_age=None)
+    parsed = []
+    read_dly_ragged = gp.read_dly_ragged
+
+    def parse(infile, *args):
+        parsed.append(infile)
+        return read_dly_ragged(infile, *args)
+    monkeypatch.setattr(gp, "read_dly_ragged", parse)
+
+    station_id = region["station_ids"][2]
+    infile = gp.data_path(station_id + ".dly")
+    responses = [service.handle("/data/" + station_id, {"elements": ["TMAX,PRCP"], "begin": ["199001"],
+                                                        "end": ["199112"]}),
+                 service.handle("/data/" + station_id, {"elements": ["SNOW"], "reject": [""]}),
+                 service.handle("/climatology/" + station_id, {"element": ["TMIN"]})]
+    assert parsed == [infile]
+
+    # Same rows as parsing the file directly
+    cube = gp.filter_qflags(gp.read_dly(infile, ["TMAX", "PRCP"], "199001", "199112"))
+    rows = json.loads(responses[0])["rows"]
+    assert len(rows) == int((cube["value"] != -9999.).any(axis=3).sum())
+    climatology = gp.daily_climatology(gp.read_dly(infile, ["TMIN"]), "TMIN")
+    assert json.loads(responses[2])["count"] == climatology["count"].tolist()
+
+    # A new version of the file is parsed again
+    info = os.stat(infile)
+    os.utime(infile, ns=(info.st_atime_ns, info.st_mtime_ns + 10 ** 9))
+    service.handle("/data/" + station_id, {"elements": ["TMAX"]})
+    assert parsed == [infile, infile]
+
+
+def test_service_keeps_one_image(region):
+    service = gs.StationService(max_age=None)
+    station_id = region["station_ids"][0]
+    query = {"width": ["400"], "height": ["300"]}
+    image = service.handle("/plot/%s/temperature.png" % station_id, query)
+    assert service.handle("/plot/%s/temperature.png" % station_id, query) is image
+    assert (len(service.plots), service.plots.hits) == (1, 1)
+    assert len(service.responses) == 0
+    with pytest.raises(gs.NotFound):
+        service.handle("/plot/USC99999999/temperature.png", query)
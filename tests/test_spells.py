@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pytest
+
+import ghcnpy as gp
+
+
+@pytest.fixture
+def cube(region):
+    station_id = region["station_ids"][1]
+    return gp.read_dly(os.path.join(region["directory"], station_id + ".dly"), ["TMAX", "PRCP"])
+
+
+def brute_force_thresholds(series, percentile, window, base_begin, base_end):
+    # Every base period value within window // 2 days of each day of year, circular
+    half = window // 2
+    thresholds = np.full((series["value"].shape[0], 366), np.nan)
+    for row in range(series["value"].shape[0]):
+        for doy in range(366):
+            pooled = []
+            for day_counter in range(len(series["doy"])):
+                distance = (series["doy"][day_counter] - doy) % 366
+                if (min(distance, 366 - distance) <= half and base_begin <= series["year"][day_counter] <= base_end
+                        and not np.isnan(series["value"][row, day_counter])):
+                    pooled.append(np.float32(series["value"][row, day_counter]))
+            if pooled:
+                thresholds[row, doy] = np.percentile(np.array(pooled, dtype='f'), percentile)
+    return thresholds
+
+
+@pytest.mark.parametrize("percentile, window, base_begin, base_end", [(90, 5, 2001, 2010), (10, 3, 2011, 2012)])
+def test_percentile_thresholds(cube, percentile, window, base_begin, base_end):
+    series = gp.daily_series(gp.filter_qflags(cube), "TMAX")
+    expected = brute_force_thresholds(series, percentile, window, base_begin, base_end)
+    thresholds = gp.percentile_thresholds(series, percentile, window, base_begin, base_end)
+    assert thresholds.shape == (1, 366)
+    np.testing.assert_allclose(thresholds, expected, rtol=1e-5, equal_nan=True)
+
+
+def brute_force_spells(value, condition, min_length, years):
+    # Walk the days: running length, then every run of at least min_length as (start, end, length)
+    running, events, start = 0, [], None
+    longest = {}
+    for day_counter in range(len(value)):
+        if not np.isnan(value[day_counter]) and condition(value[day_counter]):
+            start = day_counter if running == 0 else start
+            running += 1
+        else:
+            if running >= min_length:
+                events.append((start, day_counter - 1, running))
+            running = 0
+        longest[years[day_counter]] = max(longest.get(years[day_counter], 0), running)
+    if running >= min_length:
+        events.append((start, len(value) - 1, running))
+    return longest, events
+
+
+def test_dry_spells(cube):
+    series = gp.daily_series(gp.filter_qflags(cube), "PRCP")
+    longest, events = brute_force_spells(series["value"][0], lambda value: value < 1.0, 5, series["year"])
+    result = gp.dry_spells(cube, threshold=1.0, min_length=5)
+    assert [(event["begin_date"], event["end_date"], event["length"]) for event in result["events"]] == [
+        (series["dates"][start], series["dates"][end], length) for start, end, length in events]
+    assert list(result["longest"]) == [longest[year] for year in result["year"]]
+    end_years = [series["year"][end] for start, end, length in events]
+    assert list(result["count"]) == [end_years.count(year) for year in result["year"]]
+
+
+def test_max_n_day_total(cube):
+    series = gp.daily_series(gp.filter_qflags(cube), "PRCP")
+    value = series["value"][0]
+    result = gp.max_n_day_total(cube, n=3)
+    for year, largest in zip(result["year"], result["value"]):
+        totals = [value[day_counter - 2:day_counter + 1].sum() for day_counter in range(2, len(value))
+                  if series["year"][day_counter] == year]
+        totals = [total for total in totals if not np.isnan(total)]
+        assert largest == (pytest.approx(max(totals), rel=1e-5) if totals else -9999.)
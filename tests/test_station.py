@@ -0,0 +1,79 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import ghcnpy as gp
+from ghcnpy import iotools
+
+
+@pytest.fixture
+def downloads(region, tmp_path, monkeypatch):
+    # Serve "downloads" from a pristine copy of the region, counting each file fetched
+    remote = str(tmp_path / "remote")
+    shutil.copytree(region["directory"], remote)
+    fetched = []
+
+    def download(url, outfile, *args, **kwargs):
+        fetched.append(url.rsplit("/", 1)[-1])
+        shutil.copyfile(os.path.join(remote, fetched[-1]), outfile)
+        return outfile
+    monkeypatch.setattr(iotools, "download_file", download)
+    return fetched
+
+
+@pytest.fixture
+def parses(monkeypatch):
+    parsed = []
+    read_dly_ragged = gp.read_dly_ragged
+
+    def parse(infile, *args):
+        parsed.append(os.path.basename(infile))
+        return read_dly_ragged(infile, *args)
+    monkeypatch.setattr(gp, "read_dly_ragged", parse)
+    return parsed
+
+
+def test_views_match_direct_reads(region, downloads, parses):
+    station_id = region["station_ids"][3]
+    station = gp.Station(station_id)
+    for attempt in range(2):
+        metadata, ragged, cube = station.metadata, station.ragged, station.cube
+        selection = station.select(["TMAX", "PRCP"], "199001", "199912")
+        station.dataframe, station.climatology, station.accumulations, station.inventory
+    assert sorted(downloads) == sorted([station_id + ".dly", "ghcnd-stations.txt", "ghcnd-inventory.txt"])
+    assert parses == [station_id + ".dly"]
+
+    infile = os.path.join(region["directory"], station_id + ".dly")
+    table = gp.get_station_table(None)
+    expected = table[table.find(station_id)]
+    assert (metadata.station_id, metadata.latitude, metadata.longitude, metadata.elevation, metadata.name) == \
+        (expected.station_id, expected.latitude, expected.longitude, expected.elevation, expected.name)
+    direct = iotools.read_dly_ragged(infile)
+    for name in ("element_ptr", "months", "value", "mflag", "qflag", "sflag"):
+        np.testing.assert_array_equal(ragged[name], direct[name])
+    for view, direct in ((cube, gp.read_dly(infile)),
+                         (selection, gp.filter_qflags(gp.read_dly(infile, ["TMAX", "PRCP"], "199001", "199912")))):
+        assert (view["begin_year"], view["end_year"], view["elements"]) == \
+            (direct["begin_year"], direct["end_year"], direct["elements"])
+        for name in ("value", "mflag", "qflag", "sflag"):
+            np.testing.assert_array_equal(view[name], direct[name])
+
+
+def test_output_matches_station_id(region, downloads, parses, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    station_id = region["station_ids"][1]
+    elements = ["TMAX", "TMIN", "PRCP"]
+    outputs = []
+    for station in (station_id, gp.Station(station_id)):
+        gp.output_to_csv(station, elements, begin_date="200001", end_date="200512")
+        with open(station_id + ".csv") as f:
+            outputs.append((f.read(), gp.to_datastructure(station, elements, begin_date="200001", end_date="200512")))
+        os.remove(station_id + ".csv")
+    assert outputs[0] == outputs[1]
+    assert outputs[0][1] and len(outputs[0][0].splitlines()) == len(outputs[0][1]) + 1
+
+    # A station ID fetches and parses its file on every call, a Station once
+    assert downloads == [station_id + ".dly"] * 3
+    assert parses == [station_id + ".dly"] * 3
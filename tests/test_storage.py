@@ -0,0 +1,189 @@
+import os
+
+import numpy as np
+import pytest
+
+import ghcnpy as gp
+from ghcnpy import iotools
+
+
+def test_data_dir_created_on_use(tmp_path, monkeypatch):
+    # As from $GHCNPY_DATA_DIR: never passed through set_data_dir
+    directory = str(tmp_path / "fresh" / "ghcnd")
+    monkeypatch.setattr(iotools, "_data_dir", directory)
+    assert gp.data_path("ghcnd-stations.txt") == os.path.join(directory, "ghcnd-stations.txt")
+    assert os.path.isdir(directory)
+
+
+def test_lock_files_kept_apart(tmp_path):
+    path = str(tmp_path / "USC00000100.dly")
+    with gp.file_lock(path):
+        pass
+    assert os.listdir(str(tmp_path)) == [gp.LOCK_DIR]
+    assert os.listdir(str(tmp_path / gp.LOCK_DIR)) == ["USC00000100.dly.lock"]
+
+
+@pytest.mark.parametrize("outfile, magic", [("plot.png", b"\x89PNG"), ("plot.svg", b"<?xml"), ("plot", b"\x89PNG")])
+def test_save_figure(tmp_path, outfile, magic):
+    from matplotlib.figure import Figure
+    fig = Figure()
+    fig.add_subplot().plot([0, 1], [1, 0])
+    outfile = gp.save_figure(fig, str(tmp_path / outfile), dpi=50)
+    with open(outfile, "rb") as f:
+        assert f.read().startswith(magic)
+    assert os.listdir(str(tmp_path)) == [os.path.basename(outfile)]
+
+
+def test_plot_functions_write_atomically(region, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    station_id = region["station_ids"][0]
+    gp.plot_precipitation(gp.Station(station_id, max_age=None))
+    assert sorted(os.listdir(str(tmp_path))) == [station_id + "_precipitation.png", "data"]
+
+
+def station_file(region, counter, suffix=".dly"):
+    return os.path.join(region["directory"], region["station_ids"][counter] + suffix)
+
+
+def assert_same_cube(cube, expected):
+    assert (cube["begin_year"], cube["end_year"], cube["elements"]) == \
+        (expected["begin_year"], expected["end_year"], expected["elements"])
+    for name in ("value", "mflag", "qflag", "sflag"):
+        np.testing.assert_array_equal(cube[name], expected[name])
+
+
+@pytest.mark.parametrize("codec", ["gzip", "zlib"])
+def test_compressed_round_trip(region, codec):
+    infile = station_file(region, 2)
+    expected = gp.read_dly(infile)
+    window = gp.read_dly(infile, ["TMAX", "PRCP"], "199503", "199602")
+    outfile = gp.compress_file(infile, codec=codec, remove=True)
+    assert outfile == infile + gp.COMPRESSION_SUFFIXES[codec]
+    assert not os.path.exists(infile)
+    assert_same_cube(gp.read_dly(outfile), expected)
+    assert_same_cube(gp.read_dly(outfile, ["TMAX", "PRCP"], "199503", "199602"), window)
+
+
+def test_compressed_index_written_with_file(region, monkeypatch):
+    infile = station_file(region, 3)
+    index = gp.build_dly_index(infile)
+    outfile = gp.compress_file(infile)
+    assert os.path.exists(outfile + ".idx.npz")
+
+    # Readers use the stored index, nothing decompresses the file to rebuild it
+    def rebuild(path):
+        raise AssertionError("index rebuilt for " + path)
+    monkeypatch.setattr(iotools, "build_dly_index", rebuild)
+    for name in ("keys", "starts", "ends"):
+        np.testing.assert_array_equal(gp.get_dly_index(outfile)[name], index[name])
+    station = region["stations"][3]
+    assert gp.dly_year_range(outfile) == (station["first_year"], station["last_year"])
+
+
+def test_fetch_resource_compresses_local_copy(region):
+    gp.set_compression("gzip")
+    try:
+        station_id = region["station_ids"][4]
+        expected = gp.read_dly(station_file(region, 4))
+        outfile = gp.station_file(station_id, max_age=None)
+    finally:
+        gp.set_compression(None)
+    assert outfile.endswith(".dly.gz")
+    assert os.path.exists(outfile + ".idx.npz")
+    assert_same_cube(gp.read_dly(outfile), expected)
+
+
+def test_parallel_compressed(region):
+    plain = [station_file(region, counter) for counter in range(len(region["station_ids"]))]
+    expected = gp.read_dly_parallel(plain, ["TMAX", "PRCP"], processes=2)
+    compressed = [gp.compress_file(infile, codec="zlib", remove=False) for infile in plain[::2]] + plain[1::2]
+    stack = gp.read_dly_parallel(compressed, ["TMAX", "PRCP"], processes=2)
+    assert stack["station_ids"] == expected["station_ids"]
+    assert_same_cube(stack, expected)
+
+
+def test_station_csv_round_trip(region):
+    for counter in range(len(region["station_ids"])):
+        expected = gp.read_dly_ragged(station_file(region, counter))
+        ragged = gp.read_dly_ragged(station_file(region, counter, ".csv.gz"))
+        assert set(ragged) == set(expected)
+        for name, value in expected.items():
+            np.testing.assert_array_equal(ragged[name], value)
+    assert_same_cube(gp.read_dly(station_file(region, 5, ".csv.gz"), ["TMIN", "SNOW"], "200012", "200103"),
+                     gp.read_dly(station_file(region, 5), ["TMIN", "SNOW"], "200012", "200103"))
+
+
+def test_station_csv_year_range(region, tmp_path):
+    for counter, station in enumerate(region["stations"]):
+        year_range = (station["first_year"], station["last_year"])
+        assert gp.station_csv_year_range(station_file(region, counter, ".csv.gz")) == year_range
+        assert gp.dly_year_range(station_file(region, counter, ".csv.gz")) == year_range
+
+    # Rows out of date order, blank lines, no final newline, tiny chunks
+    path = str(tmp_path / "USC00000999.csv")
+    with open(path, "w") as out:
+        out.write("USC00000999,19990105,TMAX,12,,,7,\n\nUSC00000999,19870105,TMAX,12,,,7,\n"
+                  "USC00000999,20030105,PRCP,0,,,7,")
+    assert gp.station_csv_year_range(path, chunk_size=16) == (1987, 2003)
+    assert gp.station_csv_year_range(path) == (1987, 2003)
+
+    # Nothing reported yet
+    empty = str(tmp_path / "USC00000998.csv")
+    open(empty, "w").close()
+    ragged = gp.read_dly_ragged(empty)
+    assert gp.station_csv_year_range(empty) == (ragged["begin_year"], ragged["end_year"])
+    assert len(ragged["months"]) == 0
+
+
+def test_parallel_station_csv(region):
+    dly = [station_file(region, counter) for counter in range(len(region["station_ids"]))]
+    csv = [station_file(region, counter, ".csv.gz") for counter in range(len(region["station_ids"]))]
+    expected = gp.read_dly_parallel(dly, ["TMAX", "TMIN", "PRCP"], processes=2)
+    stack = gp.read_dly_parallel(csv, ["TMAX", "TMIN", "PRCP"], processes=2)
+    assert stack["station_ids"] == expected["station_ids"]
+    assert_same_cube(stack, expected)
+
+
+def test_fetch_resource_download_keeps_index(region, monkeypatch):
+    # Download branch: the index stored with the compressed file must still match it afterwards
+    source = station_file(region, 6)
+
+    def download(url, outfile, *args, **kwargs):
+        with open(source, "rb") as f, open(outfile, "wb") as out:
+            out.write(f.read())
+        return outfile
+    monkeypatch.setattr(iotools, "download_file", download)
+    outfile = gp.fetch_resource("http://stand-in/USC00000999.dly", "USC00000999.dly", 0, "gzip")
+    assert outfile.endswith("USC00000999.dly.gz")
+    expected = gp.read_dly(source, ["TMAX"], "200001", "200012")
+
+    def rebuild(path):
+        raise AssertionError("index rebuilt for " + path)
+    monkeypatch.setattr(iotools, "build_dly_index", rebuild)
+    np.testing.assert_array_equal(gp.read_dly(outfile, ["TMAX"], "200001", "200012")["value"], expected["value"])
+
+
+@pytest.mark.parametrize("begin_date, end_date", [("198301", "198302"), ("200006", "200107"), ("201901", None),
+                                                  ("190001", "190012")])
+def test_compressed_window_stops_early(region, monkeypatch, begin_date, end_date):
+    infile = station_file(region, 0)
+    expected = gp.read_dly_window(infile, begin_date, end_date)
+    outfile = gp.compress_file(infile, remove=False)
+
+    decompressed = []
+    iter_data_file = iotools.iter_data_file
+
+    def small_chunks(path, chunk_size=1 << 20):
+        for chunk in iter_data_file(path, 4096):
+            decompressed.append(len(chunk))
+            yield chunk
+    monkeypatch.setattr(iotools, "iter_data_file", small_chunks)
+    assert gp.read_dly_window(outfile, begin_date, end_date) == expected
+
+    # Every chunk but the last ended before the window did
+    index = gp.get_dly_index(outfile)
+    wanted = (index["keys"] >= int(begin_date)) & (index["keys"] <= int(end_date or 999999))
+    stop = index["ends"][wanted].max() if wanted.any() else 0
+    assert sum(decompressed[:-1]) < max(stop, 1)
+    if end_date is not None and wanted.any():
+        assert sum(decompressed) < os.path.getsize(infile)
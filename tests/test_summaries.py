@@ -0,0 +1,105 @@
+import calendar
+import gzip
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ghcnpy as gp
+from ghcnpy import summaries
+
+
+def dly_files(region):
+    return [os.path.join(region["directory"], station_id + ".dly") for station_id in region["station_ids"]]
+
+
+def write_year_file(region, year, outfile):
+    # by_year layout: every station's rows for one year, ordered by date
+    rows = []
+    for station_id in region["station_ids"]:
+        with gzip.open(os.path.join(region["directory"], station_id + ".csv.gz"), "rt") as f:
+            rows.extend(line for line in f if line[12:16] == str(year))
+    rows.sort(key=lambda line: (line[12:20], line[0:11]))
+    with gzip.open(outfile, "wt") as out:
+        out.writelines(rows)
+    return outfile
+
+
+def test_summarize_stations(region, tmp_path):
+    outfile = gp.summarize_stations(dly_files(region), str(tmp_path / "gsom.csv"), elements=["TMAX", "PRCP"])
+    summary = pd.read_csv(outfile, keep_default_na=False)
+
+    # Brute force for one station / month / element
+    station_id = region["station_ids"][2]
+    cube = gp.filter_qflags(gp.read_dly(dly_files(region)[2], ["TMAX", "PRCP"]))
+    for year, month, element in [(1990, 2, "TMAX"), (2000, 2, "PRCP"), (2019, 12, "TMAX")]:
+        days = calendar.monthrange(year, month)[1]
+        values = [value for value in cube["value"][year - cube["begin_year"], month - 1, :days,
+                                                   cube["elements"].index(element)] if value != -9999.]
+        row = summary[(summary["STATION"] == station_id) & (summary["YEAR"] == year) & (summary["MONTH"] == month) &
+                      (summary["ELEMENT"] == element)].iloc[0]
+        assert row["COUNT"] == len(values)
+        assert row["MEAN"] == pytest.approx(np.mean(values), abs=0.006)
+        assert row["TOTAL"] == pytest.approx(np.sum(values), abs=0.006)
+        assert (row["MIN"], row["MAX"]) == (pytest.approx(min(values), abs=0.006), pytest.approx(max(values), abs=0.006))
+        assert row["COMPLETENESS"] == pytest.approx(len(values) / days, abs=0.006)
+
+
+@pytest.mark.parametrize("freq", ["monthly", "annual"])
+def test_summarize_stations_batches(region, tmp_path, monkeypatch, freq):
+    # Every batch, stacked over its whole year range, stays inside max_memory_mb
+    stacked = []
+    summarize_batch = summaries._summarize_batch
+
+    def record_batch(batch_files, elements, freq, reject_qflags):
+        ranges = np.array([gp.dly_year_range(batch_file) for batch_file in batch_files])
+        stacked.append(len(batch_files) * (ranges[:, 1].max() - ranges[:, 0].min() + 1) * 12 * 31 * len(elements) * 32)
+        return summarize_batch(batch_files, elements, freq, reject_qflags)
+    monkeypatch.setattr(summaries, "_summarize_batch", record_batch)
+
+    single = gp.summarize_stations(dly_files(region), str(tmp_path / "single.csv"), freq=freq)
+    assert len(stacked) == 1
+    stacked.clear()
+    batched = gp.summarize_stations(dly_files(region), str(tmp_path / "batched.csv"), freq=freq, max_memory_mb=16)
+    assert len(stacked) > 1 and max(stacked) <= 16e6
+    with open(single) as first, open(batched) as second:
+        assert first.read() == second.read()
+
+
+@pytest.mark.parametrize("freq", ["monthly", "annual"])
+def test_summarize_year_files(region, tmp_path, monkeypatch, freq):
+    year_files = [write_year_file(region, year, str(tmp_path / ("%d.csv.gz" % year))) for year in (2009, 2010)]
+    stations = pd.read_csv(gp.summarize_stations(dly_files(region), str(tmp_path / "stations.csv"), freq=freq),
+                           keep_default_na=False)
+    keys = ["STATION", "YEAR"] + (["MONTH"] if freq == "monthly" else []) + ["ELEMENT"]
+    expected = stations[stations["YEAR"].isin([2009, 2010])].sort_values(keys).reset_index(drop=True)
+
+    # Rows come out year file by year file
+    in_memory = gp.summarize_year_files(year_files, str(tmp_path / "years.csv"), freq=freq)
+    years = pd.read_csv(in_memory, keep_default_na=False)
+    assert list(years["YEAR"]) == sorted(years["YEAR"])
+    # Means of float32 cubes may round the last digit the other way
+    pd.testing.assert_frame_equal(years.sort_values(keys).reset_index(drop=True), expected, check_exact=False,
+                                  atol=0.011)
+
+    # A tiny budget spills partial sums to disk; the output does not change
+    spills = []
+    spill_partials = summaries._spill_partials
+    monkeypatch.setattr(summaries, "_spill_partials", lambda spill, merged: spills.append(len(merged)) or
+                        spill_partials(spill, merged))
+    spilled = gp.summarize_year_files(year_files, str(tmp_path / "spilled.csv"), freq=freq, max_memory_mb=0.01)
+    assert len(spills) > 2
+    with open(in_memory) as first, open(spilled) as second:
+        assert first.read() == second.read()
+
+
+def test_summarize_netcdf(region, tmp_path):
+    import netCDF4 as nc
+    outfile = gp.summarize_stations(dly_files(region)[:2], str(tmp_path / "gsoy.nc"), freq="annual",
+                                    output_format="netcdf")
+    csv = pd.read_csv(gp.summarize_stations(dly_files(region)[:2], str(tmp_path / "gsoy.csv"), freq="annual"),
+                      keep_default_na=False)
+    with nc.Dataset(outfile) as dataset:
+        assert len(dataset.dimensions["record"]) == len(csv)
+        np.testing.assert_array_equal(dataset["count"][:], csv["COUNT"])